@@ -4,8 +4,10 @@ from lib.evaluation import evaluate_with_ollama
 from lib.hybrid_search import (
     normalize_scores,
     rrf_search_command,
+    warm_up_command,
     weighted_search_command,
 )
+from lib.search_utils import DEFAULT_EMBEDDING_MODEL
 
 
 def main() -> None:
@@ -32,6 +34,7 @@ def main() -> None:
     weighted_parser.add_argument(
         "--limit", type=int, default=5, help="Number of results to return (default=5)"
     )
+    add_model_argument(weighted_parser)
 
     rrf_parser = subparsers.add_parser(
         "rrf-search", help="Perform Reciprocal Rank Fusion search"
@@ -63,6 +66,17 @@ def main() -> None:
     rrf_parser.add_argument(
         "--limit", type=int, default=5, help="Number of results to return (default=5)"
     )
+    add_model_argument(rrf_parser)
+
+    warm_up_parser = subparsers.add_parser(
+        "warm-up", help="Load the search models and report load time and memory"
+    )
+    warm_up_parser.add_argument(
+        "--cross-encoder",
+        action="store_true",
+        help="Also load the cross-encoder used for reranking",
+    )
+    add_model_argument(warm_up_parser)
 
     args = parser.parse_args()
 
@@ -72,7 +86,9 @@ def main() -> None:
             for score in normalized:
                 print(f"* {score:.4f}")
         case "weighted-search":
-            result = weighted_search_command(args.query, args.alpha, args.limit)
+            result = weighted_search_command(
+                args.query, args.alpha, args.limit, args.model
+            )
 
             print(
                 f"Weighted Hybrid Search Results for '{result['query']}' (alpha={result['alpha']}):"
@@ -92,7 +108,12 @@ def main() -> None:
                 print()
         case "rrf-search":
             result = rrf_search_command(
-                args.query, args.k, args.enhance, args.rerank_method, args.limit
+                args.query,
+                args.k,
+                args.enhance,
+                args.rerank_method,
+                args.limit,
+                args.model,
             )
 
             if result["enhanced_query"]:
@@ -132,9 +153,31 @@ def main() -> None:
                 print()
             if args.evaluate:
                 evaluate_with_ollama(args.query, result["results"])
+        case "warm-up":
+            report = warm_up_command(args.cross_encoder, args.model)
+            for stats in report["models"]:
+                print(
+                    f"{stats['kind']} {stats['name']}: "
+                    f"loaded in {stats['load_seconds']:.2f}s, "
+                    f"{stats['parameter_bytes'] / 2**20:.1f} MiB of parameters"
+                )
+            print(
+                f"Warm-up took {report['seconds']:.2f}s; peak RSS "
+                f"{report['rss_before'] / 2**20:.0f} MiB -> "
+                f"{report['rss_after'] / 2**20:.0f} MiB"
+            )
         case _:
             parser.print_help()
 
 
+def add_model_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--model",
+        default=DEFAULT_EMBEDDING_MODEL,
+        help="Embedding model for semantic retrieval "
+        f"(default {DEFAULT_EMBEDDING_MODEL})",
+    )
+
+
 if __name__ == "__main__":
     main()
@@ -3,23 +3,67 @@
 import argparse
 
 from lib.keyword_search import (
+    bm25_batch_command,
     bm25_idf_command,
     bm25_tf_command,
     bm25search_command,
     build_command,
+    delete_command,
     idf_command,
+    index_memory_command,
+    merge_command,
+    phrase_command,
     search_command,
+    segments_command,
+    sync_command,
     tf_command,
     tfidf_command,
+    tokenizer_benchmark_command,
 )
-from lib.search_utils import BM25_B, BM25_K1
+from lib.search_utils import BM25_B, BM25_K1, INGEST_BATCH_SIZE
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Keyword Search CLI")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
-    subparsers.add_parser("build", help="Build the inverted index")
+    build_parser = subparsers.add_parser("build", help="Build the inverted index")
+    build_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes that tokenize and index shards in parallel",
+    )
+    build_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=INGEST_BATCH_SIZE,
+        help="Number of movies read and indexed at a time",
+    )
+    build_parser.add_argument(
+        "--positions",
+        action="store_true",
+        help="Store word positions to support phrase and proximity queries",
+    )
+
+    sync_parser = subparsers.add_parser(
+        "sync", help="Index new, changed and removed movies without a rebuild"
+    )
+    sync_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes that tokenize and index shards in parallel",
+    )
+
+    delete_parser = subparsers.add_parser(
+        "delete", help="Remove documents from the inverted index"
+    )
+    delete_parser.add_argument("doc_ids", type=int, nargs="+", help="Document IDs")
+
+    subparsers.add_parser("merge", help="Merge all index segments into one")
+
+    subparsers.add_parser("segments", help="List the segments of the inverted index")
 
     search_parser = subparsers.add_parser("search", help="Search movies using BM25")
     search_parser.add_argument("query", type=str, help="Search query")
@@ -63,15 +107,74 @@ def main() -> None:
     bm25search_parser = subparsers.add_parser(
         "bm25search", help="Search movies using full BM25 scoring"
     )
-    bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_parser.add_argument(
+        "query", type=str, help='Search query; quote "exact phrases" or "words"~N'
+    )
+    bm25search_parser.add_argument(
+        "--proximity",
+        action="store_true",
+        help="Boost documents where the query terms appear close together",
+    )
+
+    bm25batch_parser = subparsers.add_parser(
+        "bm25batch", help="Score a file of queries (one per line) as one batch"
+    )
+    bm25batch_parser.add_argument("queries_file", type=str, help="Path to queries")
+    bm25batch_parser.add_argument(
+        "--limit", type=int, default=5, help="Number of results per query"
+    )
+    bm25batch_parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="Also time scoring the queries one at a time",
+    )
+
+    phrase_parser = subparsers.add_parser(
+        "phrase", help="Search movies containing a phrase, ranked by BM25"
+    )
+    phrase_parser.add_argument("phrase", type=str, help="Phrase to match")
+    phrase_parser.add_argument(
+        "--window",
+        type=int,
+        help="Match the words in any order within this many consecutive words",
+    )
+
+    subparsers.add_parser(
+        "memory", help="Compare memory of the compact index with dict-based postings"
+    )
+
+    bench_tokenizer_parser = subparsers.add_parser(
+        "bench_tokenizer", help="Measure tokenizer throughput before and after caching"
+    )
+    bench_tokenizer_parser.add_argument(
+        "--limit", type=int, help="Number of movies to tokenize (default=all)"
+    )
 
     args = parser.parse_args()
 
     match args.command:
         case "build":
             print("Building inverted index...")
-            build_command()
+            build_command(args.workers, args.batch_size, args.positions)
             print("Inverted index built successfully.")
+        case "sync":
+            changes = sync_command(args.workers)
+            print(
+                f"Added {changes['added']}, updated {changes['updated']}, "
+                f"deleted {changes['deleted']} documents."
+            )
+        case "delete":
+            delete_command(args.doc_ids)
+            print(f"Deleted {len(args.doc_ids)} documents.")
+        case "merge":
+            merge_command()
+            print("Index segments merged successfully.")
+        case "segments":
+            for segment in segments_command():
+                print(
+                    f"{segment['name']}: {segment['documents']} documents "
+                    f"({segment['deleted']} deleted), {segment['terms']} terms"
+                )
         case "search":
             print("Searching for:", args.query)
             results = search_command(args.query)
@@ -98,9 +201,46 @@ def main() -> None:
             )
         case "bm25search":
             print("Searching for:", args.query)
-            results = bm25search_command(args.query)
+            results = bm25search_command(args.query, proximity=args.proximity)
             for i, res in enumerate(results, 1):
                 print(f"{i}. ({res['id']}) {res['title']} - Score: {res['score']:.2f}")
+        case "bm25batch":
+            with open(args.queries_file, "r") as f:
+                queries = [line.strip() for line in f if line.strip()]
+            batch = bm25_batch_command(queries, args.limit, args.compare)
+            for query, results in zip(queries, batch["results"]):
+                print(f"Query: {query}")
+                for i, res in enumerate(results, 1):
+                    print(
+                        f"  {i}. ({res['id']}) {res['title']} - Score: {res['score']:.2f}"
+                    )
+            print(f"Batch: {len(queries)} queries in {batch['batch_seconds']:.3f}s")
+            if batch["loop_seconds"] is not None:
+                print(f"One at a time: {batch['loop_seconds']:.3f}s")
+        case "phrase":
+            print("Searching for phrase:", args.phrase)
+            results = phrase_command(args.phrase, args.window)
+            for i, res in enumerate(results, 1):
+                print(f"{i}. ({res['id']}) {res['title']} - Score: {res['score']:.2f}")
+        case "memory":
+            stats = index_memory_command()
+            print(
+                f"{stats['documents']} documents in {stats['segments']} segments, "
+                f"{stats['terms']} terms, {stats['postings']} postings"
+            )
+            print(f"Dict-based postings: {stats['legacy_bytes'] / 1024 / 1024:.2f} MiB")
+            print(f"Compact index:       {stats['compact_bytes'] / 1024 / 1024:.2f} MiB")
+            if stats["compact_bytes"]:
+                print(
+                    f"Reduction:           "
+                    f"{stats['legacy_bytes'] / stats['compact_bytes']:.1f}x"
+                )
+        case "bench_tokenizer":
+            stats = tokenizer_benchmark_command(args.limit)
+            print(f"Tokenized {stats['documents']} documents ({stats['tokens']} tokens)")
+            print(f"Per-call pipeline: {stats['uncached_tokens_per_second']:,.0f} tokens/sec")
+            print(f"Cached analyzer:   {stats['analyzer_tokens_per_second']:,.0f} tokens/sec")
+            print(f"Stem cache hit rate: {stats['stem_cache_hit_rate']:.1%}")
         case _:
             parser.exit(2, parser.format_help())
 
@@ -0,0 +1,454 @@
+import heapq
+import math
+from typing import Optional
+
+import numpy as np
+
+from .index_store import load_arrays, save_arrays
+from .postings import gather_slices
+from .search_utils import (
+    HNSW_EF_CONSTRUCTION,
+    HNSW_EF_SEARCH,
+    HNSW_M,
+    INGEST_BATCH_SIZE,
+    IVF_LISTS,
+    IVF_PROBES,
+    IVF_TRAIN_SAMPLE,
+    IVFPQ_RERANK,
+    PQ_CENTROIDS,
+    PQ_SUBVECTORS,
+)
+from .vectors import kmeans, nearest_centroids, normalize_embeddings, top_k_indices
+
+ANN_FORMAT = "hnsw-index"
+ANN_FORMAT_VERSION = 1
+IVFPQ_FORMAT = "ivfpq-index"
+IVFPQ_FORMAT_VERSION = 1
+
+
+class HNSWIndex:
+    """Hierarchical navigable small world graph over unit-length vectors.
+
+    Similarity is the dot product, so the vectors must already be
+    L2-normalized. Only the graph is stored; the vectors are the caller's
+    embedding matrix. Each layer above 0 holds a sorted array of its nodes
+    and a row of neighbor ids per node, padded with -1. Layer 0 has a row
+    for every vector.
+    """
+
+    def __init__(
+            self,
+            vectors: np.ndarray,
+            m: int = HNSW_M,
+            ef_construction: int = HNSW_EF_CONSTRUCTION,
+            ef_search: int = HNSW_EF_SEARCH,
+    ) -> None:
+        self.vectors = vectors
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.entry_point = -1
+        self.max_level = -1
+        self.level_nodes: list[np.ndarray] = []
+        self.links: list[np.ndarray] = []
+        self.__visited = np.zeros(len(vectors), dtype=np.int32)
+        self.__visit_mark = 0
+
+    @classmethod
+    def build(
+            cls,
+            vectors: np.ndarray,
+            m: int = HNSW_M,
+            ef_construction: int = HNSW_EF_CONSTRUCTION,
+            ef_search: int = HNSW_EF_SEARCH,
+            seed: int = 0,
+    ) -> "HNSWIndex":
+        index = cls(vectors, m, ef_construction, ef_search)
+        rng = np.random.default_rng(seed)
+        levels = np.floor(
+            -np.log(1.0 - rng.random(len(vectors))) / math.log(m)
+        ).astype(np.int64)
+        top_level = int(levels.max()) if len(levels) else -1
+        index.level_nodes = [
+            np.arange(len(vectors)) if level == 0 else np.flatnonzero(levels >= level)
+            for level in range(top_level + 1)
+        ]
+        index.links = [
+            np.full((len(nodes), index.max_links(level)), -1, dtype=np.int32)
+            for level, nodes in enumerate(index.level_nodes)
+        ]
+        for node, level in enumerate(levels.tolist()):
+            index.__insert(node, level)
+        return index
+
+    def max_links(self, level: int) -> int:
+        return 2 * self.m if level == 0 else self.m
+
+    def neighbors(self, node: int, level: int) -> np.ndarray:
+        row = node if level == 0 else np.searchsorted(self.level_nodes[level], node)
+        links = self.links[level][row]
+        return links[links >= 0]
+
+    def search(
+            self, query: np.ndarray, limit: int, ef: Optional[int] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Approximate top `limit` vectors by dot product, best first.
+
+        A larger `ef` keeps more candidates during the layer 0 search, which
+        raises recall at the cost of latency. It never drops below `limit`.
+        """
+        if self.entry_point < 0 or limit <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        entry = self.__descend(query, self.entry_point, self.max_level, 0)
+        found = self.__search_layer(
+            query, [entry], max(ef or self.ef_search, limit), 0
+        )[:limit]
+        ids = np.array([node for _, node in found], dtype=np.int64)
+        scores = np.array([score for score, _ in found], dtype=np.float32)
+        return ids, scores
+
+    def save(self, directory: str, **manifest) -> None:
+        arrays = {"entry": np.array([self.entry_point], dtype=np.int64)}
+        for level, (nodes, links) in enumerate(zip(self.level_nodes, self.links)):
+            if level:
+                arrays[f"nodes_{level}"] = nodes
+            arrays[f"links_{level}"] = links
+        save_arrays(
+            directory,
+            {
+                "format": ANN_FORMAT,
+                "version": ANN_FORMAT_VERSION,
+                "m": self.m,
+                "ef_construction": self.ef_construction,
+                "levels": len(self.links),
+                "vector_count": len(self.vectors),
+                **manifest,
+            },
+            arrays,
+        )
+
+    @classmethod
+    def load(
+            cls, directory: str, vectors: np.ndarray, ef_search: int = HNSW_EF_SEARCH
+    ) -> tuple["HNSWIndex", dict]:
+        manifest, arrays = load_arrays(directory, ANN_FORMAT, ANN_FORMAT_VERSION)
+        if manifest["vector_count"] != len(vectors):
+            raise ValueError(
+                f"{directory} indexes {manifest['vector_count']} vectors, "
+                f"got {len(vectors)}; rebuild it"
+            )
+        index = cls(vectors, manifest["m"], manifest["ef_construction"], ef_search)
+        index.links = [arrays[f"links_{level}"] for level in range(manifest["levels"])]
+        index.level_nodes = [np.arange(len(vectors))] + [
+            arrays[f"nodes_{level}"] for level in range(1, manifest["levels"])
+        ]
+        index.entry_point = int(arrays["entry"][0])
+        index.max_level = len(index.links) - 1
+        return index, manifest
+
+    def __insert(self, node: int, level: int) -> None:
+        if self.entry_point < 0:
+            self.entry_point, self.max_level = node, level
+            return
+        query = self.vectors[node]
+        entry = self.__descend(query, self.entry_point, self.max_level, level + 1)
+        entries = [entry]
+        for layer in range(min(level, self.max_level), -1, -1):
+            found = self.__search_layer(query, entries, self.ef_construction, layer)
+            candidates = np.array([other for _, other in found], dtype=np.int64)
+            selected = self.__select_neighbors(
+                candidates, np.array([score for score, _ in found]), self.m
+            )
+            self.__set_links(node, layer, selected)
+            for neighbor in selected.tolist():
+                self.__link(neighbor, node, layer)
+            entries = candidates.tolist()
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+
+    def __descend(
+            self, query: np.ndarray, entry: int, from_level: int, to_level: int
+    ) -> int:
+        """Greedy walk towards `query` from `from_level` down to `to_level`."""
+        score = float(self.vectors[entry] @ query)
+        for level in range(from_level, to_level - 1, -1):
+            improved = True
+            while improved:
+                improved = False
+                neighbors = self.neighbors(entry, level)
+                if len(neighbors) == 0:
+                    break
+                scores = self.vectors[neighbors] @ query
+                best = int(np.argmax(scores))
+                if scores[best] > score:
+                    entry, score = int(neighbors[best]), float(scores[best])
+                    improved = True
+        return entry
+
+    def __search_layer(
+            self, query: np.ndarray, entries: list[int], ef: int, level: int
+    ) -> list[tuple[float, int]]:
+        """Best-first search of one layer, returning up to `ef` (score, node)."""
+        self.__visit_mark += 1
+        visited, mark = self.__visited, self.__visit_mark
+        entry_ids = np.array(entries, dtype=np.int64)
+        visited[entry_ids] = mark
+        entry_scores = (self.vectors[entry_ids] @ query).tolist()
+        candidates = [(-score, node) for score, node in zip(entry_scores, entries)]
+        heapq.heapify(candidates)
+        results = [(score, node) for score, node in zip(entry_scores, entries)]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            negative_score, node = heapq.heappop(candidates)
+            if -negative_score < results[0][0] and len(results) >= ef:
+                break
+            neighbors = self.neighbors(node, level)
+            neighbors = neighbors[visited[neighbors] != mark]
+            if len(neighbors) == 0:
+                continue
+            visited[neighbors] = mark
+            scores = self.vectors[neighbors] @ query
+            if len(results) >= ef:
+                better = scores > results[0][0]
+                scores, neighbors = scores[better], neighbors[better]
+            for score, neighbor in zip(scores.tolist(), neighbors.tolist()):
+                if len(results) < ef or score > results[0][0]:
+                    heapq.heappush(candidates, (-score, neighbor))
+                    heapq.heappush(results, (score, neighbor))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted(results, reverse=True)
+
+    def __select_neighbors(
+            self, candidates: np.ndarray, scores: np.ndarray, limit: int
+    ) -> np.ndarray:
+        """Diverse neighbors by the HNSW heuristic, topped up with the closest.
+
+        Candidates are taken in order of similarity and kept only if they are
+        closer to the base node than to every neighbor kept so far.
+        """
+        if len(candidates) <= limit:
+            return candidates
+        order = np.argsort(-scores, kind="stable")
+        candidates, scores = candidates[order], scores[order]
+        vectors = self.vectors[candidates]
+        gram = vectors @ vectors.T
+        closest_selected = np.full(len(candidates), -np.inf, dtype=gram.dtype)
+        selected = []
+        for i, score in enumerate(scores.tolist()):
+            if score > closest_selected[i]:
+                selected.append(i)
+                if len(selected) == limit:
+                    break
+                np.maximum(closest_selected, gram[i], out=closest_selected)
+        if len(selected) < limit:
+            pruned = np.setdiff1d(np.arange(len(candidates)), selected)
+            selected.extend(pruned[: limit - len(selected)].tolist())
+        return candidates[np.array(selected)]
+
+    def __set_links(self, node: int, level: int, neighbors: np.ndarray) -> None:
+        row = node if level == 0 else np.searchsorted(self.level_nodes[level], node)
+        self.links[level][row] = -1
+        self.links[level][row, : len(neighbors)] = neighbors
+
+    def __link(self, node: int, neighbor: int, level: int) -> None:
+        links = self.neighbors(node, level)
+        if len(links) < self.max_links(level):
+            self.__set_links(node, level, np.append(links, neighbor))
+            return
+        candidates = np.append(links, neighbor)
+        scores = self.vectors[candidates] @ self.vectors[node]
+        self.__set_links(
+            node,
+            level,
+            self.__select_neighbors(candidates, scores, self.max_links(level)),
+        )
+
+
+class IVFPQIndex:
+    """Inverted file of k-means lists with product-quantized residual codes.
+
+    Every vector is stored as its list plus one byte per subvector: the
+    nearest of PQ_CENTROIDS codewords for that slice of its residual from
+    the list centroid. Because similarity is a dot product, a query scores a
+    code as `query @ centroid` plus one lookup table entry per subvector, the
+    same tables for every list. `vectors`, usually the memory-mapped
+    embeddings file, is only read to re-rank a shortlist exactly.
+    """
+
+    def __init__(
+            self,
+            centroids: np.ndarray,
+            codebooks: np.ndarray,
+            list_offsets: np.ndarray,
+            list_ids: np.ndarray,
+            codes: np.ndarray,
+            vectors: Optional[np.ndarray] = None,
+            nprobe: int = IVF_PROBES,
+            rerank: int = IVFPQ_RERANK,
+    ) -> None:
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.codes = codes
+        self.vectors = vectors
+        self.nprobe = nprobe
+        self.rerank = rerank
+
+    @classmethod
+    def build(
+            cls,
+            vectors: np.ndarray,
+            lists: int = IVF_LISTS,
+            subvectors: Optional[int] = None,
+            train_size: int = IVF_TRAIN_SAMPLE,
+            batch_size: int = INGEST_BATCH_SIZE,
+            seed: int = 0,
+    ) -> "IVFPQIndex":
+        """Train on a sample of `vectors`, then encode them batch by batch.
+
+        Rows are L2-normalized as they are read, so `vectors` can be the raw
+        memory-mapped embeddings file. `subvectors` defaults to
+        `default_subvectors` of the dimension.
+        """
+        vector_count, dimensions = vectors.shape
+        if subvectors is None:
+            subvectors = default_subvectors(dimensions)
+        if subvectors <= 0 or dimensions % subvectors:
+            raise ValueError(
+                f"{dimensions} dimensions do not split into {subvectors} "
+                f"subvectors; use a divisor of {dimensions}"
+            )
+        rng = np.random.default_rng(seed)
+        sample_ids = rng.choice(vector_count, min(train_size, vector_count), False)
+        sample = normalize_embeddings(vectors[np.sort(sample_ids)])
+        centroids = kmeans(sample, lists, seed=seed)
+        residuals = sample - centroids[nearest_centroids(sample, centroids)]
+        codebooks = np.stack(
+            [
+                kmeans(part, PQ_CENTROIDS, seed=seed + i)
+                for i, part in enumerate(np.split(residuals, subvectors, axis=1))
+            ]
+        )
+
+        labels = np.empty(vector_count, dtype=np.int64)
+        codes = np.empty((vector_count, subvectors), dtype=np.uint8)
+        for start in range(0, vector_count, batch_size):
+            batch = normalize_embeddings(vectors[start : start + batch_size])
+            end = start + len(batch)
+            labels[start:end] = nearest_centroids(batch, centroids)
+            residuals = batch - centroids[labels[start:end]]
+            for i, part in enumerate(np.split(residuals, subvectors, axis=1)):
+                codes[start:end, i] = nearest_centroids(part, codebooks[i])
+
+        order = np.argsort(labels, kind="stable")
+        list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=len(centroids)), out=list_offsets[1:])
+        id_dtype = np.int32 if vector_count <= np.iinfo(np.int32).max else np.int64
+        return cls(
+            centroids,
+            codebooks,
+            list_offsets,
+            order.astype(id_dtype),
+            codes[order],
+            vectors,
+        )
+
+    @property
+    def code_bytes_per_vector(self) -> float:
+        """Bytes each vector costs in memory: its PQ code and its id."""
+        return self.codes.shape[1] + self.list_ids.itemsize
+
+    @property
+    def nbytes(self) -> int:
+        return (
+                self.centroids.nbytes
+                + self.codebooks.nbytes
+                + self.list_offsets.nbytes
+                + self.list_ids.nbytes
+                + self.codes.nbytes
+        )
+
+    def search(
+            self,
+            query: np.ndarray,
+            limit: int,
+            nprobe: Optional[int] = None,
+            rerank: Optional[int] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Approximate top `limit` vectors by dot product, best first.
+
+        Only the `nprobe` lists whose centroids score highest are scanned.
+        With `rerank`, that many of the best approximate hits are re-scored
+        exactly against `vectors`, read in id order.
+        """
+        nprobe = nprobe or self.nprobe
+        rerank = self.rerank if rerank is None else rerank
+        coarse_scores = self.centroids @ query
+        probes = top_k_indices(coarse_scores, nprobe)
+        starts, ends = self.list_offsets[probes], self.list_offsets[probes + 1]
+        ids = gather_slices(self.list_ids, starts, ends)
+        codes = gather_slices(self.codes, starts, ends)
+        tables = np.einsum(
+            "skd,sd->sk", self.codebooks, query.reshape(len(self.codebooks), -1)
+        )
+        scores = np.repeat(coarse_scores[probes], ends - starts)
+        scores += tables[np.arange(len(tables)), codes].sum(axis=1)
+
+        if rerank and self.vectors is not None:
+            ids = np.sort(ids[top_k_indices(scores, max(limit, rerank))])
+            scores = normalize_embeddings(self.vectors[ids]) @ query
+        top = top_k_indices(scores, limit)
+        return ids[top].astype(np.int64), scores[top].astype(np.float32)
+
+    def save(self, directory: str, **manifest) -> None:
+        save_arrays(
+            directory,
+            {
+                "format": IVFPQ_FORMAT,
+                "version": IVFPQ_FORMAT_VERSION,
+                "lists": len(self.centroids),
+                "subvectors": len(self.codebooks),
+                "vector_count": len(self.list_ids),
+                **manifest,
+            },
+            {
+                "centroids": self.centroids,
+                "codebooks": self.codebooks,
+                "list_offsets": self.list_offsets,
+                "list_ids": self.list_ids,
+                "codes": self.codes,
+            },
+        )
+
+    @classmethod
+    def load(
+            cls,
+            directory: str,
+            vectors: Optional[np.ndarray] = None,
+            nprobe: int = IVF_PROBES,
+            rerank: int = IVFPQ_RERANK,
+    ) -> tuple["IVFPQIndex", dict]:
+        manifest, arrays = load_arrays(directory, IVFPQ_FORMAT, IVFPQ_FORMAT_VERSION)
+        index = cls(
+            arrays["centroids"],
+            arrays["codebooks"],
+            arrays["list_offsets"],
+            arrays["list_ids"],
+            arrays["codes"],
+            vectors,
+            nprobe,
+            rerank,
+        )
+        return index, manifest
+
+
+def default_subvectors(dimensions: int) -> int:
+    """Largest number of PQ subvectors, up to PQ_SUBVECTORS, dividing `dimensions`."""
+    return max(
+        n for n in range(1, min(dimensions, PQ_SUBVECTORS) + 1) if dimensions % n == 0
+    )
@@ -0,0 +1,166 @@
+import os
+import time
+from collections.abc import Iterable
+from itertools import product
+from typing import Any, Optional
+
+import numpy as np
+
+from .index_store import current_manifest, write_json_atomic
+from .model_artifacts import ModelArtifacts
+from .vectors import normalize_embeddings
+
+ENCODE_SETTINGS_FORMAT = "encode-settings"
+ENCODE_SETTINGS_FORMAT_VERSION = 1
+ENCODE_SETTINGS_FILE = "encode_settings.json"
+
+
+def load_encode_settings(model_name: str) -> Optional[dict]:
+    """The tuned encode settings saved for `model_name`, if any."""
+    return current_manifest(
+        ModelArtifacts(model_name).directory,
+        ENCODE_SETTINGS_FORMAT,
+        ENCODE_SETTINGS_FORMAT_VERSION,
+        ENCODE_SETTINGS_FILE,
+    )
+
+
+def save_encode_settings(model_name: str, settings: dict) -> None:
+    artifacts = ModelArtifacts(model_name)
+    os.makedirs(artifacts.directory, exist_ok=True)
+    write_json_atomic(
+        artifacts.path(ENCODE_SETTINGS_FILE),
+        {
+            "format": ENCODE_SETTINGS_FORMAT,
+            "version": ENCODE_SETTINGS_FORMAT_VERSION,
+            "model": model_name,
+            **settings,
+        },
+    )
+
+
+def encode_settings(model_name: str) -> dict:
+    """The saved tuning of `model_name` as options for `encode_with_settings`.
+
+    Empty if the model was never tuned.
+    """
+    settings = load_encode_settings(model_name)
+    if settings is None:
+        return {}
+    return {
+        "batch_size": settings["batch_size"],
+        "threads": settings["threads"],
+        "max_seq_length": settings["max_seq_length"],
+    }
+
+
+def encode_with_settings(
+        model: Any, texts: list[str], encode_options: Optional[dict], **kwargs
+) -> np.ndarray:
+    """`model.encode(texts)` with options from `encode_settings`.
+
+    The sequence length and thread count are set for this call only and
+    restored afterwards, so the shared model keeps its own truncation for
+    everything else, such as query encoding.
+    """
+    if not encode_options:
+        return np.asarray(model.encode(texts, **kwargs))
+    original_length, original_threads = model.max_seq_length, get_threads()
+    model.max_seq_length = encode_options["max_seq_length"]
+    set_threads(min(encode_options["threads"], os.cpu_count() or 1))
+    try:
+        return np.asarray(
+            model.encode(texts, batch_size=encode_options["batch_size"], **kwargs)
+        )
+    finally:
+        model.max_seq_length = original_length
+        set_threads(original_threads)
+
+
+def set_threads(threads: int) -> None:
+    import torch
+
+    torch.set_num_threads(threads)
+
+
+def get_threads() -> int:
+    import torch
+
+    return torch.get_num_threads()
+
+
+def token_lengths(model: Any, texts: list[str]) -> np.ndarray:
+    return np.array([len(ids) for ids in model.tokenizer(texts)["input_ids"]])
+
+
+def sequence_length_candidates(model: Any, texts: list[str]) -> list[int]:
+    """The model's own limit plus the 50th/90th/99th percentile token length.
+
+    Percentiles are rounded up to a multiple of 16 and kept only below the
+    model's limit, since longer sequences are truncated there anyway.
+    """
+    limit = model.max_seq_length
+    percentiles = np.percentile(token_lengths(model, texts), [50, 90, 99])
+    rounded = (np.ceil(percentiles / 16) * 16).astype(int)
+    return sorted({limit, *(int(n) for n in rounded if 0 < n < limit)})
+
+
+def thread_candidates() -> list[int]:
+    cores = os.cpu_count() or 1
+    return sorted({1, max(cores // 2, 1), cores})
+
+
+def autotune(
+        model: Any,
+        texts: list[str],
+        batch_sizes: Iterable[int],
+        thread_counts: Iterable[int],
+        sequence_lengths: Iterable[int],
+        min_similarity: float,
+) -> tuple[Optional[dict], list[dict]]:
+    """Time `model.encode` over `texts` for every combination of the knobs.
+
+    A shorter sequence length truncates long texts and so changes their
+    embeddings. Every embedding is compared with the one encoded at the
+    model's own limit, and a combination is eligible only if no text's
+    cosine similarity drops below `min_similarity`. Returns the fastest
+    eligible combination and all measurements. The model's sequence length
+    and the thread count are restored afterwards.
+    """
+    original_length, original_threads = model.max_seq_length, get_threads()
+    reference = normalize_embeddings(
+        np.asarray(model.encode(texts, show_progress_bar=False))
+    )
+    points = []
+    try:
+        for length, threads, batch_size in product(
+                sequence_lengths, thread_counts, batch_sizes
+        ):
+            model.max_seq_length = length
+            set_threads(threads)
+            model.encode(
+                texts[:batch_size], batch_size=batch_size, show_progress_bar=False
+            )
+            start = time.perf_counter()
+            embeddings = np.asarray(
+                model.encode(texts, batch_size=batch_size, show_progress_bar=False)
+            )
+            seconds = time.perf_counter() - start
+            similarities = np.sum(normalize_embeddings(embeddings) * reference, axis=1)
+            points.append(
+                {
+                    "batch_size": batch_size,
+                    "threads": threads,
+                    "max_seq_length": length,
+                    "texts_per_second": len(texts) / seconds,
+                    "min_similarity": float(similarities.min()),
+                    "eligible": bool(similarities.min() >= min_similarity),
+                }
+            )
+    finally:
+        model.max_seq_length = original_length
+        set_threads(original_threads)
+
+    eligible = [point for point in points if point["eligible"]]
+    best = max(eligible, key=lambda p: p["texts_per_second"], default=None)
+    return best, points
@@ -0,0 +1,273 @@
+import hashlib
+import os
+import shutil
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+from .index_store import RowFile, current_manifest, write_json_atomic
+from .near_duplicates import DuplicateIndex
+
+CHUNK_BUILD_FORMAT = "chunk-embedding-build"
+CHUNK_BUILD_FORMAT_VERSION = 4
+CHUNK_BUILD_FILE = "progress.json"
+CHUNK_METADATA_DTYPE = np.dtype(
+    [
+        ("movie_idx", "<i4"),
+        ("chunk_idx", "<i4"),
+        ("total_chunks", "<i4"),
+        ("vector_idx", "<i4"),
+        ("canonical_movie", "<i4"),
+    ]
+)
+
+
+def ordered_pool_map(
+        function: Callable, items: Iterable, workers: int
+) -> Iterator:
+    """`map(function, items)` run in `workers` processes, results in order.
+
+    At most two tasks per worker are queued ahead of the consumer, so
+    `items` is read lazily and never piles up in memory.
+    """
+    if workers <= 1:
+        yield from map(function, items)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        queued = deque()
+        for item in items:
+            queued.append(executor.submit(function, item))
+            if len(queued) >= 2 * workers:
+                yield queued.popleft().result()
+        while queued:
+            yield queued.popleft().result()
+
+
+class ChunkBuild:
+    """Chunk embeddings and metadata of a build in progress, resumable by movie.
+
+    Embeddings, chunk metadata records (CHUNK_METADATA_DTYPE) and the
+    description key of every completed movie are appended to raw files in
+    `directory`. After each batch, progress.json records how many movies
+    are complete and how many chunk rows they own. A later build with the
+    same model, sequence length and chunking picks up from there:
+    completed movies whose keys still match are skipped, and the first one
+    that changed rewinds the build to it.
+
+    Near-duplicate chunks share one stored vector, which `vector_idx`
+    points at, and near-duplicate movies point at the first of their kind
+    through `canonical_movie`. Both are found through DuplicateIndexes kept
+    on disk alongside, so a resumed build still finds duplicates of what
+    came before without holding every signature in memory.
+    """
+
+    def __init__(
+            self,
+            directory: str,
+            model_name: str,
+            chunking: str,
+            digest: "hashlib._Hash",
+            max_seq_length: Optional[int] = None,
+    ) -> None:
+        """`max_seq_length` is the tuned sequence length chunks are encoded
+        at, None for the model's own.
+        """
+        self.directory = directory
+        self.model_name = model_name
+        self.chunking = chunking
+        self.digest = digest
+        self.max_seq_length = max_seq_length
+        manifest = current_manifest(
+            directory, CHUNK_BUILD_FORMAT, CHUNK_BUILD_FORMAT_VERSION, CHUNK_BUILD_FILE
+        )
+        if manifest is None or (
+                manifest["model"] != model_name
+                or manifest["chunking"] != chunking
+                or manifest.get("max_seq_length") != max_seq_length
+        ):
+            shutil.rmtree(directory, ignore_errors=True)
+            manifest = {"movies": 0, "chunks": 0, "dimensions": None}
+        os.makedirs(directory, exist_ok=True)
+        self.movies = manifest["movies"]
+        self.chunks = manifest["chunks"]
+        self.vectors = 0
+        # Vectors used by committed chunks.
+        self.committed_vectors = 0
+        self.movie_keys = RowFile(self.__path("movie_keys"), np.uint64)
+        self.chunk_rows = RowFile(self.__path("chunks"), CHUNK_METADATA_DTYPE)
+        self.embeddings = None
+        if manifest["dimensions"] is not None:
+            self.__open_embeddings(manifest["dimensions"])
+        # Representatives are keyed by movie ordinal and by vector id.
+        self.movie_duplicates = DuplicateIndex(
+            os.path.join(directory, "movie_duplicates")
+        )
+        self.vector_duplicates = DuplicateIndex(
+            os.path.join(directory, "vector_duplicates")
+        )
+        # Movies handed to `add` whose chunks are not all written yet.
+        self.queued_keys = np.empty(0, dtype=np.uint64)
+        self.queued_counts = np.empty(0, dtype=np.int64)
+        self.queued_written = 0
+        self.rewind(self.movies)
+
+    @property
+    def dimensions(self) -> Optional[int]:
+        return self.embeddings.row_shape[0] if self.embeddings is not None else None
+
+    def pending(
+            self, movies: Iterable[tuple[int, str]]
+    ) -> Iterator[tuple[int, int, str]]:
+        """(ordinal, key, description) of every movie that still needs chunks.
+
+        `movies` yields (key, description) in order. Completed movies with
+        an unchanged key are skipped.
+        """
+        completed = np.array(self.movie_keys.read())
+        count = 0
+        for ordinal, (key, description) in enumerate(movies):
+            count += 1
+            if ordinal < self.movies:
+                if completed[ordinal] == key:
+                    self.digest.update(int(key).to_bytes(8, "little"))
+                    continue
+                self.rewind(ordinal)
+            yield ordinal, key, description
+        if count < self.movies:
+            self.rewind(count)
+
+    def rewind(self, movies: int) -> None:
+        """Drop everything after the first `movies` completed movies.
+
+        Vector ids are handed out in chunk order, so the vectors the kept
+        chunks use are exactly the ones up to the largest id among them.
+        """
+        chunk_rows = np.array(self.chunk_rows.read()[: self.chunks])
+        self.chunks = int(np.searchsorted(chunk_rows["movie_idx"], movies))
+        vector_ids = chunk_rows["vector_idx"][: self.chunks]
+        self.vectors = int(vector_ids.max()) + 1 if self.chunks else 0
+        self.committed_vectors = self.vectors
+        self.movies = min(self.movies, movies)
+        self.movie_keys.truncate(self.movies)
+        self.chunk_rows.truncate(self.chunks)
+        if self.embeddings is not None:
+            self.embeddings.truncate(self.vectors)
+        self.movie_duplicates.rewind(self.movies)
+        self.vector_duplicates.rewind(self.vectors)
+        self.__save_progress()
+
+    def add(
+            self, keys: np.ndarray, counts: np.ndarray, signatures: np.ndarray
+    ) -> np.ndarray:
+        """Queue movies whose chunks, `counts[i]` each, are about to be appended.
+
+        Returns the ordinal of the first near-duplicate of every movie, which
+        is its own ordinal if it is the first of its kind.
+        """
+        first_ordinal = self.movies + len(self.queued_keys)
+        canonical, _ = self.movie_duplicates.add(
+            signatures, np.arange(first_ordinal, first_ordinal + len(keys))
+        )
+        self.queued_keys = np.concatenate([self.queued_keys, keys])
+        self.queued_counts = np.concatenate([self.queued_counts, counts])
+        return canonical.astype(np.int32)
+
+    def assign_vectors(self, signatures: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Vector id of every chunk about to be appended, and which need encoding.
+
+        A chunk that is a near-duplicate of a stored or earlier chunk reuses
+        its vector; every other chunk gets the next new id.
+        """
+        return self.vector_duplicates.add(signatures)
+
+    def append(self, embeddings: np.ndarray, chunk_rows: np.ndarray) -> None:
+        """Write one batch of chunks, then commit the movies it completes.
+
+        `embeddings` holds only the new vectors, in the order of their ids.
+        """
+        if len(embeddings):
+            if self.embeddings is None:
+                self.__open_embeddings(embeddings.shape[1])
+            self.embeddings.append(embeddings)
+            self.vectors += len(embeddings)
+        self.chunk_rows.append(chunk_rows)
+        self.queued_written += len(chunk_rows)
+        self.commit()
+
+    def commit(self) -> None:
+        ends = np.cumsum(self.queued_counts)
+        completed = int(np.searchsorted(ends, self.queued_written, side="right"))
+        if completed == 0:
+            return
+        keys = self.queued_keys[:completed]
+        chunks = int(ends[completed - 1])
+        for file in self.__files():
+            file.sync()
+        self.movie_duplicates.sync()
+        self.vector_duplicates.sync()
+        self.movie_keys.append(keys)
+        self.movie_keys.sync()
+        self.digest.update(keys.astype("<u8").tobytes())
+        committed_rows = self.chunk_rows.read()[self.chunks : self.chunks + chunks]
+        if len(committed_rows):
+            self.committed_vectors = max(
+                self.committed_vectors, int(committed_rows["vector_idx"].max()) + 1
+            )
+        self.movies += completed
+        self.chunks += chunks
+        self.queued_keys = self.queued_keys[completed:]
+        self.queued_counts = self.queued_counts[completed:]
+        self.queued_written -= chunks
+        self.__save_progress()
+        self.movie_duplicates.commit(self.movies)
+        self.vector_duplicates.commit(self.committed_vectors)
+
+    def finish(self, embeddings_path: str, metadata_path: str) -> np.ndarray:
+        """Write the finished build out as .npy files and remove the build."""
+        self.commit()
+        if self.embeddings is None:
+            np.save(embeddings_path, np.empty((0, 0), dtype=np.float32))
+            embeddings = np.load(embeddings_path, mmap_mode="r")
+        else:
+            embeddings = self.embeddings.save_npy(embeddings_path)
+
+        self.chunk_rows.save_npy(metadata_path)
+
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        return embeddings
+
+    def close(self) -> None:
+        """Close the build's files; rows after the last commit are dropped on resume."""
+        for file in self.__files():
+            file.close()
+        self.movie_duplicates.close()
+        self.vector_duplicates.close()
+
+    def __open_embeddings(self, dimensions: int) -> None:
+        self.embeddings = RowFile(self.__path("embeddings"), np.float32, (dimensions,))
+
+    def __files(self) -> list[RowFile]:
+        files = [self.movie_keys, self.chunk_rows]
+        return files + [self.embeddings] if self.embeddings is not None else files
+
+    def __path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.rows")
+
+    def __save_progress(self) -> None:
+        write_json_atomic(
+            os.path.join(self.directory, CHUNK_BUILD_FILE),
+            {
+                "format": CHUNK_BUILD_FORMAT,
+                "version": CHUNK_BUILD_FORMAT_VERSION,
+                "model": self.model_name,
+                "max_seq_length": self.max_seq_length,
+                "chunking": self.chunking,
+                "movies": self.movies,
+                "chunks": self.chunks,
+                "dimensions": self.dimensions,
+            },
+        )
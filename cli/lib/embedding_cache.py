@@ -0,0 +1,441 @@
+import atexit
+import hashlib
+import os
+import shutil
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict, defaultdict
+from collections.abc import Callable, Iterable, Iterator
+from functools import lru_cache
+from itertools import batched
+from typing import Optional
+
+import numpy as np
+
+from .autotune import encode_with_settings
+from .index_store import (
+    current_manifest,
+    load_arrays,
+    save_array_batches,
+    save_arrays,
+    write_json_atomic,
+)
+from .model_artifacts import model_slug
+from .search_utils import (
+    EMBEDDING_STORE_DIR,
+    QUERY_CACHE_FLUSH_SIZE,
+    QUERY_CACHE_SIZE,
+    QUERY_CACHE_TTL,
+    QUERY_EMBEDDINGS_DIR,
+    SEGMENT_MERGE_FACTOR,
+    STORE_MERGE_BATCH_SIZE,
+)
+
+STORE_FORMAT = "embedding-store"
+STORE_FORMAT_VERSION = 1
+STORE_FILE = "store.json"
+STORE_SEGMENT_FORMAT = "embedding-store-segment"
+STORE_SEGMENT_FORMAT_VERSION = 1
+
+
+def embedding_key(
+        model_name: str, text: str, max_seq_length: Optional[int] = None
+) -> int:
+    """Hash of (model name, text), plus the tuned sequence length if any.
+
+    A text truncated at another length embeds differently, so vectors
+    encoded with tuned settings never share keys with untuned ones.
+    """
+    if max_seq_length is not None:
+        model_name = f"{model_name}\0{max_seq_length}"
+    encoded = f"{model_name}\0{text}".encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(encoded, digest_size=8).digest(), "little")
+
+
+class EmbeddingCache:
+    """Embeddings of one model keyed by a hash of (model name, input text).
+
+    Newly encoded vectors are appended as immutable segments of keys sorted
+    alongside their vectors, listed in store.json. Segments of similar size
+    are merged size-tiered, so every vector is rewritten about once per
+    tier rather than on every add once the store has grown.
+    """
+
+    def __init__(self, model_name: str, directory: Optional[str] = None) -> None:
+        self.model_name = model_name
+        self.directory = os.path.join(
+            directory or EMBEDDING_STORE_DIR, model_slug(model_name)
+        )
+        self.segments: list[tuple[str, np.ndarray, np.ndarray]] = []
+        self.__load()
+
+    def __len__(self) -> int:
+        return sum(len(keys) for _, keys, _ in self.segments)
+
+    def keys(
+            self, texts: list[str], encode_options: Optional[dict] = None
+    ) -> np.ndarray:
+        max_seq_length = (encode_options or {}).get("max_seq_length")
+        return np.fromiter(
+            (embedding_key(self.model_name, text, max_seq_length) for text in texts),
+            dtype=np.uint64,
+            count=len(texts),
+        )
+
+    def lookup(
+            self, keys: np.ndarray
+    ) -> tuple[np.ndarray, list[tuple[np.ndarray, np.ndarray]]]:
+        """Which keys are cached, plus (positions in `keys`, vectors) per segment."""
+        found = np.zeros(len(keys), dtype=bool)
+        rows: list[tuple[np.ndarray, np.ndarray]] = []
+        for _, segment_keys, vectors in reversed(self.segments):
+            pending = np.flatnonzero(~found)
+            if len(pending) == 0:
+                break
+            positions = np.searchsorted(segment_keys, keys[pending])
+            positions[positions == len(segment_keys)] = 0
+            hits = segment_keys[positions] == keys[pending]
+            if hits.any():
+                found[pending[hits]] = True
+                rows.append((pending[hits], vectors[positions[hits]]))
+        return found, rows
+
+    def encode(
+            self,
+            model,
+            texts: list[str],
+            keys: Optional[np.ndarray] = None,
+            encode_options: Optional[dict] = None,
+            show_progress_bar: bool = True,
+    ) -> np.ndarray:
+        """Embeddings of `texts`, encoding and storing only unseen texts.
+
+        `encode_options` come from `autotune.encode_settings` and are part of
+        the keys. Callers encoding batch by batch turn `show_progress_bar`
+        off so that a build does not print a bar per batch.
+        """
+        if not texts:
+            return np.asarray(model.encode([], show_progress_bar=False))
+        keys = self.keys(texts, encode_options) if keys is None else keys
+        found, rows = self.lookup(keys)
+        missing = np.flatnonzero(~found)
+        new_keys, first, inverse = np.unique(
+            keys[missing], return_index=True, return_inverse=True
+        )
+        new_vectors = None
+        if len(new_keys):
+            new_vectors = encode_with_settings(
+                model,
+                [texts[i] for i in missing[first]],
+                encode_options,
+                show_progress_bar=show_progress_bar,
+            )
+            self.add(new_keys, new_vectors)
+
+        sample = new_vectors if new_vectors is not None else rows[0][1]
+        embeddings = np.empty((len(texts), *sample.shape[1:]), dtype=sample.dtype)
+        for positions, vectors in rows:
+            embeddings[positions] = vectors
+        if new_vectors is not None:
+            embeddings[missing] = new_vectors[inverse]
+        return embeddings
+
+    def encode_batches(
+            self,
+            model,
+            texts: Iterable[str],
+            batch_size: int,
+            digest: Optional["hashlib._Hash"] = None,
+            encode_options: Optional[dict] = None,
+    ) -> Iterator[np.ndarray]:
+        """Embed a stream of texts batch by batch through the cache.
+
+        If given, `digest` is fed every key in order, which identifies the
+        exact inputs the resulting embeddings were made from.
+        """
+        for batch in batched(texts, batch_size):
+            batch = list(batch)
+            keys = self.keys(batch, encode_options)
+            if digest is not None:
+                digest.update(keys.tobytes())
+            yield self.encode(
+                model, batch, keys, encode_options, show_progress_bar=False
+            )
+
+    def add(self, keys: np.ndarray, vectors: np.ndarray) -> None:
+        order = np.argsort(keys, kind="stable")
+        name = _new_segment_name()
+        save_arrays(
+            os.path.join(self.directory, name),
+            self.__segment_manifest(),
+            {"keys": keys[order], "vectors": vectors[order]},
+        )
+        self.segments.append(self.__open_segment(name))
+        self.__save_manifest()
+        self.maybe_merge()
+
+    def maybe_merge(self) -> None:
+        """Merge segments of similar size until no size tier is full.
+
+        A segment's tier is its size's order of magnitude in base
+        SEGMENT_MERGE_FACTOR. A tier holding that many segments is merged
+        into one segment of the next tier.
+        """
+        while True:
+            tiers = defaultdict(list)
+            for segment in self.segments:
+                tiers[store_tier(len(segment[1]))].append(segment)
+            full = [
+                tier
+                for tier, segments in tiers.items()
+                if len(segments) >= SEGMENT_MERGE_FACTOR
+            ]
+            if not full:
+                return
+            self.merge(tiers[min(full)])
+
+    def merge(
+            self, segments: Optional[list[tuple[str, np.ndarray, np.ndarray]]] = None
+    ) -> None:
+        """Merge `segments` (default: all) into one, keeping the newest vector
+        per key.
+
+        The sorted keys of the segments are walked in step and written out
+        batch by batch, so memory stays bounded whatever the store's size.
+        The merged segment takes the place of the newest one it replaces.
+        """
+        if segments is None:
+            segments = self.segments
+        if len(segments) < 2:
+            return
+        names = {name for name, _, _ in segments}
+        newest_first = [
+            segment for segment in reversed(self.segments) if segment[0] in names
+        ]
+        name = _new_segment_name()
+        save_array_batches(
+            os.path.join(self.directory, name),
+            self.__segment_manifest(),
+            ["keys", "vectors"],
+            merge_sorted_segments(
+                [(keys, vectors) for _, keys, vectors in newest_first],
+                STORE_MERGE_BATCH_SIZE,
+            ),
+        )
+        merged = self.__open_segment(name)
+        kept = []
+        for segment in self.segments:
+            if segment[0] == newest_first[0][0]:
+                kept.append(merged)
+            elif segment[0] not in names:
+                kept.append(segment)
+        self.segments = kept
+        self.__save_manifest()
+        for old_name in names:
+            shutil.rmtree(os.path.join(self.directory, old_name), ignore_errors=True)
+
+    def __segment_manifest(self) -> dict:
+        return {
+            "format": STORE_SEGMENT_FORMAT,
+            "version": STORE_SEGMENT_FORMAT_VERSION,
+            "model": self.model_name,
+        }
+
+    def __open_segment(self, name: str) -> tuple[str, np.ndarray, np.ndarray]:
+        _, arrays = load_arrays(
+            os.path.join(self.directory, name),
+            STORE_SEGMENT_FORMAT,
+            STORE_SEGMENT_FORMAT_VERSION,
+        )
+        return name, arrays["keys"], arrays["vectors"]
+
+    def __save_manifest(self) -> None:
+        write_json_atomic(
+            os.path.join(self.directory, STORE_FILE),
+            {
+                "format": STORE_FORMAT,
+                "version": STORE_FORMAT_VERSION,
+                "model": self.model_name,
+                "segments": [name for name, _, _ in self.segments],
+            },
+        )
+
+    def __load(self) -> None:
+        manifest = current_manifest(
+            self.directory, STORE_FORMAT, STORE_FORMAT_VERSION, STORE_FILE
+        )
+        if manifest is None:
+            return
+        for name in manifest["segments"]:
+            self.segments.append(self.__open_segment(name))
+
+
+class QueryEmbeddingCache:
+    """LRU of query embeddings bounded by size and age, over an optional disk tier.
+
+    Queries are keyed by model and whitespace-normalized text. With a
+    `directory`, new embeddings are also written to an EmbeddingCache there,
+    in batches of QUERY_CACHE_FLUSH_SIZE and at exit, so they outlive the
+    process; the disk tier has no TTL since a model's output never changes.
+    """
+
+    def __init__(
+            self,
+            model_name: str,
+            max_size: int = QUERY_CACHE_SIZE,
+            ttl: float = QUERY_CACHE_TTL,
+            directory: Optional[str] = None,
+    ) -> None:
+        self.model_name = model_name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[int, tuple[float, np.ndarray]] = OrderedDict()
+        self.disk = EmbeddingCache(model_name, directory) if directory else None
+        self.pending: dict[int, np.ndarray] = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if self.disk is not None:
+            atexit.register(self.flush)
+
+    def get(self, text: str, encode: Callable[[list[str]], np.ndarray]) -> np.ndarray:
+        """Embedding of `text`; `encode` embeds a list of normalized queries."""
+        return self.__get([text], encode)[0]
+
+    def get_many(
+            self, texts: list[str], encode: Callable[[list[str]], np.ndarray]
+    ) -> np.ndarray:
+        """Embeddings of `texts`, with all misses encoded in one `encode` call."""
+        return np.stack(self.__get(texts, encode))
+
+    def flush(self) -> None:
+        """Write embeddings computed since the last flush to the disk tier."""
+        with self._lock:
+            self.__flush()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def __get(
+            self, texts: list[str], encode: Callable[[list[str]], np.ndarray]
+    ) -> list[np.ndarray]:
+        queries = [normalize_query(text) for text in texts]
+        keys = [embedding_key(self.model_name, query) for query in queries]
+        vectors: list[Optional[np.ndarray]] = [None] * len(texts)
+        now = time.monotonic()
+        with self._lock:
+            for i, key in enumerate(keys):
+                entry = self.entries.get(key)
+                if entry is not None and now - entry[0] <= self.ttl:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    vectors[i] = entry[1]
+            if self.disk is not None:
+                pending = [i for i, vector in enumerate(vectors) if vector is None]
+                found, rows = self.disk.lookup(
+                    np.array([keys[i] for i in pending], dtype=np.uint64)
+                )
+                for positions, disk_vectors in rows:
+                    for position, vector in zip(positions.tolist(), disk_vectors):
+                        i = pending[position]
+                        self.disk_hits += 1
+                        vectors[i] = self.__remember(keys[i], np.array(vector), now)
+
+        missing = {}
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[i], []).append(i)
+        if missing:
+            encoded = encode([queries[positions[0]] for positions in missing.values()])
+            with self._lock:
+                for (key, positions), vector in zip(missing.items(), encoded):
+                    self.misses += len(positions)
+                    vector = self.__remember(key, np.array(vector), now)
+                    if self.disk is not None:
+                        self.pending[key] = vector
+                    for i in positions:
+                        vectors[i] = vector
+                if len(self.pending) >= QUERY_CACHE_FLUSH_SIZE:
+                    self.__flush()
+        return vectors
+
+    def __remember(self, key: int, vector: np.ndarray, now: float) -> np.ndarray:
+        vector.flags.writeable = False
+        self.entries[key] = (now, vector)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return vector
+
+    def __flush(self) -> None:
+        if self.disk is None or not self.pending:
+            return
+        keys = np.fromiter(self.pending, dtype=np.uint64, count=len(self.pending))
+        self.disk.add(keys, np.stack(list(self.pending.values())))
+        self.pending = {}
+
+
+def store_tier(size: int) -> int:
+    """Size tier of a segment: floor(log(size)) in base SEGMENT_MERGE_FACTOR."""
+    tier = 0
+    while size >= SEGMENT_MERGE_FACTOR:
+        size //= SEGMENT_MERGE_FACTOR
+        tier += 1
+    return tier
+
+
+def merge_sorted_segments(
+        segments: list[tuple[np.ndarray, np.ndarray]], batch_size: int
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """Union of (sorted unique keys, vectors) segments, in key order, in batches.
+
+    `segments` go newest first, and a key held by several keeps the newest
+    vector. Each round looks at the next `batch_size` keys of every segment
+    and takes all keys up to the smallest last key among those windows, so
+    no key is split across rounds and a round holds at most
+    `batch_size * len(segments)` rows.
+    """
+    cursors = [0] * len(segments)
+    while True:
+        active = [i for i, (keys, _) in enumerate(segments) if cursors[i] < len(keys)]
+        if not active:
+            return
+        bound = min(
+            segments[i][0][min(cursors[i] + batch_size, len(segments[i][0])) - 1]
+            for i in active
+        )
+        key_parts, vector_parts = [], []
+        for i in active:
+            keys, vectors = segments[i]
+            start = cursors[i]
+            window = keys[start : start + batch_size]
+            end = start + int(np.searchsorted(window, bound, side="right"))
+            key_parts.append(keys[start:end])
+            vector_parts.append(vectors[start:end])
+            cursors[i] = end
+        keys, first = np.unique(np.concatenate(key_parts), return_index=True)
+        yield keys, np.concatenate(vector_parts)[first]
+
+
+def normalize_query(text: str) -> str:
+    return unicodedata.normalize("NFC", " ".join(text.split()))
+
+
+@lru_cache(maxsize=None)
+def query_embedding_cache(model_name: str) -> QueryEmbeddingCache:
+    """The process-wide query cache for `model_name`, persisted on disk."""
+    return QueryEmbeddingCache(model_name, directory=QUERY_EMBEDDINGS_DIR)
+
+
+def _new_segment_name() -> str:
+    return f"segment_{uuid.uuid4().hex[:12]}"
@@ -5,7 +5,6 @@ from .search_utils import (
     load_golden_dataset,
     load_movies,
 )
-from .semantic_search import SemanticSearch
 from ollama import generate
 
 # model = "gpt-oss:20b"
@@ -44,8 +43,6 @@ def evaluate_command(limit: int = 5) -> dict:
     golden_data = load_golden_dataset()
     test_cases = golden_data["test_cases"]
 
-    semantic_search = SemanticSearch()
-    semantic_search.load_or_create_embeddings(movies)
     hybrid_search = HybridSearch(movies)
 
     total_precision = 0
@@ -1,11 +1,20 @@
 import os
+import time
 from typing import Optional
 
 from .keyword_search import InvertedIndex
+from .models import (
+    CROSS_ENCODER,
+    SENTENCE_TRANSFORMER,
+    model_stats,
+    peak_rss_bytes,
+    warm_up,
+)
 from .query_enhancement import enhance_query
-from .reranking import rerank
+from .reranking import cross_encoder_model, rerank
 from .search_utils import (
     DEFAULT_ALPHA,
+    DEFAULT_EMBEDDING_MODEL,
     DEFAULT_SEARCH_LIMIT,
     RRF_K,
     SEARCH_MULTIPLIER,
@@ -16,18 +25,22 @@ from .semantic_search import ChunkedSemanticSearch
 
 
 class HybridSearch:
-    def __init__(self, documents: list[dict]) -> None:
+    def __init__(
+            self, documents: list[dict], model_name: str = DEFAULT_EMBEDDING_MODEL
+    ) -> None:
         self.documents = documents
-        self.semantic_search = ChunkedSemanticSearch()
+        self.semantic_search = ChunkedSemanticSearch(model_name)
         self.semantic_search.load_or_create_chunk_embeddings(documents)
 
         self.idx = InvertedIndex()
         if not os.path.exists(self.idx.index_path):
             self.idx.build()
             self.idx.save()
+        else:
+            self.idx.load()
+            self.idx.sync(documents)
 
     def _bm25_search(self, query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> list[dict]:
-        self.idx.load()
         return self.idx.bm25_search(query, limit)
 
     def weighted_search(self, query: str, alpha: float, limit: int = 5) -> list[dict]:
@@ -180,10 +193,13 @@ def reciprocal_rank_fusion(
 
 
 def weighted_search_command(
-        query: str, alpha: float = DEFAULT_ALPHA, limit: int = DEFAULT_SEARCH_LIMIT
+        query: str,
+        alpha: float = DEFAULT_ALPHA,
+        limit: int = DEFAULT_SEARCH_LIMIT,
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
 ) -> dict:
     movies = load_movies()
-    searcher = HybridSearch(movies)
+    searcher = HybridSearch(movies, model_name)
 
     original_query = query
 
@@ -204,9 +220,10 @@ def rrf_search_command(
         enhance: Optional[str] = None,
         rerank_method: Optional[str] = None,
         limit: int = DEFAULT_SEARCH_LIMIT,
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
 ) -> dict:
     movies = load_movies()
-    searcher = HybridSearch(movies)
+    searcher = HybridSearch(movies, model_name)
 
     original_query = query
     enhanced_query = None
@@ -232,3 +249,21 @@ def rrf_search_command(
         "reranked": reranked,
         "results": results,
     }
+
+
+def warm_up_command(
+        cross_encoder: bool = False, model_name: str = DEFAULT_EMBEDDING_MODEL
+) -> dict:
+    """Load the models hybrid search needs and report what that cost."""
+    models = [(SENTENCE_TRANSFORMER, model_name)]
+    if cross_encoder:
+        models.append((CROSS_ENCODER, cross_encoder_model))
+    rss_before = peak_rss_bytes()
+    start = time.perf_counter()
+    warm_up(models)
+    return {
+        "seconds": time.perf_counter() - start,
+        "rss_before": rss_before,
+        "rss_after": peak_rss_bytes(),
+        "models": model_stats(),
+    }
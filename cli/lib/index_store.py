@@ -0,0 +1,244 @@
+import json
+import os
+import shutil
+from collections.abc import Iterable, Iterator, Mapping
+from typing import Optional
+
+import numpy as np
+
+MANIFEST_FILE = "manifest.json"
+
+
+def save_arrays(directory: str, manifest: dict, arrays: dict[str, np.ndarray]) -> None:
+    """Write arrays as .npy files next to a JSON manifest.
+
+    The files go to a temporary sibling directory that then replaces
+    `directory`, so readers never observe a half-written index. Processes
+    that still map the old files keep reading them until they reopen.
+    """
+    tmp_directory = f"{directory}.tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_directory, f"{name}.npy"), np.ascontiguousarray(array))
+    with open(os.path.join(tmp_directory, MANIFEST_FILE), "w") as f:
+        json.dump({**manifest, "arrays": sorted(arrays)}, f, indent=2)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+
+
+def save_array_batches(
+        directory: str,
+        manifest: dict,
+        names: list[str],
+        batches: Iterable[tuple[np.ndarray, ...]],
+) -> None:
+    """Like `save_arrays`, for arrays that arrive as aligned batches of rows.
+
+    Every batch holds the next rows of each array in `names`. Rows go
+    straight to disk, so no array is ever held whole in memory.
+    """
+    tmp_directory = f"{directory}.tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    rows_paths = [os.path.join(tmp_directory, f"{name}.rows") for name in names]
+    layouts = [(np.dtype(np.float32), (0,))] * len(names)
+    files = [open(path, "wb") for path in rows_paths]
+    try:
+        for i, batch in enumerate(batches):
+            for j, (rows, f) in enumerate(zip(batch, files)):
+                rows = np.ascontiguousarray(rows)
+                if i == 0:
+                    layouts[j] = rows.dtype, rows.shape[1:]
+                f.write(rows.tobytes())
+    finally:
+        for f in files:
+            f.close()
+    for name, rows_path, (dtype, row_shape) in zip(names, rows_paths, layouts):
+        rows_to_npy(
+            rows_path, os.path.join(tmp_directory, f"{name}.npy"), dtype, row_shape
+        )
+        os.remove(rows_path)
+    with open(os.path.join(tmp_directory, MANIFEST_FILE), "w") as f:
+        json.dump({**manifest, "arrays": sorted(names)}, f, indent=2)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+
+
+def save_npy_stream(path: str, batches: Iterable[np.ndarray]) -> np.ndarray:
+    """Write batches of rows to one .npy file without holding them together.
+
+    Rows are spooled to a raw side file because the .npy header needs the
+    final row count. The result is returned memory-mapped read-only.
+    """
+    rows_path = f"{path}.rows"
+    dtype, row_shape = np.dtype(np.float32), (0,)
+    with open(rows_path, "wb") as rows:
+        for i, batch in enumerate(batches):
+            batch = np.ascontiguousarray(batch)
+            if i == 0:
+                dtype, row_shape = batch.dtype, batch.shape[1:]
+            rows.write(batch.tobytes())
+    npy = rows_to_npy(rows_path, path, dtype, row_shape)
+    os.remove(rows_path)
+    return npy
+
+
+def rows_to_npy(
+        rows_path: str, path: str, dtype: np.dtype, row_shape: tuple[int, ...]
+) -> np.ndarray:
+    """Copy a raw file of rows into a .npy file, returned memory-mapped read-only."""
+    row_bytes = np.dtype(dtype).itemsize * int(np.prod(row_shape, dtype=np.int64))
+    row_count = os.path.getsize(rows_path) // row_bytes if row_bytes else 0
+    tmp_path = f"{path}.tmp.npy"
+    array = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=dtype, shape=(row_count, *row_shape)
+    )
+    data_offset = array.offset
+    del array
+    with open(rows_path, "rb") as rows, open(tmp_path, "r+b") as f:
+        f.seek(data_offset)
+        shutil.copyfileobj(rows, f)
+    os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+
+class RowFile:
+    """Rows of one dtype and shape appended to a raw file, which can be cut back.
+
+    This grows an array on disk batch by batch, and across runs when the
+    caller records how many rows were complete.
+    """
+
+    def __init__(
+            self, path: str, dtype: np.dtype, row_shape: tuple[int, ...] = ()
+    ) -> None:
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.row_bytes = self.dtype.itemsize * int(np.prod(row_shape, dtype=np.int64))
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        self.file.seek(0, os.SEEK_END)
+
+    def __len__(self) -> int:
+        return self.file.tell() // self.row_bytes
+
+    def append(self, rows: np.ndarray) -> None:
+        self.file.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+
+    def truncate(self, row_count: int) -> None:
+        self.file.truncate(row_count * self.row_bytes)
+        self.file.seek(0, os.SEEK_END)
+
+    def read(self) -> np.ndarray:
+        """All rows so far, memory-mapped read-only."""
+        self.file.flush()
+        if len(self) == 0:
+            return np.empty((0, *self.row_shape), dtype=self.dtype)
+        return np.memmap(
+            self.path, self.dtype, mode="r", shape=(len(self), *self.row_shape)
+        )
+
+    def sync(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        self.file.close()
+
+    def save_npy(self, path: str) -> np.ndarray:
+        self.sync()
+        return rows_to_npy(self.path, path, self.dtype, self.row_shape)
+
+
+def write_json_atomic(path: str, data: dict) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_manifest(
+        directory: str, kind: str, version: int, filename: str = MANIFEST_FILE
+) -> dict:
+    with open(os.path.join(directory, filename), "r") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != kind or manifest.get("version") != version:
+        raise ValueError(
+            f"{directory} holds {manifest.get('format')} version "
+            f"{manifest.get('version')}, expected {kind} version {version}; "
+            "rebuild it"
+        )
+    return manifest
+
+
+def current_manifest(
+        directory: str, kind: str, version: int, filename: str = MANIFEST_FILE
+) -> Optional[dict]:
+    """Manifest of a saved index, or None if it is missing or outdated."""
+    try:
+        return load_manifest(directory, kind, version, filename)
+    except (OSError, ValueError):
+        return None
+
+
+def file_stamp(path: str) -> dict:
+    """Size and mtime of a file, to tell whether something derived is stale."""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def load_arrays(
+        directory: str, kind: str, version: int
+) -> tuple[dict, dict[str, np.ndarray]]:
+    """Open every array of a saved index read-only with mmap.
+
+    Only the .npy headers are read here; data pages are faulted in on access
+    and shared through the page cache by every process mapping the files.
+    """
+    manifest = load_manifest(directory, kind, version)
+    arrays = {}
+    for name in manifest["arrays"]:
+        arrays[name] = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+    return manifest, arrays
+
+
+class DocumentStore(Mapping):
+    """Read-only doc id -> document mapping over JSON records in one byte array.
+
+    `doc_ids` must be sorted; a record is decoded only when it is looked up.
+    """
+
+    def __init__(
+            self, doc_ids: np.ndarray, data: np.ndarray, offsets: np.ndarray
+    ) -> None:
+        self.doc_ids = doc_ids
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_documents(cls, documents: list[dict]) -> "DocumentStore":
+        records = [json.dumps(doc).encode("utf-8") for doc in documents]
+        offsets = np.zeros(len(records) + 1, dtype=np.int64)
+        np.cumsum([len(record) for record in records], out=offsets[1:])
+        data = np.frombuffer(b"".join(records), dtype=np.uint8)
+        doc_ids = np.array([doc["id"] for doc in documents], dtype=np.int64)
+        return cls(doc_ids, data, offsets)
+
+    def document(self, ordinal: int) -> dict:
+        record = self.data[self.offsets[ordinal] : self.offsets[ordinal + 1]]
+        return json.loads(record.tobytes())
+
+    def __getitem__(self, doc_id: int) -> dict:
+        ordinal = int(np.searchsorted(self.doc_ids, doc_id))
+        if ordinal == len(self.doc_ids) or self.doc_ids[ordinal] != doc_id:
+            raise KeyError(doc_id)
+        return self.document(ordinal)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.doc_ids.tolist())
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
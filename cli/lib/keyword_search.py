@@ -1,109 +1,1002 @@
+import hashlib
+import heapq
+import json
 import math
 import os
-import pickle
+import re
+import shutil
 import string
+import sys
+import threading
+import time
+import uuid
 from collections import Counter, defaultdict
+from collections.abc import Iterable, Iterator, Mapping
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import AbstractContextManager, nullcontext
+from functools import lru_cache
+from itertools import batched, repeat
+from typing import NamedTuple, Optional
 
+import numpy as np
 from nltk.stem import PorterStemmer
 
+from .index_store import (
+    DocumentStore,
+    load_arrays,
+    load_manifest,
+    save_arrays,
+    write_json_atomic,
+)
+from .postings import (
+    TermDictionary,
+    block_byte_offsets,
+    delta_encode,
+    gather_slices,
+    segmented_cumsum,
+    varbyte_decode,
+    varbyte_encode,
+)
+
 from .search_utils import (
     BM25_B,
+    BM25_BLOCK_SIZE,
+    BM25_BATCH_CELLS,
     BM25_K1,
     CACHE_DIR,
     DEFAULT_SEARCH_LIMIT,
+    INGEST_BATCH_SIZE,
+    PROXIMITY_ALPHA,
+    SEARCH_MULTIPLIER,
+    SEGMENT_MAX_DELETED_RATIO,
+    SEGMENT_MERGE_FACTOR,
+    STEM_CACHE_SIZE,
     format_search_result,
+    iter_movies,
     load_movies,
     load_stopwords,
 )
 
 
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+
+INDEX_FORMAT = "keyword-index"
+INDEX_FORMAT_VERSION = 2
+SEGMENTS_FORMAT = "keyword-segments"
+SEGMENTS_FORMAT_VERSION = 1
+SEGMENTS_FILE = "segments.json"
+# "a phrase" or "words within a window"~N
+PHRASE_PATTERN = re.compile(r'"([^"]*)"(?:~(\d+))?')
+
+
+class IndexSegment:
+    """Compressed postings over a sorted, immutable set of documents.
+
+    Deleting a document never rewrites a segment. The delete is recorded as a
+    tombstone that masks the document out until the segment is merged away.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.docmap = DocumentStore.from_documents([])
+        # Documents are addressed by dense ordinals in ascending movie id order.
+        self.doc_ids = np.empty(0, dtype=np.int64)
+        self.doc_lengths = np.empty(0, dtype=np.int32)
+        self.doc_hashes = np.empty(0, dtype=np.uint64)
+        self.terms = TermDictionary.from_terms([])
+        self.doc_freqs = np.empty(0, dtype=np.int32)
+        # Postings are split into blocks of BM25_BLOCK_SIZE. term_blocks[t] to
+        # term_blocks[t + 1] is the block range of term t; each block points
+        # into the variable-byte encoded doc gaps and term frequencies.
+        self.term_blocks = np.zeros(1, dtype=np.int64)
+        self.block_last_docs = np.empty(0, dtype=np.int32)
+        self.block_postings_offsets = np.zeros(1, dtype=np.int64)
+        self.block_tf_offsets = np.zeros(1, dtype=np.int64)
+        self.postings = np.empty(0, dtype=np.uint8)
+        self.tfs = np.empty(0, dtype=np.uint8)
+        # Max BM25 saturation (impact without IDF) per block and per term,
+        # computed against saturation_avg_doc_length at build time.
+        self.block_max_saturations = np.empty(0, dtype=np.float32)
+        self.term_max_saturations = np.empty(0, dtype=np.float32)
+        self.saturation_avg_doc_length = 0.0
+        # Optional word positions of every posting, gap encoded per posting
+        # and split at the same block boundaries as the postings.
+        self.positions: Optional[np.ndarray] = None
+        self.block_position_offsets: Optional[np.ndarray] = None
+        # Tombstones: deleted ordinals, and how many of them contain each term.
+        self.deleted: set[int] = set()
+        self.deleted_doc_freqs: Counter = Counter()
+        self.live: Optional[np.ndarray] = None
+        self.saved = False
+
+    @classmethod
+    def from_documents(
+            cls,
+            name: str,
+            movies: list[dict],
+            workers: int = 1,
+            positions: bool = False,
+            executor: Optional[Executor] = None,
+    ) -> "IndexSegment":
+        """Index `movies` as a segment, in `workers` shards when above one.
+
+        Shards run on `executor`, which callers indexing several segments
+        should create once (see `worker_pool`); without one, a pool is
+        started for this call only.
+        """
+        if workers > 1 and executor is None:
+            with worker_pool(workers) as executor:
+                return cls.from_documents(name, movies, workers, positions, executor)
+        texts = [f"{m['title']} {m['description']}" for m in movies]
+        if workers > 1:
+            # Contiguous ordinal ranges, so shard postings are already in
+            # final order and merging is a concatenation per term.
+            shard_size = -(-len(texts) // workers)
+            starts = range(0, len(texts), max(shard_size, 1))
+            shards = list(
+                executor.map(
+                    build_index_shard,
+                    [texts[start : start + shard_size] for start in starts],
+                    starts,
+                    repeat(positions),
+                )
+            )
+        else:
+            shards = [build_index_shard(texts, 0, positions)]
+
+        hashes = np.array([document_hash(m) for m in movies], dtype=np.uint64)
+        return cls.from_postings(
+            name,
+            DocumentStore.from_documents(movies),
+            hashes,
+            merge_index_shards(shards),
+        )
+
+    @classmethod
+    def from_postings(
+            cls,
+            name: str,
+            docmap: DocumentStore,
+            doc_hashes: np.ndarray,
+            postings: "IndexShard",
+    ) -> "IndexSegment":
+        segment = cls(name)
+        segment.docmap = docmap
+        segment.doc_ids = docmap.doc_ids
+        segment.doc_hashes = doc_hashes
+        segment.doc_lengths = postings.doc_lengths
+        segment.terms = TermDictionary.from_terms(postings.terms)
+        segment.doc_freqs = postings.doc_freqs
+        segment.__compress_postings(
+            postings.doc_ordinals, postings.tfs, postings.positions
+        )
+        return segment
+
+    def __compress_postings(
+            self,
+            doc_ordinals: np.ndarray,
+            tfs: np.ndarray,
+            positions: Optional[np.ndarray],
+    ) -> None:
+        term_starts = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        np.cumsum(self.doc_freqs, out=term_starts[1:])
+
+        blocks_per_term = -(-self.doc_freqs.astype(np.int64) // BM25_BLOCK_SIZE)
+        self.term_blocks = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        np.cumsum(blocks_per_term, out=self.term_blocks[1:])
+        block_terms = np.repeat(np.arange(len(self.terms)), blocks_per_term)
+        block_starts = term_starts[block_terms] + BM25_BLOCK_SIZE * (
+            np.arange(len(block_terms)) - self.term_blocks[block_terms]
+        )
+        block_ends = np.minimum(
+            block_starts + BM25_BLOCK_SIZE, term_starts[block_terms + 1]
+        )
+        self.block_last_docs = doc_ordinals[block_ends - 1].astype(np.int32)
+
+        deltas = delta_encode(doc_ordinals, term_starts)
+        self.postings = varbyte_encode(deltas)
+        self.tfs = varbyte_encode(tfs)
+        self.block_postings_offsets = block_byte_offsets(deltas, block_starts)
+        self.block_tf_offsets = block_byte_offsets(tfs, block_starts)
+
+        if positions is not None:
+            posting_starts = np.zeros(len(tfs) + 1, dtype=np.int64)
+            np.cumsum(tfs, out=posting_starts[1:])
+            position_deltas = delta_encode(positions, posting_starts)
+            self.positions = varbyte_encode(position_deltas)
+            self.block_position_offsets = block_byte_offsets(
+                position_deltas, posting_starts[block_starts]
+            )
+
+        if len(self.doc_lengths):
+            self.saturation_avg_doc_length = float(self.doc_lengths.mean())
+        saturations = bm25_saturation(
+            tfs,
+            self.doc_lengths[doc_ordinals],
+            self.saturation_avg_doc_length,
+        )
+        if len(block_starts):
+            block_max = np.maximum.reduceat(saturations, block_starts)
+            term_max = np.maximum.reduceat(block_max, self.term_blocks[:-1])
+        else:
+            block_max = term_max = np.empty(0)
+        self.block_max_saturations = _round_up_float32(block_max)
+        self.term_max_saturations = _round_up_float32(term_max)
+
+    def save(self, directory: str) -> None:
+        manifest = {
+            "format": INDEX_FORMAT,
+            "version": INDEX_FORMAT_VERSION,
+            "documents": len(self.doc_ids),
+            "terms": len(self.terms),
+            "block_size": BM25_BLOCK_SIZE,
+            "saturation_avg_doc_length": self.saturation_avg_doc_length,
+            "positions": self.has_positions,
+        }
+        save_arrays(os.path.join(directory, self.name), manifest, self.__arrays())
+        self.saved = True
+
+    def __arrays(self) -> dict[str, np.ndarray]:
+        arrays = {
+            "doc_ids": self.doc_ids,
+            "doc_lengths": self.doc_lengths,
+            "doc_hashes": self.doc_hashes,
+            "document_data": self.docmap.data,
+            "document_offsets": self.docmap.offsets,
+            "term_data": self.terms.data,
+            "term_offsets": self.terms.offsets,
+            "doc_freqs": self.doc_freqs,
+            "term_blocks": self.term_blocks,
+            "block_last_docs": self.block_last_docs,
+            "block_postings_offsets": self.block_postings_offsets,
+            "block_tf_offsets": self.block_tf_offsets,
+            "postings": self.postings,
+            "tfs": self.tfs,
+            "block_max_saturations": self.block_max_saturations,
+            "term_max_saturations": self.term_max_saturations,
+        }
+        if self.has_positions:
+            arrays["positions"] = self.positions
+            arrays["block_position_offsets"] = self.block_position_offsets
+        return arrays
+
+    @classmethod
+    def load(cls, directory: str, name: str) -> "IndexSegment":
+        manifest, arrays = load_arrays(
+            os.path.join(directory, name), INDEX_FORMAT, INDEX_FORMAT_VERSION
+        )
+        if manifest["block_size"] != BM25_BLOCK_SIZE:
+            raise ValueError(
+                f"index was built with block size {manifest['block_size']}, "
+                f"expected {BM25_BLOCK_SIZE}; rebuild it"
+            )
+        segment = cls(name)
+        segment.doc_ids = arrays["doc_ids"]
+        segment.doc_lengths = arrays["doc_lengths"]
+        segment.doc_hashes = arrays["doc_hashes"]
+        segment.docmap = DocumentStore(
+            segment.doc_ids, arrays["document_data"], arrays["document_offsets"]
+        )
+        segment.terms = TermDictionary(arrays["term_data"], arrays["term_offsets"])
+        segment.doc_freqs = arrays["doc_freqs"]
+        segment.term_blocks = arrays["term_blocks"]
+        segment.block_last_docs = arrays["block_last_docs"]
+        segment.block_postings_offsets = arrays["block_postings_offsets"]
+        segment.block_tf_offsets = arrays["block_tf_offsets"]
+        segment.postings = arrays["postings"]
+        segment.tfs = arrays["tfs"]
+        segment.block_max_saturations = arrays["block_max_saturations"]
+        segment.term_max_saturations = arrays["term_max_saturations"]
+        segment.saturation_avg_doc_length = manifest["saturation_avg_doc_length"]
+        if manifest.get("positions"):
+            segment.positions = arrays["positions"]
+            segment.block_position_offsets = arrays["block_position_offsets"]
+        segment.saved = True
+        return segment
+
+    @property
+    def has_positions(self) -> bool:
+        return self.positions is not None
+
+    @property
+    def live_count(self) -> int:
+        return len(self.doc_ids) - len(self.deleted)
+
+    def live_ordinals(self) -> np.ndarray:
+        if self.live is None:
+            return np.arange(len(self.doc_ids))
+        return np.flatnonzero(self.live)
+
+    def delete(self, ordinal: int) -> None:
+        doc = self.docmap.document(ordinal)
+        self.deleted.add(ordinal)
+        self.deleted_doc_freqs.update(
+            set(tokenize_text(f"{doc['title']} {doc['description']}"))
+        )
+        if self.live is None:
+            self.live = np.ones(len(self.doc_ids), dtype=bool)
+        self.live[ordinal] = False
+
+    def restore_tombstones(self, deleted: list[int], deleted_doc_freqs: dict) -> None:
+        self.deleted = set(deleted)
+        self.deleted_doc_freqs = Counter(deleted_doc_freqs)
+        if self.deleted:
+            self.live = np.ones(len(self.doc_ids), dtype=bool)
+            self.live[deleted] = False
+
+    def ordinal(self, doc_id: int) -> Optional[int]:
+        """Live ordinal of a document in this segment, if it has one."""
+        ordinal = int(np.searchsorted(self.doc_ids, doc_id))
+        if ordinal == len(self.doc_ids) or self.doc_ids[ordinal] != doc_id:
+            return None
+        if ordinal in self.deleted:
+            return None
+        return ordinal
+
+    def live_doc_freq(self, token: str) -> int:
+        term_id = self.terms.lookup(token)
+        if term_id is None:
+            return 0
+        return int(self.doc_freqs[term_id]) - self.deleted_doc_freqs[token]
+
+    def decode_postings(
+            self, term_id: int, blocks: Optional[np.ndarray] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Decode doc ordinals and term frequencies of a term.
+
+        With `blocks` (sorted absolute block numbers of the term) only those
+        blocks are decoded, which is how candidates skip the rest of a list.
+        Tombstoned documents are included; callers filter them.
+        """
+        first_block = self.term_blocks[term_id]
+        last_block = self.term_blocks[term_id + 1]
+        if blocks is None:
+            postings_start = self.block_postings_offsets[first_block]
+            postings_end = self.block_postings_offsets[last_block]
+            tfs_start = self.block_tf_offsets[first_block]
+            tfs_end = self.block_tf_offsets[last_block]
+            deltas = varbyte_decode(self.postings[postings_start:postings_end])
+            tfs = varbyte_decode(self.tfs[tfs_start:tfs_end])
+            return np.cumsum(deltas), tfs
+
+        deltas = varbyte_decode(
+            gather_slices(
+                self.postings,
+                self.block_postings_offsets[blocks],
+                self.block_postings_offsets[blocks + 1],
+            )
+        )
+        tfs = varbyte_decode(
+            gather_slices(
+                self.tfs,
+                self.block_tf_offsets[blocks],
+                self.block_tf_offsets[blocks + 1],
+            )
+        )
+        block_sizes = np.full(len(blocks), BM25_BLOCK_SIZE, dtype=np.int64)
+        block_sizes[blocks == last_block - 1] = (
+            self.doc_freqs[term_id] - BM25_BLOCK_SIZE * (last_block - 1 - first_block)
+        )
+        # Gaps restart at each block from the previous block's last doc.
+        bases = np.where(
+            blocks > first_block, self.block_last_docs[np.maximum(blocks - 1, 0)], 0
+        )
+        block_starts = np.cumsum(block_sizes) - block_sizes
+        deltas[block_starts] += bases
+        return segmented_cumsum(deltas, block_sizes), tfs
+
+    def decode_positions(
+            self, term_id: int, blocks: Optional[np.ndarray] = None
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Like decode_postings, plus the concatenated word positions.
+
+        The positions of a posting are its `tf` next values.
+        """
+        doc_ordinals, tfs = self.decode_postings(term_id, blocks)
+        if blocks is None:
+            blocks = np.arange(self.term_blocks[term_id], self.term_blocks[term_id + 1])
+        deltas = varbyte_decode(
+            gather_slices(
+                self.positions,
+                self.block_position_offsets[blocks],
+                self.block_position_offsets[blocks + 1],
+            )
+        )
+        return doc_ordinals, tfs, segmented_cumsum(deltas, tfs)
+
+    def seek_positions(
+            self, term_id: int, ordinals: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Postings and positions of a term restricted to sorted `ordinals`.
+
+        block_last_docs works as a skip list: only the blocks whose doc range
+        can hold one of `ordinals` are decoded.
+        """
+        first_block = self.term_blocks[term_id]
+        last_block = self.term_blocks[term_id + 1]
+        blocks = first_block + np.searchsorted(
+            self.block_last_docs[first_block:last_block], ordinals
+        )
+        blocks = np.unique(blocks[blocks < last_block])
+        doc_ordinals, tfs, positions = self.decode_positions(term_id, blocks)
+        matched = np.isin(doc_ordinals, ordinals, assume_unique=True)
+        return doc_ordinals[matched], tfs[matched], positions[np.repeat(matched, tfs)]
+
+    def decode_all(self) -> tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+        """Doc ordinals, term frequencies and positions of every term.
+
+        Positions are None when the segment has none.
+        """
+        doc_ordinals = segmented_cumsum(varbyte_decode(self.postings), self.doc_freqs)
+        tfs = varbyte_decode(self.tfs)
+        positions = None
+        if self.has_positions:
+            positions = segmented_cumsum(varbyte_decode(self.positions), tfs)
+        return doc_ordinals, tfs, positions
+
+    def match_phrase(
+            self, tokens: list[tuple[str, int]], window: Optional[int] = None
+    ) -> np.ndarray:
+        """Live ordinals of the documents matching a phrase.
+
+        `tokens` are (token, query word position) pairs. Without `window` the
+        tokens must occur at the same relative positions as in the query;
+        with it they must all fall within `window` consecutive words, in any
+        order. The rarest term is decoded in full and every other term only
+        in the blocks that can hold a surviving document, so the cost follows
+        the rarest term's postings.
+        """
+        term_ids = []
+        for token, _ in tokens:
+            term_id = self.terms.lookup(token)
+            if term_id is None:
+                return np.empty(0, dtype=np.int64)
+            term_ids.append(term_id)
+
+        postings = {}
+        ordinals = None
+        for term_id in sorted(set(term_ids), key=lambda t: self.doc_freqs[t]):
+            if ordinals is None:
+                doc_ordinals, tfs, positions = self.decode_positions(term_id)
+                if self.live is not None:
+                    live = self.live[doc_ordinals]
+                    positions = positions[np.repeat(live, tfs)]
+                    doc_ordinals, tfs = doc_ordinals[live], tfs[live]
+            else:
+                doc_ordinals, tfs, positions = self.seek_positions(term_id, ordinals)
+            postings[term_id] = doc_ordinals, tfs, positions
+            ordinals = doc_ordinals
+            if not len(ordinals):
+                return ordinals
+
+        # Earlier terms still hold documents that later terms ruled out.
+        occurrences = {}
+        for term_id, (doc_ordinals, tfs, positions) in postings.items():
+            matched = np.isin(doc_ordinals, ordinals, assume_unique=True)
+            occurrences[term_id] = (
+                np.repeat(doc_ordinals[matched], tfs[matched]),
+                positions[np.repeat(matched, tfs)],
+            )
+
+        if window is None:
+            first_position = min(position for _, position in tokens)
+            phrase_starts = None
+            for term_id, (_, position) in zip(term_ids, tokens):
+                docs, positions = occurrences[term_id]
+                starts = positions - (position - first_position)
+                valid = starts >= 0
+                keys = np.unique((docs[valid] << 32) | starts[valid])
+                if phrase_starts is None:
+                    phrase_starts = keys
+                else:
+                    phrase_starts = np.intersect1d(
+                        phrase_starts, keys, assume_unique=True
+                    )
+            return np.unique(phrase_starts >> 32)
+
+        docs = [occurrences[term_id][0] for term_id in postings]
+        spans = _min_cover_spans(
+            np.concatenate(docs),
+            np.concatenate([occurrences[term_id][1] for term_id in postings]),
+            np.repeat(np.arange(len(docs)), [len(d) for d in docs]),
+            len(docs),
+        )
+        return ordinals[spans <= window]
+
+    def proximity_boosts(
+            self, tokens: list[str], ordinals: np.ndarray
+    ) -> np.ndarray:
+        """Tao & Zhai's MinDist proximity boost for sorted `ordinals`.
+
+        The boost is log(1 + exp(-d) / alpha), where d is the smallest word
+        distance between two different query terms in the document; documents
+        with fewer than two of the terms get 0.
+        """
+        docs, offsets, terms = [], [], []
+        for term_index, token in enumerate(set(tokens)):
+            term_id = self.terms.lookup(token)
+            if term_id is None:
+                continue
+            doc_ordinals, tfs, positions = self.seek_positions(term_id, ordinals)
+            docs.append(np.repeat(doc_ordinals, tfs))
+            offsets.append(positions)
+            terms.append(np.full(len(positions), term_index))
+        boosts = np.zeros(len(ordinals))
+        if len(docs) < 2:
+            return boosts
+        docs = np.concatenate(docs)
+        offsets = np.concatenate(offsets)
+        terms = np.concatenate(terms)
+        order = np.lexsort((offsets, docs))
+        docs, offsets, terms = docs[order], offsets[order], terms[order]
+        # The closest pair of different terms is always adjacent in position
+        # order, so only neighbours need comparing.
+        pairs = (docs[1:] == docs[:-1]) & (terms[1:] != terms[:-1])
+        distances = np.full(len(ordinals), np.inf)
+        np.minimum.at(
+            distances,
+            np.searchsorted(ordinals, docs[1:][pairs]),
+            (offsets[1:] - offsets[:-1])[pairs],
+        )
+        return np.log1p(np.exp(-distances) / PROXIMITY_ALPHA)
+
+    def iter_postings(self):
+        """Yield the live postings of every term."""
+        for term_id, term in enumerate(self.terms):
+            doc_ordinals, tfs = self.decode_postings(term_id)
+            if self.live is not None:
+                live = self.live[doc_ordinals]
+                doc_ordinals, tfs = doc_ordinals[live], tfs[live]
+            if len(doc_ordinals):
+                yield term, doc_ordinals, tfs
+
+    def compact_nbytes(self) -> int:
+        size = 0
+        for name, array in self.__arrays().items():
+            if not name.startswith("document_"):
+                size += array.nbytes
+        return size
+
+    def get_tf(self, ordinal: int, token: str) -> int:
+        term_id = self.terms.lookup(token)
+        if term_id is None:
+            return 0
+        first_block = self.term_blocks[term_id]
+        last_block = self.term_blocks[term_id + 1]
+        block = first_block + np.searchsorted(
+            self.block_last_docs[first_block:last_block], ordinal
+        )
+        if block == last_block:
+            return 0
+        doc_ordinals, tfs = self.decode_postings(term_id, np.array([block]))
+        position = np.searchsorted(doc_ordinals, ordinal)
+        if position < len(doc_ordinals) and doc_ordinals[position] == ordinal:
+            return int(tfs[position])
+        return 0
+
+    def top_k(
+            self,
+            term_weights: dict[str, float],
+            limit: int,
+            avg_doc_length: float,
+            threshold: float = 0.0,
+            candidates: Optional[np.ndarray] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Best `limit` live documents for BM25 term weights (query tf * IDF).
+
+        `threshold` is a known lower bound on the final k-th score, e.g. from
+        segments searched before; documents that cannot reach it are skipped.
+        `candidates` (sorted live ordinals) restricts the search to those
+        documents, e.g. the ones matching a phrase.
+        """
+        # Saturation grows with the average doc length but never by more than
+        # the ratio of the new average to the one the maxima were built with.
+        saturation_scale = 1.0
+        if self.saturation_avg_doc_length > 0:
+            saturation_scale = max(
+                1.0, avg_doc_length / self.saturation_avg_doc_length
+            )
+        query_terms = []
+        for token, weight in term_weights.items():
+            term_id = self.terms.lookup(token)
+            if term_id is None:
+                continue
+            max_saturation = float(self.term_max_saturations[term_id])
+            bound = weight * max_saturation * saturation_scale
+            query_terms.append((term_id, weight, bound))
+        # MaxScore: score the highest-impact terms first so the top-k
+        # threshold rises early, then stop admitting new documents once the
+        # remaining terms cannot lift an unseen document above it.
+        query_terms.sort(key=lambda x: x[2], reverse=True)
+        # Suffix sums rather than a running difference, so that the bound is
+        # exactly 0 after the last term instead of a rounding error below it.
+        bounds = [bound for _, _, bound in query_terms]
+        remaining_bounds = [sum(bounds[i:]) for i in range(len(bounds) + 1)]
+
+        scores = np.zeros(len(self.doc_ids))
+        touched = np.zeros(len(self.doc_ids), dtype=bool)
+        for i, (term_id, weight, _) in enumerate(query_terms):
+            remaining_bound = remaining_bounds[i]
+            if candidates is None and threshold > remaining_bound:
+                candidates = np.flatnonzero(touched)
+            if candidates is not None:
+                reachable = scores[candidates] + remaining_bound >= threshold
+                candidates = candidates[reachable]
+            remaining_bound = remaining_bounds[i + 1]
+
+            if candidates is None:
+                doc_ordinals, tfs = self.decode_postings(term_id)
+                if self.live is not None:
+                    live = self.live[doc_ordinals]
+                    doc_ordinals, tfs = doc_ordinals[live], tfs[live]
+                touched[doc_ordinals] = True
+            else:
+                # Only candidates can still make the top-k: drop those whose
+                # block maximum cannot get them there, and decode only the
+                # blocks that hold the survivors.
+                first_block = self.term_blocks[term_id]
+                last_block = self.term_blocks[term_id + 1]
+                blocks = first_block + np.searchsorted(
+                    self.block_last_docs[first_block:last_block], candidates
+                )
+                in_term = blocks < last_block
+                block_bounds = np.zeros(len(candidates))
+                block_bounds[in_term] = (
+                    weight
+                    * saturation_scale
+                    * self.block_max_saturations[blocks[in_term]]
+                )
+                keep = scores[candidates] + block_bounds + remaining_bound >= threshold
+                candidates = candidates[keep]
+                doc_ordinals, tfs = self.decode_postings(
+                    term_id, np.unique(blocks[keep & in_term])
+                )
+                positions = np.minimum(
+                    np.searchsorted(candidates, doc_ordinals), len(candidates) - 1
+                )
+                matched = candidates[positions] == doc_ordinals
+                doc_ordinals = doc_ordinals[matched]
+                tfs = tfs[matched]
+
+            scores[doc_ordinals] += weight * bm25_saturation(
+                tfs, self.doc_lengths[doc_ordinals], avg_doc_length
+            )
+            pool = np.flatnonzero(touched) if candidates is None else candidates
+            if len(pool) >= limit:
+                kth = len(pool) - limit
+                threshold = max(
+                    threshold, float(np.partition(scores[pool], kth)[kth])
+                )
+
+        pool = np.flatnonzero(touched) if candidates is None else candidates
+        if len(pool) > limit:
+            # Keep every document tied with the k-th score, then the lowest
+            # doc ids among them, as the callers order hits by (score, id).
+            kth = len(pool) - limit
+            pool = pool[scores[pool] >= np.partition(scores[pool], kth)[kth]]
+            order = np.lexsort((self.doc_ids[pool], -scores[pool]))[:limit]
+            pool = pool[order]
+        return pool, scores[pool]
+
+
 class InvertedIndex:
+    """BM25 index made of immutable segments, LSM style.
+
+    A build writes one segment. Later catalog changes add a small segment
+    with the new or changed documents and tombstone their old versions, and
+    small or mostly-deleted segments are merged in the background. Corpus
+    statistics (N, average length, document frequencies) always count live
+    documents only, so scores match a full rebuild.
+
+    There must be a single writer per index directory; any number of
+    processes may read it.
+    """
+
     def __init__(self) -> None:
-        self.index = defaultdict(set)
-        self.docmap: dict[int, dict] = {}
-        self.index_path = os.path.join(CACHE_DIR, "index.pkl")
-        self.docmap_path = os.path.join(CACHE_DIR, "docmap.pkl")
-        self.tf_path = os.path.join(CACHE_DIR, "term_frequencies.pkl")
-        self.doc_lengths_path = os.path.join(CACHE_DIR, "doc_lengths.pkl")
-        self.term_frequencies = defaultdict(Counter)
-        self.doc_lengths = {}
-
-    def build(self) -> None:
-        movies = load_movies()
-        for m in movies:
-            doc_id = m["id"]
-            doc_description = f"{m['title']} {m['description']}"
-            self.docmap[doc_id] = m
-            self.__add_document(doc_id, doc_description)
+        self.index_path = os.path.join(CACHE_DIR, "keyword_index")
+        self.segments: list[IndexSegment] = []
+        self.doc_count = 0
+        self.total_doc_length = 0
+        self.docmap = LiveDocuments(self)
+        self._bm25_idfs: dict[str, float] = {}
+        self._bm25_matrix: Optional[BM25Matrix] = None
+        self._lock = threading.RLock()
+        self._merge_thread: Optional[threading.Thread] = None
+        # Whether new segments store word positions for phrase queries.
+        self.store_positions = False
+
+    def build(
+            self,
+            workers: int = 1,
+            batch_size: int = INGEST_BATCH_SIZE,
+            positions: bool = False,
+    ) -> None:
+        """Index the catalog as a stream, then merge it into one segment.
+
+        A segment is written per batch and reopened memory-mapped, so
+        tokenizing is bounded by `batch_size` rather than the catalog size.
+        Nothing is indexed yet, so only ids repeated within the catalog are
+        looked up to tombstone their earlier version. The batch segments are
+        merged at the end, so queries on a fresh index touch one segment.
+        One pool of `workers` processes indexes every batch.
+        """
+        with self._lock, worker_pool(workers) as executor:
+            self.store_positions = positions
+            self.segments = []
+            self.doc_count = 0
+            self.total_doc_length = 0
+            seen: set[int] = set()
+            for batch in batched(iter_movies(), batch_size):
+                batch = _unique_by_id(batch)
+                repeated = [m["id"] for m in batch if m["id"] in seen]
+                seen.update(m["id"] for m in batch)
+                self.__upsert(batch, workers, repeated, executor)
+            self.__reset_corpus_stats()
+            self.merge()
 
     def save(self) -> None:
-        os.makedirs(CACHE_DIR, exist_ok=True)
-        with open(self.index_path, "wb") as f:
-            pickle.dump(self.index, f)
-        with open(self.docmap_path, "wb") as f:
-            pickle.dump(self.docmap, f)
-        with open(self.tf_path, "wb") as f:
-            pickle.dump(self.term_frequencies, f)
-        with open(self.doc_lengths_path, "wb") as f:
-            pickle.dump(self.doc_lengths, f)
+        with self._lock:
+            os.makedirs(self.index_path, exist_ok=True)
+            for segment in self.segments:
+                if not segment.saved:
+                    segment.save(self.index_path)
+            manifest = {
+                "format": SEGMENTS_FORMAT,
+                "version": SEGMENTS_FORMAT_VERSION,
+                "documents": self.doc_count,
+                "total_doc_length": self.total_doc_length,
+                "positions": self.store_positions,
+                "segments": [
+                    {
+                        "name": segment.name,
+                        "deleted": sorted(segment.deleted),
+                        "deleted_doc_freqs": dict(segment.deleted_doc_freqs),
+                    }
+                    for segment in self.segments
+                ],
+            }
+            write_json_atomic(os.path.join(self.index_path, SEGMENTS_FILE), manifest)
+            names = {segment.name for segment in self.segments}
+            for entry in os.listdir(self.index_path):
+                path = os.path.join(self.index_path, entry)
+                if os.path.isdir(path) and entry not in names:
+                    shutil.rmtree(path, ignore_errors=True)
 
     def load(self) -> None:
-        with open(self.index_path, "rb") as f:
-            self.index = pickle.load(f)
-        with open(self.docmap_path, "rb") as f:
-            self.docmap = pickle.load(f)
-        with open(self.tf_path, "rb") as f:
-            self.term_frequencies = pickle.load(f)
-        with open(self.doc_lengths_path, "rb") as f:
-            self.doc_lengths = pickle.load(f)
+        manifest = load_manifest(
+            self.index_path, SEGMENTS_FORMAT, SEGMENTS_FORMAT_VERSION, SEGMENTS_FILE
+        )
+        segments = []
+        for entry in manifest["segments"]:
+            segment = IndexSegment.load(self.index_path, entry["name"])
+            segment.restore_tombstones(entry["deleted"], entry["deleted_doc_freqs"])
+            segments.append(segment)
+        with self._lock:
+            self.segments = segments
+            self.doc_count = manifest["documents"]
+            self.total_doc_length = manifest["total_doc_length"]
+            self.store_positions = manifest.get("positions", False)
+            self.__reset_corpus_stats()
 
-    def get_documents(self, term: str) -> list[int]:
-        doc_ids = self.index.get(term, set())
-        return sorted(list(doc_ids))
+    def add_documents(self, movies: list[dict]) -> None:
+        """Insert or replace documents by id and persist the change."""
+        self.apply_changes(movies, [])
 
-    def __add_document(self, doc_id: int, text: str) -> None:
-        tokens = tokenize_text(text)
-        for token in set(tokens):
-            self.index[token].add(doc_id)
-        self.term_frequencies[doc_id].update(tokens)
-        self.doc_lengths[doc_id] = len(tokens)
+    def delete_documents(self, doc_ids: Iterable[int]) -> None:
+        self.apply_changes([], doc_ids)
 
-    def get_tf(self, doc_id: int, term: str) -> int:
+    def sync(
+            self,
+            movies: Iterable[dict],
+            batch_size: int = INGEST_BATCH_SIZE,
+            workers: int = 1,
+    ) -> dict:
+        """Bring the index in line with a catalog, touching only the delta.
+
+        Documents are compared by content hash, so unchanged documents cost a
+        hash and a lookup and are never re-tokenized. Changes are applied in
+        batches of `batch_size` as the catalog streams by, all indexed by one
+        pool of `workers` processes.
+        """
+        indexed = {}
+        for segment in self.segments:
+            live = segment.live_ordinals()
+            indexed.update(
+                zip(segment.doc_ids[live].tolist(), segment.doc_hashes[live].tolist())
+            )
+        seen = set()
+        changes = Counter()
+        changed = []
+        with worker_pool(workers) as executor:
+            for movie in movies:
+                doc_id = movie["id"]
+                if indexed.get(doc_id) != document_hash(movie):
+                    changed.append(movie)
+                    if doc_id not in seen:
+                        changes["added" if doc_id not in indexed else "updated"] += 1
+                seen.add(doc_id)
+                if len(changed) >= batch_size:
+                    self.apply_changes(changed, [], workers, executor)
+                    changed = []
+            removed = [doc_id for doc_id in indexed if doc_id not in seen]
+            if changed or removed:
+                self.apply_changes(changed, removed, workers, executor)
+        return {
+            "added": changes["added"],
+            "updated": changes["updated"],
+            "deleted": len(removed),
+        }
+
+    def apply_changes(
+            self,
+            upserts: list[dict],
+            deletes: Iterable[int],
+            workers: int = 1,
+            executor: Optional[Executor] = None,
+    ) -> None:
+        with self._lock:
+            for doc_id in deletes:
+                self.__delete(doc_id)
+            if upserts:
+                self.__upsert(upserts, workers, executor=executor)
+            self.__reset_corpus_stats()
+            self.save()
+        self.maybe_merge(background=True)
+
+    def __upsert(
+            self,
+            movies: Iterable[dict],
+            workers: int = 1,
+            replaced: Optional[Iterable[int]] = None,
+            executor: Optional[Executor] = None,
+    ) -> None:
+        """Index `movies` as a new segment, tombstoning their old versions.
+
+        `replaced` limits the lookup of old versions to those ids; by default
+        every movie is looked up.
+        """
+        movies = _unique_by_id(movies)
+        if replaced is None:
+            replaced = [movie["id"] for movie in movies]
+        for doc_id in replaced:
+            self.__delete(doc_id)
+        name = _new_segment_name()
+        IndexSegment.from_documents(
+            name, movies, workers, self.store_positions, executor
+        ).save(self.index_path)
+        segment = IndexSegment.load(self.index_path, name)
+        self.segments = [*self.segments, segment]
+        self.doc_count += len(movies)
+        self.total_doc_length += int(segment.doc_lengths.sum())
+
+    def __delete(self, doc_id: int) -> None:
+        location = self.__locate(doc_id)
+        if location is None:
+            return
+        segment, ordinal = location
+        segment.delete(ordinal)
+        self.doc_count -= 1
+        self.total_doc_length -= int(segment.doc_lengths[ordinal])
+
+    def maybe_merge(self, background: bool = False) -> None:
+        """Merge segments if the merge policy asks for it.
+
+        Too many segments merge the smallest SEGMENT_MERGE_FACTOR of them;
+        segments with more than SEGMENT_MAX_DELETED_RATIO tombstones are
+        rewritten to purge them. A background merge holds the write lock, so
+        updates wait for it while searches keep using the current segments.
+        """
+        with self._lock:
+            if self._merge_thread is not None and self._merge_thread.is_alive():
+                return
+            segments = [
+                segment
+                for segment in self.segments
+                if len(segment.deleted)
+                > SEGMENT_MAX_DELETED_RATIO * len(segment.doc_ids)
+            ]
+            if len(self.segments) > SEGMENT_MERGE_FACTOR:
+                by_size = sorted(self.segments, key=lambda s: s.live_count)
+                for segment in by_size[:SEGMENT_MERGE_FACTOR]:
+                    if segment not in segments:
+                        segments.append(segment)
+            if not segments:
+                return
+            if background:
+                self._merge_thread = threading.Thread(
+                    target=self.merge, args=(segments,)
+                )
+                self._merge_thread.start()
+                return
+        self.merge(segments)
+
+    def wait_for_merge(self) -> None:
+        thread = self._merge_thread
+        if thread is not None:
+            thread.join()
+
+    def merge(self, segments: Optional[list[IndexSegment]] = None) -> None:
+        """Merge `segments` (default: all) into one and persist the result."""
+        with self._lock:
+            if segments is None:
+                segments = self.segments
+            if len(segments) == 1 and not segments[0].deleted:
+                return
+            merged = merge_segments(_new_segment_name(), segments)
+            kept = [segment for segment in self.segments if segment not in segments]
+            if len(merged.doc_ids):
+                kept.append(merged)
+            self.segments = kept
+            self.__reset_corpus_stats()
+            self.save()
+
+    def __locate(self, doc_id: int) -> Optional[tuple[IndexSegment, int]]:
+        for segment in reversed(self.segments):
+            ordinal = segment.ordinal(doc_id)
+            if ordinal is not None:
+                return segment, ordinal
+        return None
+
+    def __reset_corpus_stats(self) -> None:
+        self._bm25_idfs = {}
+        self._bm25_matrix = None
+
+    def __analyze_term(self, term: str) -> str:
         tokens = tokenize_text(term)
         if len(tokens) != 1:
             raise ValueError("term must be a single token")
-        token = tokens[0]
-        return self.term_frequencies[doc_id][token]
+        return tokens[0]
+
+    def get_documents(self, term: str) -> list[int]:
+        doc_ids = []
+        for segment in self.segments:
+            term_id = segment.terms.lookup(term)
+            if term_id is None:
+                continue
+            doc_ordinals, _ = segment.decode_postings(term_id)
+            if segment.live is not None:
+                doc_ordinals = doc_ordinals[segment.live[doc_ordinals]]
+            doc_ids.extend(segment.doc_ids[doc_ordinals].tolist())
+        return sorted(doc_ids)
+
+    def get_tf(self, doc_id: int, term: str) -> int:
+        token = self.__analyze_term(term)
+        location = self.__locate(doc_id)
+        if location is None:
+            return 0
+        segment, ordinal = location
+        return segment.get_tf(ordinal, token)
+
+    def __doc_freq(self, token: str) -> int:
+        return sum(segment.live_doc_freq(token) for segment in self.segments)
 
     def get_idf(self, term: str) -> float:
-        tokens = tokenize_text(term)
-        if len(tokens) != 1:
-            raise ValueError("term must be a single token")
-        token = tokens[0]
-        doc_count = len(self.docmap)
-        term_doc_count = len(self.index[token])
-        return math.log((doc_count + 1) / (term_doc_count + 1))
+        term_doc_count = self.__doc_freq(self.__analyze_term(term))
+        return math.log((self.doc_count + 1) / (term_doc_count + 1))
 
     def get_bm25_idf(self, term: str) -> float:
-        tokens = tokenize_text(term)
-        if len(tokens) != 1:
-            raise ValueError("term must be a single token")
-        token = tokens[0]
-        doc_count = len(self.docmap)
-        term_doc_count = len(self.index[token])
-        return math.log((doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1)
+        return self.__bm25_idf(self.__analyze_term(term))
+
+    def __bm25_idf(self, token: str) -> float:
+        idf = self._bm25_idfs.get(token)
+        if idf is None:
+            term_doc_count = self.__doc_freq(token)
+            idf = math.log(
+                (self.doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1
+            )
+            self._bm25_idfs[token] = idf
+        return idf
 
     def get_bm25_tf(
             self, doc_id: int, term: str, k1: float = BM25_K1, b: float = BM25_B
     ) -> float:
         tf = self.get_tf(doc_id, term)
-        doc_length = self.doc_lengths.get(doc_id, 0)
-        avg_doc_length = self.__get_avg_doc_length()
-        if avg_doc_length > 0:
-            length_norm = 1 - b + b * (doc_length / avg_doc_length)
-        else:
-            length_norm = 1
-        return (tf * (k1 + 1)) / (tf + k1 * length_norm)
+        location = self.__locate(doc_id)
+        doc_length = 0
+        if location is not None:
+            segment, ordinal = location
+            doc_length = int(segment.doc_lengths[ordinal])
+        return bm25_saturation(tf, doc_length, self.__get_avg_doc_length(), k1, b)
 
     def get_tf_idf(self, doc_id: int, term: str) -> float:
         tf = self.get_tf(doc_id, term)
@@ -111,33 +1004,93 @@ class InvertedIndex:
         return tf * idf
 
     def __get_avg_doc_length(self) -> float:
-        if not self.doc_lengths or len(self.doc_lengths) == 0:
+        if self.doc_count == 0:
             return 0.0
-        total_length = 0
-        for length in self.doc_lengths.values():
-            total_length += length
-        return total_length / len(self.doc_lengths)
+        return self.total_doc_length / self.doc_count
 
     def bm25(self, doc_id: int, term: str) -> float:
         tf_component = self.get_bm25_tf(doc_id, term)
         idf_component = self.get_bm25_idf(term)
         return tf_component * idf_component
 
-    def bm25_search(self, query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> list[dict]:
-        query_tokens = tokenize_text(query)
+    @property
+    def has_positions(self) -> bool:
+        return all(segment.has_positions for segment in self.segments)
+
+    def bm25_search(
+            self,
+            query: str,
+            limit: int = DEFAULT_SEARCH_LIMIT,
+            proximity: bool = False,
+    ) -> list[dict]:
+        """BM25 top-k search over all segments.
+
+        A quoted phrase ("bear attack") must occur as written, and "..."~N
+        needs its words within N consecutive words. With `proximity` the best
+        limit * SEARCH_MULTIPLIER documents get a term proximity boost and
+        are re-ranked. Both need an index built with positions.
+        """
+        if limit <= 0:
+            return []
 
-        scores = {}
-        for doc_id in self.docmap:
-            score = 0.0
-            for token in query_tokens:
-                score += self.bm25(doc_id, token)
-            scores[doc_id] = score
+        if proximity and not self.has_positions:
+            raise ValueError("proximity boosts need an index built with positions")
+        phrases = []
+        # Without positions, quoted phrases fall back to plain keywords.
+        for match in PHRASE_PATTERN.finditer(query if self.has_positions else ""):
+            tokens = tokenize_with_positions(match.group(1))
+            if tokens:
+                window = int(match.group(2)) if match.group(2) else None
+                phrases.append((tokens, window))
+        query_tokens = tokenize_text(PHRASE_PATTERN.sub(r" \1 ", query))
+
+        term_weights = {}
+        for token, query_tf in Counter(query_tokens).items():
+            if self.__doc_freq(token) > 0:
+                term_weights[token] = query_tf * self.__bm25_idf(token)
+
+        pool_size = limit * SEARCH_MULTIPLIER if proximity else limit
+        avg_doc_length = self.__get_avg_doc_length()
+        hits = []
+        threshold = 0.0
+        # Largest segments first: their k-th score lets later segments prune.
+        for segment in sorted(self.segments, key=lambda s: s.live_count, reverse=True):
+            candidates = None
+            for tokens, window in phrases:
+                matches = segment.match_phrase(tokens, window)
+                if candidates is None:
+                    candidates = matches
+                else:
+                    candidates = np.intersect1d(candidates, matches, assume_unique=True)
+            if candidates is not None and not len(candidates):
+                continue
+            ordinals, scores = segment.top_k(
+                term_weights, pool_size, avg_doc_length, threshold, candidates
+            )
+            for ordinal, score in zip(ordinals.tolist(), scores.tolist()):
+                hits.append((score, int(segment.doc_ids[ordinal]), segment, ordinal))
+            if len(hits) >= pool_size:
+                hits = heapq.nlargest(pool_size, hits, key=lambda x: (x[0], -x[1]))
+                threshold = hits[-1][0]
 
-        sorted_docs = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+        if proximity:
+            boosted = []
+            for segment in {id(hit[2]): hit[2] for hit in hits}.values():
+                segment_hits = sorted(
+                    (hit for hit in hits if hit[2] is segment), key=lambda x: x[3]
+                )
+                ordinals = np.array([hit[3] for hit in segment_hits], dtype=np.int64)
+                boosts = segment.proximity_boosts(query_tokens, ordinals)
+                for (score, doc_id, _, ordinal), boost in zip(
+                        segment_hits, boosts.tolist()
+                ):
+                    boosted.append((score + boost, doc_id, segment, ordinal))
+            hits = boosted
+        hits.sort(key=lambda x: (-x[0], x[1]))
 
         results = []
-        for doc_id, score in sorted_docs[:limit]:
-            doc = self.docmap[doc_id]
+        for score, _, segment, ordinal in hits[:limit]:
+            doc = segment.docmap.document(ordinal)
             formatted_result = format_search_result(
                 doc_id=doc["id"],
                 title=doc["title"],
@@ -148,13 +1101,574 @@ class InvertedIndex:
 
         return results
 
+    def bm25_search_many(
+            self, queries: list[str], limit: int = DEFAULT_SEARCH_LIMIT
+    ) -> list[list[dict]]:
+        """BM25 top-k for a batch of queries with sparse matrix products.
+
+        Queries become a sparse query x term matrix of query tf * IDF, which
+        is multiplied by the cached term x doc saturation matrix a block of
+        rows at a time, followed by a per-row top-k. Quotes are ignored, so
+        phrases are scored as plain keywords.
+        """
+        if limit <= 0:
+            return [[] for _ in queries]
+        with self._lock:
+            if self._bm25_matrix is None:
+                self._bm25_matrix = BM25Matrix.from_segments(
+                    self.segments, self.__get_avg_doc_length()
+                )
+            matrix = self._bm25_matrix
+
+        query_rows, query_terms, query_weights = [], [], []
+        for row, query in enumerate(queries):
+            tokens = tokenize_text(PHRASE_PATTERN.sub(r" \1 ", query))
+            for token, query_tf in Counter(tokens).items():
+                term = matrix.vocabulary.get(token)
+                if term is not None:
+                    query_rows.append(row)
+                    query_terms.append(term)
+                    query_weights.append(query_tf * self.__bm25_idf(token))
+
+        columns, scores = matrix.top_k(
+            np.array(query_rows, dtype=np.int64),
+            np.array(query_terms, dtype=np.int64),
+            np.array(query_weights),
+            len(queries),
+            limit,
+        )
+        results = []
+        for row_columns, row_scores in zip(columns, scores):
+            row_results = []
+            for column, score in zip(row_columns.tolist(), row_scores.tolist()):
+                if score <= 0:
+                    break
+                doc = matrix.document(column)
+                row_results.append(
+                    format_search_result(
+                        doc_id=doc["id"],
+                        title=doc["title"],
+                        document=doc["description"],
+                        score=score,
+                    )
+                )
+            results.append(row_results)
+        return results
+
+    def phrase_search(
+            self,
+            phrase: str,
+            limit: int = DEFAULT_SEARCH_LIMIT,
+            window: Optional[int] = None,
+    ) -> list[dict]:
+        if not self.has_positions:
+            raise ValueError("phrase queries need an index built with positions")
+        query = f'"{phrase}"' if window is None else f'"{phrase}"~{window}'
+        return self.bm25_search(query, limit)
+
+
+class BM25Matrix:
+    """Term x doc matrix of BM25 saturations over the live documents.
+
+    Stored CSR by term (the CSC layout of a doc x term matrix): the columns
+    and weights of term t are columns[term_starts[t]:term_starts[t + 1]].
+    IDF is left to the query side, so query x matrix gives BM25 scores.
+    """
+
+    def __init__(
+            self,
+            vocabulary: dict[str, int],
+            term_starts: np.ndarray,
+            columns: np.ndarray,
+            weights: np.ndarray,
+            segments: list[IndexSegment],
+            column_segments: np.ndarray,
+            column_ordinals: np.ndarray,
+    ) -> None:
+        self.vocabulary = vocabulary
+        self.term_starts = term_starts
+        self.columns = columns
+        self.weights = weights
+        self.segments = segments
+        self.column_segments = column_segments
+        self.column_ordinals = column_ordinals
+        self.doc_ids = np.concatenate(
+            [np.empty(0, dtype=np.int64)]
+            + [segment.doc_ids[segment.live_ordinals()] for segment in segments]
+        )
+
+    @classmethod
+    def from_segments(
+            cls,
+            segments: list[IndexSegment],
+            avg_doc_length: float,
+            k1: float = BM25_K1,
+            b: float = BM25_B,
+    ) -> "BM25Matrix":
+        terms = []
+        for term in heapq.merge(*(list(segment.terms) for segment in segments)):
+            if not terms or terms[-1] != term:
+                terms.append(term)
+        vocabulary = {term: i for i, term in enumerate(terms)}
+
+        posting_terms, posting_columns, posting_weights = [], [], []
+        column_segments, column_ordinals = [], []
+        first_column = 0
+        for segment_index, segment in enumerate(segments):
+            live = segment.live_ordinals()
+            column_map = np.full(len(segment.doc_ids), -1, dtype=np.int64)
+            column_map[live] = first_column + np.arange(len(live))
+            column_segments.append(np.full(len(live), segment_index))
+            column_ordinals.append(live)
+            first_column += len(live)
+
+            doc_ordinals, tfs, _ = segment.decode_all()
+            segment_term_ids = np.array(
+                [vocabulary[term] for term in segment.terms], dtype=np.int64
+            )
+            columns = column_map[doc_ordinals]
+            keep = columns >= 0
+            posting_terms.append(np.repeat(segment_term_ids, segment.doc_freqs)[keep])
+            posting_columns.append(columns[keep])
+            posting_weights.append(
+                bm25_saturation(
+                    tfs[keep],
+                    segment.doc_lengths[doc_ordinals[keep]],
+                    avg_doc_length,
+                    k1,
+                    b,
+                )
+            )
+
+        posting_terms = np.concatenate([np.empty(0, dtype=np.int64), *posting_terms])
+        order = np.argsort(posting_terms, kind="stable")
+        term_starts = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(posting_terms, minlength=len(terms)), out=term_starts[1:])
+        return cls(
+            vocabulary,
+            term_starts,
+            np.concatenate([np.empty(0, dtype=np.int64), *posting_columns])[order],
+            np.concatenate([np.empty(0), *posting_weights])[order],
+            segments,
+            np.concatenate([np.empty(0, dtype=np.int64), *column_segments]),
+            np.concatenate([np.empty(0, dtype=np.int64), *column_ordinals]),
+        )
+
+    def document(self, column: int) -> dict:
+        segment = self.segments[self.column_segments[column]]
+        return segment.docmap.document(self.column_ordinals[column])
+
+    def top_k(
+            self,
+            query_rows: np.ndarray,
+            query_terms: np.ndarray,
+            query_weights: np.ndarray,
+            query_count: int,
+            limit: int,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Columns and scores of the best `limit` docs for each query row.
+
+        The query matrix is given as COO triplets. Rows are scored in blocks
+        of at most BM25_BATCH_CELLS dense scores; within each row results are
+        sorted by score, then doc id, like `InvertedIndex.bm25_search`.
+        """
+        doc_count = len(self.doc_ids)
+        limit = min(limit, doc_count)
+        columns = np.empty((query_count, limit), dtype=np.int64)
+        scores = np.empty((query_count, limit))
+        if limit == 0:
+            return columns, scores
+        rows_per_block = max(1, BM25_BATCH_CELLS // max(doc_count, 1))
+        for first_row in range(0, query_count, rows_per_block):
+            block_rows = min(rows_per_block, query_count - first_row)
+            in_block = (query_rows >= first_row) & (query_rows < first_row + block_rows)
+            rows = query_rows[in_block] - first_row
+            terms = query_terms[in_block]
+            # Sparse x sparse: every query nonzero expands into its term's
+            # postings, and products for the same (row, doc) are summed.
+            lengths = self.term_starts[terms + 1] - self.term_starts[terms]
+            postings = np.arange(int(lengths.sum())) + np.repeat(
+                self.term_starts[terms] - (np.cumsum(lengths) - lengths), lengths
+            )
+            cells = np.repeat(rows, lengths) * doc_count + self.columns[postings]
+            products = self.weights[postings] * np.repeat(
+                query_weights[in_block], lengths
+            )
+            block_scores = np.bincount(
+                cells, weights=products, minlength=block_rows * doc_count
+            ).reshape(block_rows, doc_count)
+
+            top = np.argpartition(-block_scores, limit - 1, axis=1)[:, :limit]
+            kth_scores = np.take_along_axis(block_scores, top, axis=1).min(axis=1)
+            for i, (row_scores, kth_score) in enumerate(zip(block_scores, kth_scores)):
+                # argpartition picks arbitrary docs among those tied with the
+                # k-th score, so take all of them and keep the lowest doc ids.
+                # Zero scores are not matches, and callers drop them.
+                if kth_score > 0:
+                    candidates = np.flatnonzero(row_scores >= kth_score)
+                else:
+                    candidates = np.union1d(np.flatnonzero(row_scores > 0), top[i])
+                order = np.lexsort(
+                    (self.doc_ids[candidates], -row_scores[candidates])
+                )[:limit]
+                columns[first_row + i] = candidates[order]
+                scores[first_row + i] = row_scores[candidates[order]]
+        return columns, scores
+
+
+class LiveDocuments(Mapping):
+    """Doc id -> document view over the live documents of an index."""
+
+    def __init__(self, index: InvertedIndex) -> None:
+        self.index = index
+
+    def __getitem__(self, doc_id: int) -> dict:
+        for segment in reversed(self.index.segments):
+            ordinal = segment.ordinal(doc_id)
+            if ordinal is not None:
+                return segment.docmap.document(ordinal)
+        raise KeyError(doc_id)
+
+    def __iter__(self) -> Iterator[int]:
+        for segment in self.index.segments:
+            yield from segment.doc_ids[segment.live_ordinals()].tolist()
+
+    def __len__(self) -> int:
+        return self.index.doc_count
+
+
+def bm25_saturation(
+        tf: int,
+        doc_length: int,
+        avg_doc_length: float,
+        k1: float = BM25_K1,
+        b: float = BM25_B,
+) -> float:
+    if avg_doc_length > 0:
+        length_norm = 1 - b + b * (doc_length / avg_doc_length)
+    else:
+        length_norm = 1
+    return (tf * (k1 + 1)) / (tf + k1 * length_norm)
+
+
+class IndexShard(NamedTuple):
+    """Uncompressed postings of a contiguous range of documents, by term."""
+
+    terms: list[str]
+    doc_freqs: np.ndarray
+    doc_ordinals: np.ndarray
+    tfs: np.ndarray
+    doc_lengths: np.ndarray
+    # Word positions of each posting (tf of them), concatenated, if indexed.
+    positions: Optional[np.ndarray] = None
+
+
+def build_index_shard(
+        texts: list[str], first_ordinal: int, positions: bool = False
+) -> IndexShard:
+    term_postings: dict[str, list[int]] = defaultdict(list)
+    term_tfs: dict[str, list[int]] = defaultdict(list)
+    term_positions: dict[str, list[int]] = defaultdict(list)
+    doc_lengths = []
+    for ordinal, text in enumerate(texts, start=first_ordinal):
+        if positions:
+            tokens = tokenize_with_positions(text)
+            occurrences = defaultdict(list)
+            for token, position in tokens:
+                occurrences[token].append(position)
+            for token, token_positions in occurrences.items():
+                term_positions[token].extend(token_positions)
+            counts = {token: len(p) for token, p in occurrences.items()}
+        else:
+            tokens = tokenize_text(text)
+            counts = Counter(tokens)
+        for token, tf in counts.items():
+            term_postings[token].append(ordinal)
+            term_tfs[token].append(tf)
+        doc_lengths.append(len(tokens))
+
+    terms = sorted(term_postings)
+    return IndexShard(
+        terms=terms,
+        doc_freqs=np.array([len(term_postings[t]) for t in terms], dtype=np.int32),
+        doc_ordinals=np.fromiter(
+            (d for t in terms for d in term_postings[t]), dtype=np.int64
+        ),
+        tfs=np.fromiter((tf for t in terms for tf in term_tfs[t]), dtype=np.int64),
+        doc_lengths=np.array(doc_lengths, dtype=np.int32),
+        positions=(
+            np.fromiter((p for t in terms for p in term_positions[t]), dtype=np.int64)
+            if positions
+            else None
+        ),
+    )
+
+
+def merge_index_shards(shards: list[IndexShard]) -> IndexShard:
+    """K-way merge of shards covering consecutive document ranges, in order."""
+    terms = []
+    for term in heapq.merge(*(shard.terms for shard in shards)):
+        if not terms or terms[-1] != term:
+            terms.append(term)
+    term_ids = {term: i for i, term in enumerate(terms)}
+
+    shard_term_ids = []
+    doc_freqs = np.zeros(len(terms), dtype=np.int32)
+    for shard in shards:
+        ids = np.array([term_ids[term] for term in shard.terms], dtype=np.int64)
+        doc_freqs[ids] += shard.doc_freqs
+        shard_term_ids.append(ids)
+
+    # Each shard's postings for a term go right after the earlier shards'.
+    next_slots = np.cumsum(doc_freqs, dtype=np.int64) - doc_freqs
+    doc_ordinals = np.empty(int(doc_freqs.sum()), dtype=np.int64)
+    tfs = np.empty(len(doc_ordinals), dtype=np.int64)
+    shard_destinations = []
+    for shard, ids in zip(shards, shard_term_ids):
+        shard_term_starts = np.cumsum(shard.doc_freqs, dtype=np.int64) - shard.doc_freqs
+        destinations = np.repeat(next_slots[ids] - shard_term_starts, shard.doc_freqs)
+        destinations += np.arange(len(shard.doc_ordinals))
+        doc_ordinals[destinations] = shard.doc_ordinals
+        tfs[destinations] = shard.tfs
+        next_slots[ids] += shard.doc_freqs
+        shard_destinations.append(destinations)
+
+    positions = None
+    if shards and all(shard.positions is not None for shard in shards):
+        # Positions move with their postings, tf values at a time.
+        position_starts = np.cumsum(tfs) - tfs
+        positions = np.empty(int(tfs.sum()), dtype=np.int64)
+        for shard, destinations in zip(shards, shard_destinations):
+            shard_position_starts = np.cumsum(shard.tfs) - shard.tfs
+            position_destinations = np.repeat(
+                position_starts[destinations] - shard_position_starts, shard.tfs
+            )
+            position_destinations += np.arange(len(shard.positions))
+            positions[position_destinations] = shard.positions
+
+    doc_lengths = np.concatenate(
+        [shard.doc_lengths for shard in shards] or [np.empty(0, dtype=np.int32)]
+    )
+    return IndexShard(terms, doc_freqs, doc_ordinals, tfs, doc_lengths, positions)
+
+
+def merge_segments(name: str, segments: list[IndexSegment]) -> IndexSegment:
+    """Merge the live documents of segments into one, without re-tokenizing.
+
+    Postings are decoded, remapped to the merged doc ordinals and re-sorted by
+    (term, ordinal); terms whose documents were all deleted are dropped.
+    """
+    terms = []
+    for term in heapq.merge(*(list(segment.terms) for segment in segments)):
+        if not terms or terms[-1] != term:
+            terms.append(term)
+    term_ids = {term: i for i, term in enumerate(terms)}
+
+    doc_ids, doc_lengths, doc_hashes, records, record_lengths = [], [], [], [], []
+    for segment in segments:
+        live = segment.live_ordinals()
+        doc_ids.append(segment.doc_ids[live])
+        doc_lengths.append(segment.doc_lengths[live])
+        doc_hashes.append(segment.doc_hashes[live])
+        offsets = segment.docmap.offsets
+        records.append(
+            gather_slices(segment.docmap.data, offsets[live], offsets[live + 1])
+        )
+        record_lengths.append(offsets[live + 1] - offsets[live])
+    doc_ids = np.concatenate([np.empty(0, dtype=np.int64), *doc_ids])
+    order = np.argsort(doc_ids, kind="stable")
+    new_ordinals = np.empty(len(order), dtype=np.int64)
+    new_ordinals[order] = np.arange(len(order))
+
+    with_positions = all(segment.has_positions for segment in segments)
+    posting_terms, posting_ordinals, posting_tfs, posting_positions = [], [], [], []
+    first_ordinal = 0
+    for segment in segments:
+        # Segment ordinal -> merged ordinal, -1 for tombstoned documents.
+        ordinal_map = np.full(len(segment.doc_ids), -1, dtype=np.int64)
+        live = segment.live_ordinals()
+        ordinal_map[live] = new_ordinals[first_ordinal : first_ordinal + len(live)]
+        first_ordinal += len(live)
+
+        doc_ordinals, tfs, positions = segment.decode_all()
+        segment_term_ids = np.array(
+            [term_ids[term] for term in segment.terms], dtype=np.int64
+        )
+        merged_ordinals = ordinal_map[doc_ordinals]
+        keep = merged_ordinals >= 0
+        posting_terms.append(np.repeat(segment_term_ids, segment.doc_freqs)[keep])
+        posting_ordinals.append(merged_ordinals[keep])
+        posting_tfs.append(tfs[keep])
+        if with_positions:
+            posting_positions.append(positions[np.repeat(keep, tfs)])
+    posting_terms = np.concatenate([np.empty(0, dtype=np.int64), *posting_terms])
+    posting_ordinals = np.concatenate([np.empty(0, dtype=np.int64), *posting_ordinals])
+    posting_tfs = np.concatenate([np.empty(0, dtype=np.int64), *posting_tfs])
+    posting_order = np.lexsort((posting_ordinals, posting_terms))
+    positions = None
+    if with_positions:
+        position_starts = np.cumsum(posting_tfs) - posting_tfs
+        positions = gather_slices(
+            np.concatenate([np.empty(0, dtype=np.int64), *posting_positions]),
+            position_starts[posting_order],
+            position_starts[posting_order] + posting_tfs[posting_order],
+        )
+
+    doc_freqs = np.bincount(posting_terms, minlength=len(terms)).astype(np.int32)
+    present = doc_freqs > 0
+
+    record_lengths = np.concatenate([np.empty(0, dtype=np.int64), *record_lengths])
+    record_starts = np.cumsum(record_lengths) - record_lengths
+    data = np.concatenate([np.empty(0, dtype=np.uint8), *records])
+    document_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(record_lengths[order], out=document_offsets[1:])
+    docmap = DocumentStore(
+        doc_ids[order],
+        gather_slices(
+            data, record_starts[order], record_starts[order] + record_lengths[order]
+        ),
+        document_offsets,
+    )
+
+    return IndexSegment.from_postings(
+        name,
+        docmap,
+        np.concatenate([np.empty(0, dtype=np.uint64), *doc_hashes])[order],
+        IndexShard(
+            terms=[term for term, keep in zip(terms, present.tolist()) if keep],
+            doc_freqs=doc_freqs[present],
+            doc_ordinals=posting_ordinals[posting_order],
+            tfs=posting_tfs[posting_order],
+            doc_lengths=np.concatenate(
+                [np.empty(0, dtype=np.int32), *doc_lengths]
+            )[order],
+            positions=positions,
+        ),
+    )
+
+
+def document_hash(doc: dict) -> int:
+    encoded = json.dumps(doc, sort_keys=True).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(encoded, digest_size=8).digest(), "little")
+
+
+def worker_pool(workers: int) -> AbstractContextManager[Optional[Executor]]:
+    """A process pool of `workers` to share across segment builds, or None."""
+    if workers <= 1:
+        return nullcontext()
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def _unique_by_id(movies: Iterable[dict]) -> list[dict]:
+    """Last version of every movie, sorted by id."""
+    return sorted({m["id"]: m for m in movies}.values(), key=lambda m: m["id"])
+
+
+def _new_segment_name() -> str:
+    return f"segment_{uuid.uuid4().hex[:12]}"
+
 
-def build_command() -> None:
+def _min_cover_spans(
+        docs: np.ndarray, positions: np.ndarray, terms: np.ndarray, term_count: int
+) -> np.ndarray:
+    """Fewest consecutive words that hold all terms, for each document.
+
+    Takes parallel occurrence arrays and returns one span per document, in
+    ascending doc order. Every document must contain all `term_count` terms.
+    """
+    order = np.lexsort((positions, docs))
+    docs = docs[order]
+    positions = positions[order].tolist()
+    terms = terms[order].tolist()
+    bounds = np.flatnonzero(np.diff(docs, prepend=-1, append=-1)).tolist()
+    spans = np.empty(len(bounds) - 1, dtype=np.int64)
+    for doc, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        counts = [0] * term_count
+        covered = 0
+        left = start
+        best = math.inf
+        for right in range(start, end):
+            if counts[terms[right]] == 0:
+                covered += 1
+            counts[terms[right]] += 1
+            while covered == term_count:
+                best = min(best, positions[right] - positions[left] + 1)
+                counts[terms[left]] -= 1
+                if counts[terms[left]] == 0:
+                    covered -= 1
+                left += 1
+        spans[doc] = best
+    return spans
+
+
+def _round_up_float32(values: np.ndarray) -> np.ndarray:
+    rounded = np.asarray(values, dtype=np.float32)
+    return np.where(
+        rounded < values, np.nextafter(rounded, np.float32(np.inf)), rounded
+    ).astype(np.float32)
+
+
+def _deep_sizeof(obj, seen: Optional[set] = None) -> int:
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += _deep_sizeof(key, seen) + _deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += _deep_sizeof(item, seen)
+    return size
+
+
+def build_command(
+        workers: int = 1,
+        batch_size: int = INGEST_BATCH_SIZE,
+        positions: bool = False,
+) -> None:
     idx = InvertedIndex()
-    idx.build()
+    idx.build(workers, batch_size, positions)
     idx.save()
 
 
+def sync_command(workers: int = 1) -> dict:
+    idx = InvertedIndex()
+    idx.load()
+    changes = idx.sync(iter_movies(), workers=workers)
+    idx.wait_for_merge()
+    return changes
+
+
+def delete_command(doc_ids: list[int]) -> None:
+    idx = InvertedIndex()
+    idx.load()
+    idx.delete_documents(doc_ids)
+    idx.wait_for_merge()
+
+
+def merge_command() -> None:
+    idx = InvertedIndex()
+    idx.load()
+    idx.merge()
+
+
+def segments_command() -> list[dict]:
+    idx = InvertedIndex()
+    idx.load()
+    return [
+        {
+            "name": segment.name,
+            "documents": len(segment.doc_ids),
+            "deleted": len(segment.deleted),
+            "terms": len(segment.terms),
+        }
+        for segment in idx.segments
+    ]
+
+
 def search_command(query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> list[dict]:
     idx = InvertedIndex()
     idx.load()
@@ -174,29 +1688,66 @@ def search_command(query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> list[dict]:
     return results
 
 
+class TextAnalyzer:
+    """Lowercase, strip punctuation, drop stop words and stem.
+
+    The stop word set, stemmer and punctuation table are built once, and
+    stems are memoised because catalog text repeats the same words a lot.
+    """
+
+    def __init__(
+            self,
+            stopwords: Optional[Iterable[str]] = None,
+            stem_cache_size: int = STEM_CACHE_SIZE,
+    ) -> None:
+        if stopwords is None:
+            stopwords = load_stopwords()
+        self.stopwords = frozenset(stopwords)
+        self.stemmer = PorterStemmer()
+        self.stem = lru_cache(maxsize=stem_cache_size)(self.stemmer.stem)
+
+    def tokenize(self, text: str) -> list[str]:
+        stopwords = self.stopwords
+        stem = self.stem
+        words = preprocess_text(text).split()
+        return [stem(word) for word in words if word not in stopwords]
+
+    def tokenize_many(self, texts: Iterable[str]) -> list[list[str]]:
+        return [self.tokenize(text) for text in texts]
+
+    def tokenize_with_positions(self, text: str) -> list[tuple[str, int]]:
+        """Tokens with their word position; stop words keep their slots."""
+        stopwords = self.stopwords
+        stem = self.stem
+        words = preprocess_text(text).split()
+        return [
+            (stem(word), position)
+            for position, word in enumerate(words)
+            if word not in stopwords
+        ]
+
+
+@lru_cache(maxsize=1)
+def get_analyzer() -> TextAnalyzer:
+    return TextAnalyzer()
+
+
 def preprocess_text(text: str) -> str:
     text = text.lower()
-    text = text.translate(str.maketrans("", "", string.punctuation))
+    text = text.translate(PUNCTUATION_TABLE)
     return text
 
 
 def tokenize_text(text: str) -> list[str]:
-    text = preprocess_text(text)
-    tokens = text.split()
-    valid_tokens = []
-    for token in tokens:
-        if token:
-            valid_tokens.append(token)
-    stop_words = load_stopwords()
-    filtered_words = []
-    for word in valid_tokens:
-        if word not in stop_words:
-            filtered_words.append(word)
-    stemmer = PorterStemmer()
-    stemmed_words = []
-    for word in filtered_words:
-        stemmed_words.append(stemmer.stem(word))
-    return stemmed_words
+    return get_analyzer().tokenize(text)
+
+
+def tokenize_many(texts: Iterable[str]) -> list[list[str]]:
+    return get_analyzer().tokenize_many(texts)
+
+
+def tokenize_with_positions(text: str) -> list[tuple[str, int]]:
+    return get_analyzer().tokenize_with_positions(text)
 
 
 def tf_command(doc_id: int, term: str) -> int:
@@ -231,7 +1782,105 @@ def tfidf_command(doc_id: int, term: str) -> float:
     return idx.get_tf_idf(doc_id, term)
 
 
-def bm25search_command(query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> list[dict]:
+def bm25search_command(
+        query: str, limit: int = DEFAULT_SEARCH_LIMIT, proximity: bool = False
+) -> list[dict]:
     idx = InvertedIndex()
     idx.load()
-    return idx.bm25_search(query, limit)
+    return idx.bm25_search(query, limit, proximity)
+
+
+def bm25_batch_command(
+        queries: list[str], limit: int = DEFAULT_SEARCH_LIMIT, compare: bool = False
+) -> dict:
+    idx = InvertedIndex()
+    idx.load()
+    start = time.perf_counter()
+    results = idx.bm25_search_many(queries, limit)
+    batch_seconds = time.perf_counter() - start
+
+    loop_seconds = None
+    if compare:
+        start = time.perf_counter()
+        for query in queries:
+            idx.bm25_search(query, limit)
+        loop_seconds = time.perf_counter() - start
+
+    return {
+        "results": results,
+        "batch_seconds": batch_seconds,
+        "loop_seconds": loop_seconds,
+    }
+
+
+def phrase_command(
+        phrase: str, window: Optional[int] = None, limit: int = DEFAULT_SEARCH_LIMIT
+) -> list[dict]:
+    idx = InvertedIndex()
+    idx.load()
+    return idx.phrase_search(phrase, limit, window)
+
+
+def index_memory_command() -> dict:
+    idx = InvertedIndex()
+    idx.load()
+
+    # Rebuild the previous dict/set/Counter layout from the same postings.
+    index = defaultdict(set)
+    term_frequencies = defaultdict(Counter)
+    doc_lengths = {}
+    for segment in idx.segments:
+        live = segment.live_ordinals()
+        doc_lengths.update(
+            zip(segment.doc_ids[live].tolist(), segment.doc_lengths[live].tolist())
+        )
+        for term, doc_ordinals, tfs in segment.iter_postings():
+            for doc_id, tf in zip(segment.doc_ids[doc_ordinals].tolist(), tfs.tolist()):
+                index[term].add(doc_id)
+                term_frequencies[doc_id][term] = tf
+    seen = set()
+    legacy_bytes = (
+        _deep_sizeof(index, seen)
+        + _deep_sizeof(term_frequencies, seen)
+        + _deep_sizeof(doc_lengths, seen)
+    )
+
+    return {
+        "documents": idx.doc_count,
+        "segments": len(idx.segments),
+        "terms": len(index),
+        "postings": sum(len(doc_ids) for doc_ids in index.values()),
+        "legacy_bytes": legacy_bytes,
+        "compact_bytes": sum(segment.compact_nbytes() for segment in idx.segments),
+    }
+
+
+def tokenizer_benchmark_command(limit: Optional[int] = None) -> dict:
+    texts = [f"{m['title']} {m['description']}" for m in load_movies()[:limit]]
+
+    def uncached_tokenize(text: str) -> list[str]:
+        # The previous per-call pipeline: stop words re-read from disk and
+        # checked against a list, a new stemmer and punctuation table per call.
+        text = text.lower().translate(str.maketrans("", "", string.punctuation))
+        stop_words = load_stopwords()
+        stemmer = PorterStemmer()
+        return [stemmer.stem(word) for word in text.split() if word not in stop_words]
+
+    start = time.perf_counter()
+    token_count = sum(len(uncached_tokenize(text)) for text in texts)
+    uncached_seconds = time.perf_counter() - start
+
+    analyzer = TextAnalyzer()
+    start = time.perf_counter()
+    analyzer.tokenize_many(texts)
+    analyzer_seconds = time.perf_counter() - start
+    cache_info = analyzer.stem.cache_info()
+    stem_lookups = max(cache_info.hits + cache_info.misses, 1)
+
+    return {
+        "documents": len(texts),
+        "tokens": token_count,
+        "uncached_tokens_per_second": token_count / uncached_seconds,
+        "analyzer_tokens_per_second": token_count / analyzer_seconds,
+        "stem_cache_hit_rate": cache_info.hits / stem_lookups,
+    }
@@ -0,0 +1,68 @@
+import os
+import re
+from typing import Optional
+
+import numpy as np
+
+from .index_store import MANIFEST_FILE, current_manifest, write_json_atomic
+from .search_utils import MODEL_CACHE_DIR
+
+MODEL_ARTIFACTS_FORMAT = "model-artifacts"
+MODEL_ARTIFACTS_FORMAT_VERSION = 1
+
+
+def model_slug(model_name: str) -> str:
+    return re.sub(r"[^\w.-]+", "_", model_name)
+
+
+class ModelArtifacts:
+    """Where the embeddings of one model and everything built from them live.
+
+    Each model gets its own directory under MODEL_CACHE_DIR, so vectors of
+    different models sit side by side instead of overwriting each other.
+    manifest.json there records the model id and its embedding dimension;
+    a file whose vectors are not that wide was made by something else and
+    is treated as missing.
+    """
+
+    def __init__(self, model_name: str, directory: Optional[str] = None) -> None:
+        self.model_name = model_name
+        self.directory = os.path.join(
+            directory or MODEL_CACHE_DIR, model_slug(model_name)
+        )
+        self.movie_embeddings = self.path("movie_embeddings.npy")
+        self.chunk_embeddings = self.path("chunk_embeddings.npy")
+        self.chunk_metadata = self.path("chunk_metadata.npy")
+        self.chunk_build = self.path("chunk_build")
+        self.chunk_ann = self.path("chunk_hnsw")
+        self.chunk_ivfpq = self.path("chunk_ivfpq")
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @property
+    def dimensions(self) -> Optional[int]:
+        """Embedding dimension of the model, once something has been built."""
+        manifest = current_manifest(
+            self.directory, MODEL_ARTIFACTS_FORMAT, MODEL_ARTIFACTS_FORMAT_VERSION
+        )
+        if manifest is None or manifest["model"] != self.model_name:
+            return None
+        return manifest["dimensions"]
+
+    def matches(self, vectors: np.ndarray) -> bool:
+        """Whether `vectors` have the dimension recorded for this model."""
+        return vectors.shape[1] == self.dimensions
+
+    def record(self, vectors: np.ndarray) -> None:
+        """Record the dimension of freshly built `vectors` in the manifest."""
+        os.makedirs(self.directory, exist_ok=True)
+        write_json_atomic(
+            os.path.join(self.directory, MANIFEST_FILE),
+            {
+                "format": MODEL_ARTIFACTS_FORMAT,
+                "version": MODEL_ARTIFACTS_FORMAT_VERSION,
+                "model": self.model_name,
+                "dimensions": int(vectors.shape[1]),
+            },
+        )
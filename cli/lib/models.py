@@ -0,0 +1,109 @@
+import resource
+import threading
+import time
+from collections.abc import Callable, Iterable
+from typing import Any, Optional
+
+SENTENCE_TRANSFORMER = "sentence-transformer"
+CROSS_ENCODER = "cross-encoder"
+
+
+def _load_sentence_transformer(name: str) -> Any:
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(name)
+
+
+def _load_cross_encoder(name: str) -> Any:
+    from sentence_transformers import CrossEncoder
+
+    return CrossEncoder(name)
+
+
+MODEL_LOADERS: dict[str, Callable[[str], Any]] = {
+    SENTENCE_TRANSFORMER: _load_sentence_transformer,
+    CROSS_ENCODER: _load_cross_encoder,
+}
+
+_models: dict[tuple[str, str], Any] = {}
+_load_seconds: dict[tuple[str, str], float] = {}
+_lock = threading.Lock()
+
+
+def get_model(kind: str, name: str) -> Any:
+    """The process-wide instance of a model, loaded on first use.
+
+    Neither sentence_transformers nor the weights are imported until some
+    component actually needs the model, and every later caller shares it.
+    """
+    key = (kind, name)
+    model = _models.get(key)
+    if model is not None:
+        return model
+    if kind not in MODEL_LOADERS:
+        raise ValueError(
+            f"unknown model kind {kind!r}, expected one of {', '.join(MODEL_LOADERS)}"
+        )
+    with _lock:
+        if key not in _models:
+            start = time.perf_counter()
+            _models[key] = MODEL_LOADERS[kind](name)
+            _load_seconds[key] = time.perf_counter() - start
+        return _models[key]
+
+
+def sentence_transformer(name: str) -> Any:
+    return get_model(SENTENCE_TRANSFORMER, name)
+
+
+def cross_encoder(name: str) -> Any:
+    return get_model(CROSS_ENCODER, name)
+
+
+def warm_up(
+        models: Iterable[tuple[str, str]], background: bool = False
+) -> Optional[threading.Thread]:
+    """Load (kind, name) models ahead of the first query.
+
+    With `background` they load in a daemon thread, which is returned, so
+    a process can start serving while the weights are read.
+    """
+    models = list(models)
+
+    def load() -> None:
+        for kind, name in models:
+            get_model(kind, name)
+
+    if not background:
+        load()
+        return None
+    thread = threading.Thread(target=load, name="model-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def model_stats() -> list[dict]:
+    """Load time and parameter memory of every model loaded so far."""
+    stats = []
+    for (kind, name), model in list(_models.items()):
+        stats.append(
+            {
+                "kind": kind,
+                "name": name,
+                "load_seconds": _load_seconds[(kind, name)],
+                "parameter_bytes": parameter_bytes(model),
+            }
+        )
+    return stats
+
+
+def parameter_bytes(model: Any) -> int:
+    module = model if hasattr(model, "parameters") else getattr(model, "model", None)
+    if module is None or not hasattr(module, "parameters"):
+        return 0
+    return sum(p.numel() * p.element_size() for p in module.parameters())
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of this process (ru_maxrss is KiB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -1,15 +1,23 @@
 import math
+import numpy as np
 from PIL import Image
-from sentence_transformers import SentenceTransformer
 
-from .semantic_search import cosine_similarity
-from .search_utils import load_movies
+from .autotune import encode_settings
+from .models import sentence_transformer
+from .semantic_search import encode_batches
+from .search_utils import INGEST_BATCH_SIZE, load_movies
+from .vectors import normalize_embeddings, top_k_indices
 
 class MultimodalSearch:
     def __init__(self, model_name="clip-ViT-B-32", movies: list[dict] = None):
-        self.sentence_tranformer = SentenceTransformer(model_name)
-        self.texts = [f"{doc['title']}: {doc['description']}" for doc in movies]
-        self.text_embeddings = self.sentence_tranformer.encode(self.texts, show_progress_bar=True)
+        self.sentence_tranformer = sentence_transformer(model_name)
+        encode_options = encode_settings(model_name)
+        texts = (f"{doc['title']}: {doc['description']}" for doc in movies)
+        batches = list(encode_batches(
+            self.sentence_tranformer, texts, INGEST_BATCH_SIZE, encode_options))
+        # An empty catalog yields no batches, and nothing to search.
+        self.text_embeddings = normalize_embeddings(
+            np.concatenate(batches) if batches else np.empty((0, 0), dtype=np.float32))
         self.movies = movies
 
     def embed_image(self, image_path: str):
@@ -18,11 +26,12 @@ class MultimodalSearch:
         return embedding
 
     def search_with_image(self, image_path: str):
-        img_embedding = self.embed_image(image_path)
-        img_similarities = [(movie, cosine_similarity(img_embedding, text_embedding)) for text_embedding,movie in
-                            zip(self.text_embeddings, self.movies)]
-        img_similarities.sort(key=lambda x: x[1], reverse=True)
-        return img_similarities[:5]
+        if not self.movies:
+            return []
+        img_embedding = normalize_embeddings(self.embed_image(image_path))
+        img_similarities = self.text_embeddings @ img_embedding
+        return [(self.movies[i], float(img_similarities[i]))
+                for i in top_k_indices(img_similarities, 5)]
 
 
 def verify_image_embedding(image_path: str):
@@ -0,0 +1,381 @@
+import os
+import re
+import shutil
+import zlib
+from collections.abc import Iterable, Iterator
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from .index_store import RowFile, current_manifest, load_arrays, save_array_batches
+from .postings import slice_indices
+from .search_utils import (
+    DUPLICATE_RUN_SIZE,
+    LSH_BANDS,
+    MINHASH_PERMUTATIONS,
+    NEAR_DUPLICATE_THRESHOLD,
+    SEGMENT_MERGE_FACTOR,
+    SHINGLE_SIZE,
+    STORE_MERGE_BATCH_SIZE,
+)
+
+DUPLICATE_RUN_FORMAT = "lsh-band-run"
+DUPLICATE_RUN_FORMAT_VERSION = 1
+SHINGLE_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+EMPTY_HASH = np.iinfo(np.uint32).max
+
+
+def shingle_hashes(text: str, size: int = SHINGLE_SIZE) -> np.ndarray:
+    """Distinct 64-bit hashes of the lowercased word `size`-grams of `text`.
+
+    Texts shorter than `size` words are a single shingle.
+    """
+    words = np.array(
+        [zlib.crc32(word.encode()) for word in re.findall(r"\w+", text.lower())],
+        dtype=np.uint64,
+    )
+    if len(words) == 0:
+        return words
+    size = min(size, len(words))
+    count = len(words) - size + 1
+    hashes = np.zeros(count, dtype=np.uint64)
+    for offset in range(size):
+        hashes = hashes * SHINGLE_MULTIPLIER + words[offset : offset + count]
+    return np.unique(hashes)
+
+
+class MinHasher:
+    """MinHash signatures from `permutations` multiply-shift hash functions.
+
+    The fraction of equal signature values between two texts estimates the
+    Jaccard similarity of their shingle sets. The functions come from a
+    fixed seed, so signatures made in different processes agree.
+    """
+
+    def __init__(self, permutations: int = MINHASH_PERMUTATIONS, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.multipliers = rng.integers(1, 2**63, permutations, dtype=np.uint64)
+        self.multipliers |= np.uint64(1)
+        self.offsets = rng.integers(0, 2**63, permutations, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = shingle_hashes(text)
+        if len(hashes) == 0:
+            return np.full(len(self.multipliers), EMPTY_HASH, dtype=np.uint32)
+        mixed = self.multipliers[:, None] * hashes + self.offsets[:, None]
+        return (mixed >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+    def signatures(self, texts: Iterable[str]) -> np.ndarray:
+        rows = [self.signature(text) for text in texts]
+        if not rows:
+            return np.empty((0, len(self.multipliers)), dtype=np.uint32)
+        return np.stack(rows)
+
+
+@lru_cache(maxsize=None)
+def minhasher() -> MinHasher:
+    return MinHasher()
+
+
+def estimated_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.mean(a == b))
+
+
+class BandRun(NamedTuple):
+    """Band keys of the representatives numbered `start` to `end`, sorted."""
+
+    start: int
+    end: int
+    keys: np.ndarray
+    reps: np.ndarray
+
+
+class DuplicateIndex:
+    """Representatives of near-duplicate groups, found through LSH banding.
+
+    Signatures are cut into `bands` bands; texts sharing any whole band
+    become candidates, and a candidate is a duplicate when its estimated
+    Jaccard similarity reaches `threshold`. A text joins the earliest
+    representative it is a duplicate of, and every text that matches none
+    becomes one itself, so identical inputs in the same order always give
+    the same groups, however they are batched.
+
+    Representatives are kept in `directory`: their ids and signatures are
+    appended to raw files, and the band keys of committed ones are written
+    in sorted runs of DUPLICATE_RUN_SIZE that are searched memory-mapped
+    and merged SEGMENT_MERGE_FACTOR at a time. Only the keys added since the
+    last run are held in memory, so memory does not grow with the corpus
+    and reopening the index reads no signatures.
+    """
+
+    def __init__(
+            self,
+            directory: str,
+            threshold: float = NEAR_DUPLICATE_THRESHOLD,
+            bands: int = LSH_BANDS,
+    ) -> None:
+        self.directory = directory
+        self.threshold = threshold
+        self.bands = bands
+        os.makedirs(directory, exist_ok=True)
+        self.ids = RowFile(os.path.join(directory, "ids.rows"), np.int64)
+        self.signatures = RowFile(
+            os.path.join(directory, "signatures.rows"),
+            np.uint32,
+            (MINHASH_PERMUTATIONS,),
+        )
+        ranges = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            manifest = current_manifest(
+                path, DUPLICATE_RUN_FORMAT, DUPLICATE_RUN_FORMAT_VERSION
+            )
+            if manifest is not None:
+                ranges.append((manifest["start"], manifest["end"]))
+            elif os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+        # A merge interrupted before removing its inputs leaves runs that
+        # the merged one covers; keep the longest run from each start.
+        self.runs: list[BandRun] = []
+        for start, end in sorted(ranges, key=lambda r: (r[0], -r[1])):
+            if start == (self.runs[-1].end if self.runs else 0):
+                self.runs.append(self.__load_run(start, end))
+            else:
+                shutil.rmtree(self.__run_path(start, end), ignore_errors=True)
+        self.count = min(len(self.ids), len(self.signatures))
+        self.__restore(self.count)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def add(
+            self, signatures: np.ndarray, ids: Optional[np.ndarray] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Representative id of every row, and which rows are new ones.
+
+        New representatives take the id in `ids` of their row, which must
+        be above the ids already held; by default they are numbered on from
+        `len(self)`.
+        """
+        keys = self.band_keys(signatures)
+        reps = self.__match_held(signatures, keys)
+        new = reps < 0
+        # Rows of this batch can only match representatives made from
+        # earlier rows of it, after every held one was ruled out.
+        buckets: dict[int, list[int]] = {}
+        new_rows: list[int] = []
+        for i in np.flatnonzero(new).tolist():
+            candidates = {c for key in keys[i].tolist() for c in buckets.get(key, ())}
+            for candidate in sorted(candidates):
+                similarity = estimated_similarity(
+                    signatures[new_rows[candidate]], signatures[i]
+                )
+                if similarity >= self.threshold:
+                    reps[i] = self.count + candidate
+                    new[i] = False
+                    break
+            else:
+                reps[i] = self.count + len(new_rows)
+                for key in keys[i].tolist():
+                    buckets.setdefault(key, []).append(len(new_rows))
+                new_rows.append(i)
+
+        first_rep = self.count
+        new_ids = (
+            np.arange(first_rep, first_rep + len(new_rows))
+            if ids is None
+            else np.asarray(ids, dtype=np.int64)[new_rows]
+        )
+        self.ids.append(new_ids)
+        self.signatures.append(signatures[new_rows])
+        self.count += len(new_rows)
+        self.__hold(keys[new_rows], np.arange(first_rep, self.count))
+        return np.array(self.ids.read()[reps]), new
+
+    def rewind(self, limit: int) -> None:
+        """Drop the representatives with ids from `limit` on."""
+        self.__restore(int(np.searchsorted(self.ids.read()[: self.count], limit)))
+
+    def sync(self) -> None:
+        self.ids.sync()
+        self.signatures.sync()
+
+    def commit(self, limit: int) -> None:
+        """Write runs of the representatives with ids below `limit`.
+
+        The caller has committed those, so a restart keeps them; later ones
+        can still be rewound and stay in memory. Call `sync` first.
+        """
+        committed = int(np.searchsorted(self.ids.read()[: self.count], limit))
+        self.__write_runs(committed)
+
+    def close(self) -> None:
+        self.ids.close()
+        self.signatures.close()
+
+    def band_keys(self, signatures: np.ndarray) -> np.ndarray:
+        """One 64-bit hash per band of every signature, seeded by the band."""
+        columns = np.array_split(np.arange(signatures.shape[1]), self.bands)
+        keys = np.empty((len(signatures), self.bands), dtype=np.uint64)
+        for band, band_columns in enumerate(columns):
+            key = np.full(len(signatures), band, dtype=np.uint64)
+            for column in band_columns:
+                key = key * SHINGLE_MULTIPLIER + signatures[:, column]
+            keys[:, band] = key
+        return keys
+
+    def __match_held(self, signatures: np.ndarray, keys: np.ndarray) -> np.ndarray:
+        """Earliest held representative every row is a duplicate of, or -1."""
+        no_match = np.iinfo(np.int64).max
+        best = np.full(len(signatures), no_match, dtype=np.int64)
+        if self.count:
+            held = self.signatures.read()
+            rows = np.repeat(np.arange(len(signatures)), self.bands)
+            flat_keys = keys.ravel()
+            for run_keys, run_reps in [
+                *((run.keys, run.reps) for run in self.runs),
+                (self.tail_keys, self.tail_reps),
+            ]:
+                starts = np.searchsorted(run_keys, flat_keys, side="left")
+                ends = np.searchsorted(run_keys, flat_keys, side="right")
+                pair_rows = np.repeat(rows, ends - starts)
+                if not len(pair_rows):
+                    continue
+                pair_reps = np.asarray(run_reps[slice_indices(starts, ends)])
+                similarities = (held[pair_reps] == signatures[pair_rows]).mean(axis=1)
+                similar = similarities >= self.threshold
+                np.minimum.at(best, pair_rows[similar], pair_reps[similar])
+        best[best == no_match] = -1
+        return best
+
+    def __hold(self, keys: np.ndarray, reps: np.ndarray) -> None:
+        """Insert band keys of new representatives into the in-memory tail."""
+        keys = keys.ravel()
+        reps = np.repeat(reps, self.bands)
+        order = np.argsort(keys, kind="stable")
+        positions = np.searchsorted(self.tail_keys, keys[order], side="right")
+        self.tail_keys = np.insert(self.tail_keys, positions, keys[order])
+        self.tail_reps = np.insert(self.tail_reps, positions, reps[order])
+
+    def __restore(self, count: int) -> None:
+        """Cut the index to `count` representatives and rebuild its tail."""
+        self.count = count
+        self.ids.truncate(count)
+        self.signatures.truncate(count)
+        while self.runs and self.runs[-1].end > count:
+            run = self.runs.pop()
+            shutil.rmtree(self.__run_path(run.start, run.end), ignore_errors=True)
+        start = self.runs[-1].end if self.runs else 0
+        self.tail_keys = np.empty(0, dtype=np.uint64)
+        self.tail_reps = np.empty(0, dtype=np.int64)
+        # Batch by batch, so that a rewind into a large run stays bounded.
+        for batch_start in range(start, count, DUPLICATE_RUN_SIZE):
+            batch_end = min(batch_start + DUPLICATE_RUN_SIZE, count)
+            self.__hold(
+                self.band_keys(np.array(self.signatures.read()[batch_start:batch_end])),
+                np.arange(batch_start, batch_end),
+            )
+            self.__write_runs(batch_end)
+
+    def __write_runs(self, committed: int) -> None:
+        """Move full runs of committed representatives from the tail to disk."""
+        while True:
+            start = self.runs[-1].end if self.runs else 0
+            end = start + DUPLICATE_RUN_SIZE
+            if end > committed:
+                return
+            in_run = self.tail_reps < end
+            self.runs.append(
+                self.__save_run(
+                    start, end, [(self.tail_keys[in_run], self.tail_reps[in_run])]
+                )
+            )
+            self.tail_keys = self.tail_keys[~in_run]
+            self.tail_reps = self.tail_reps[~in_run]
+            self.__maybe_merge()
+
+    def __maybe_merge(self) -> None:
+        """Merge the last SEGMENT_MERGE_FACTOR runs while they have one size.
+
+        Runs are written at one size, so they stay in descending sizes that
+        are powers of SEGMENT_MERGE_FACTOR times it, like a counter.
+        """
+        factor = SEGMENT_MERGE_FACTOR
+        while (
+                len(self.runs) >= factor
+                and len({run.end - run.start for run in self.runs[-factor:]}) == 1
+        ):
+            merged = self.runs[-factor:]
+            run = self.__save_run(
+                merged[0].start,
+                merged[-1].end,
+                merge_sorted_runs(
+                    [(run.keys, run.reps) for run in merged], STORE_MERGE_BATCH_SIZE
+                ),
+            )
+            for old in merged:
+                shutil.rmtree(self.__run_path(old.start, old.end), ignore_errors=True)
+            self.runs[-factor:] = [run]
+
+    def __save_run(
+            self,
+            start: int,
+            end: int,
+            batches: Iterable[tuple[np.ndarray, np.ndarray]],
+    ) -> BandRun:
+        save_array_batches(
+            self.__run_path(start, end),
+            {
+                "format": DUPLICATE_RUN_FORMAT,
+                "version": DUPLICATE_RUN_FORMAT_VERSION,
+                "start": start,
+                "end": end,
+            },
+            ["keys", "reps"],
+            batches,
+        )
+        return self.__load_run(start, end)
+
+    def __load_run(self, start: int, end: int) -> BandRun:
+        _, arrays = load_arrays(
+            self.__run_path(start, end),
+            DUPLICATE_RUN_FORMAT,
+            DUPLICATE_RUN_FORMAT_VERSION,
+        )
+        return BandRun(start, end, arrays["keys"], arrays["reps"])
+
+    def __run_path(self, start: int, end: int) -> str:
+        return os.path.join(self.directory, f"run_{start}_{end}")
+
+
+def merge_sorted_runs(
+        runs: list[tuple[np.ndarray, np.ndarray]], batch_size: int
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """Union of (sorted keys, values) runs, in key order, in batches.
+
+    Like `embedding_cache.merge_sorted_segments`, but keys may repeat and
+    every value is kept. Each round takes all keys up to the smallest last
+    key among the next `batch_size` keys of every run.
+    """
+    cursors = [0] * len(runs)
+    while True:
+        active = [i for i, (keys, _) in enumerate(runs) if cursors[i] < len(keys)]
+        if not active:
+            return
+        bound = min(
+            runs[i][0][min(cursors[i] + batch_size, len(runs[i][0])) - 1]
+            for i in active
+        )
+        key_parts, value_parts = [], []
+        for i in active:
+            keys, values = runs[i]
+            start = cursors[i]
+            window = keys[start : start + batch_size]
+            end = start + int(np.searchsorted(window, bound, side="right"))
+            key_parts.append(keys[start:end])
+            value_parts.append(values[start:end])
+            cursors[i] = end
+        keys = np.concatenate(key_parts)
+        order = np.argsort(keys, kind="stable")
+        yield keys[order], np.concatenate(value_parts)[order]
@@ -0,0 +1,127 @@
+from bisect import bisect_left
+from collections.abc import Sequence
+from typing import Optional
+
+import numpy as np
+
+VARBYTE_CONTINUATION = 0x80
+VARBYTE_PAYLOAD = 0x7F
+
+
+def varbyte_lengths(values: np.ndarray) -> np.ndarray:
+    """Number of bytes each non-negative integer takes in variable-byte form."""
+    remaining = np.asarray(values, dtype=np.uint64) >> np.uint64(7)
+    lengths = np.ones(len(remaining), dtype=np.int64)
+    while remaining.any():
+        lengths += remaining > 0
+        remaining >>= np.uint64(7)
+    return lengths
+
+
+def varbyte_encode(values: np.ndarray) -> np.ndarray:
+    """Encode non-negative integers as little-endian 7-bit groups.
+
+    Every byte except the last one of a value has the continuation bit set,
+    so values can be decoded without a separate length table.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if len(values) == 0:
+        return np.empty(0, dtype=np.uint8)
+    lengths = varbyte_lengths(values)
+    starts = np.cumsum(lengths) - lengths
+    byte_values = np.repeat(values, lengths)
+    byte_positions = np.arange(int(lengths.sum())) - np.repeat(starts, lengths)
+    encoded = (byte_values >> (np.uint64(7) * byte_positions.astype(np.uint64))) & (
+        np.uint64(VARBYTE_PAYLOAD)
+    )
+    encoded = encoded.astype(np.uint8)
+    encoded[byte_positions < np.repeat(lengths - 1, lengths)] |= VARBYTE_CONTINUATION
+    return encoded
+
+
+def varbyte_decode(data: np.ndarray) -> np.ndarray:
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(data < VARBYTE_CONTINUATION)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    byte_positions = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    payload = (data & VARBYTE_PAYLOAD).astype(np.int64)
+    return np.add.reduceat(payload << (7 * byte_positions), starts)
+
+
+def delta_encode(doc_ordinals: np.ndarray, term_starts: np.ndarray) -> np.ndarray:
+    """Gaps between consecutive postings, restarting at every term boundary."""
+    deltas = np.diff(doc_ordinals, prepend=0)
+    first_postings = term_starts[:-1][term_starts[:-1] < term_starts[1:]]
+    deltas[first_postings] = doc_ordinals[first_postings]
+    return deltas
+
+
+def segmented_cumsum(values: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Running sums that restart at every segment of the given lengths."""
+    running = np.cumsum(values)
+    nonempty = lengths > 0
+    starts = (np.cumsum(lengths) - lengths)[nonempty]
+    return running - np.repeat(running[starts] - values[starts], lengths[nonempty])
+
+
+def block_byte_offsets(values: np.ndarray, block_starts: np.ndarray) -> np.ndarray:
+    """Byte offset of every block in the encoding of `values`, plus the end."""
+    byte_ends = np.cumsum(varbyte_lengths(values))
+    offsets = np.zeros(len(block_starts) + 1, dtype=np.int64)
+    offsets[1:-1] = byte_ends[block_starts[1:] - 1]
+    offsets[-1] = byte_ends[-1] if len(byte_ends) else 0
+    return offsets
+
+
+def gather_slices(data: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Concatenate data[starts[i]:ends[i]] for every i."""
+    return data[slice_indices(starts, ends)]
+
+
+def slice_indices(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Concatenation of range(starts[i], ends[i]) for every i."""
+    lengths = ends - starts
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(int(lengths.sum())) + offsets
+
+
+class TermDictionary(Sequence):
+    """Sorted terms stored as one UTF-8 byte array plus offsets.
+
+    Lookups binary-search the offsets, so opening a memory-mapped dictionary
+    costs nothing and a lookup touches only O(log T) terms.
+    """
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray) -> None:
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_terms(cls, terms: list[str]) -> "TermDictionary":
+        encoded = [term.encode("utf-8") for term in terms]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(term) for term in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, term_id: int) -> str:
+        if not 0 <= term_id < len(self):
+            raise IndexError(term_id)
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return self.data[start:end].tobytes().decode("utf-8")
+
+    def lookup(self, term: str) -> Optional[int]:
+        term_id = bisect_left(self, term)
+        if term_id < len(self) and self[term_id] == term:
+            return term_id
+        return None
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + self.offsets.nbytes
@@ -3,10 +3,11 @@ import json
 
 
 from ollama import generate
-from sentence_transformers import CrossEncoder
+
+from .models import cross_encoder
 
 model = "gpt-oss:20b"
-cross_encoder = CrossEncoder("cross-encoder/ms-marco-TinyBERT-L2-v2")
+cross_encoder_model = "cross-encoder/ms-marco-TinyBERT-L2-v2"
 
 
 def llm_rerank_individual(
@@ -86,7 +87,7 @@ def cross_encoder_rerank(
     for doc in documents:
         pairs.append([query, f"{doc.get('title', '')} - {doc.get('document', '')}"])
 
-    scores = cross_encoder.predict(pairs)
+    scores = cross_encoder(cross_encoder_model).predict(pairs)
 
     for doc, score in zip(documents, scores):
         doc["crossencoder_score"] = float(score)
@@ -1,17 +1,63 @@
 import json
 import os
-from typing import Any
+from collections.abc import Iterator
+from typing import Any, Optional, TextIO
 
 DEFAULT_ALPHA = 0.5
 RRF_K = 60
 SEARCH_MULTIPLIER = 5
 
 DEFAULT_SEARCH_LIMIT = 5
+DEFAULT_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
 DOCUMENT_PREVIEW_LENGTH = 100
 SCORE_PRECISION = 3
 
 BM25_K1 = 1.5
 BM25_B = 0.75
+BM25_BLOCK_SIZE = 64
+PROXIMITY_ALPHA = 0.3
+BM25_BATCH_CELLS = 1 << 22
+SEGMENT_MERGE_FACTOR = 8
+STORE_MERGE_BATCH_SIZE = 65_536
+SEGMENT_MAX_DELETED_RATIO = 0.3
+
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 100
+HNSW_EF_SEARCH = 64
+IVF_LISTS = 256
+IVF_PROBES = 16
+# Upper bound; the default is the largest divisor of the dimension up to it.
+PQ_SUBVECTORS = 48
+PQ_CENTROIDS = 256
+IVF_TRAIN_SAMPLE = 65_536
+IVFPQ_RERANK = 100
+KMEANS_ITERATIONS = 20
+QUANTIZED_RESCORE = 300
+CASCADE_SHORTLIST = 100
+VECTOR_BATCH_CELLS = 1 << 22
+SOFTMAX_POOLING_TEMPERATURE = 0.05
+ANN_BENCHMARK_SAMPLE = 200
+AUTOTUNE_SAMPLE = 256
+AUTOTUNE_BATCH_SIZES = (16, 32, 64, 128)
+AUTOTUNE_MIN_SIMILARITY = 0.99
+
+SHINGLE_SIZE = 3
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 8
+NEAR_DUPLICATE_THRESHOLD = 0.9
+# Representatives per sorted run of LSH band keys on disk.
+DUPLICATE_RUN_SIZE = 65_536
+
+STEM_CACHE_SIZE = 100_000
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_TTL = 3600.0
+QUERY_CACHE_FLUSH_SIZE = 64
+
+INGEST_BATCH_SIZE = 10_000
+EMBED_BATCH_SIZE = 512
+CHUNK_TASK_SIZE = 256
+CHUNK_WORKERS = 2
+JSON_READ_SIZE = 1 << 20
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 DATA_PATH = os.path.join(PROJECT_ROOT, "data", "movies.json")
@@ -24,15 +70,92 @@ DEFAULT_CHUNK_SIZE = 200
 DEFAULT_CHUNK_OVERLAP = 1
 DEFAULT_SEMANTIC_CHUNK_SIZE = 4
 
-MOVIE_EMBEDDINGS_PATH = os.path.join(CACHE_DIR, "movie_embeddings.npy")
-CHUNK_EMBEDDINGS_PATH = os.path.join(CACHE_DIR, "chunk_embeddings.npy")
-CHUNK_METADATA_PATH = os.path.join(CACHE_DIR, "chunk_metadata.json")
+MODEL_CACHE_DIR = os.path.join(CACHE_DIR, "models")
+EMBEDDING_STORE_DIR = os.path.join(CACHE_DIR, "embedding_store")
+QUERY_EMBEDDINGS_DIR = os.path.join(CACHE_DIR, "query_embeddings")
 
 
 def load_movies() -> list[dict]:
-    with open(DATA_PATH, "r") as f:
-        data = json.load(f)
-    return data["movies"]
+    return list(iter_movies())
+
+
+def iter_movies(path: Optional[str] = None) -> Iterator[dict]:
+    """Yield movies one at a time from a JSON or JSON Lines catalog.
+
+    A `.jsonl` file holds one movie per line. Any other file is the usual
+    {"movies": [...]} document, which is parsed incrementally so that only a
+    read buffer and the current movie are held in memory.
+    """
+    path = path or DATA_PATH
+    with open(path, "r") as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from iter_json_array(f, "movies")
+
+
+def iter_json_array(f: TextIO, key: str) -> Iterator[Any]:
+    """Yield the items of the `key` list of a JSON object (or of a bare list)."""
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+
+    def read_more() -> None:
+        nonlocal buffer, pos, eof
+        chunk = f.read(JSON_READ_SIZE)
+        buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+
+    def peek() -> str:
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or eof:
+                return buffer[pos : pos + 1]
+            read_more()
+
+    def expect(char: str) -> None:
+        nonlocal pos
+        if peek() != char:
+            raise ValueError(f"malformed JSON in {f.name}: expected {char!r}")
+        pos += 1
+
+    def decode() -> Any:
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+                # A value that ends the buffer may be cut short (e.g. a number).
+                if end < len(buffer) or eof:
+                    pos = end
+                    return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            read_more()
+
+    if peek() == "{":
+        expect("{")
+        while True:
+            name = decode()
+            expect(":")
+            if name == key:
+                break
+            decode()
+            if peek() != ",":
+                raise ValueError(f"{f.name} has no {key!r} list")
+            expect(",")
+    expect("[")
+    if peek() == "]":
+        return
+    while True:
+        yield decode()
+        if peek() != ",":
+            break
+        expect(",")
+    expect("]")
 
 
 def load_stopwords() -> list[str]:
@@ -1,64 +1,218 @@
+import hashlib
 import json
 import os
 import re
+import time
+from collections.abc import Iterable, Iterator
+from itertools import batched
+from typing import TYPE_CHECKING, Optional
 
 import numpy as np
-from sentence_transformers import SentenceTransformer
 
+from .ann_index import (
+    ANN_FORMAT,
+    ANN_FORMAT_VERSION,
+    IVFPQ_FORMAT,
+    IVFPQ_FORMAT_VERSION,
+    HNSWIndex,
+    IVFPQIndex,
+)
+from .autotune import (
+    autotune,
+    encode_settings,
+    encode_with_settings,
+    save_encode_settings,
+    sequence_length_candidates,
+    thread_candidates,
+)
+from .chunk_build import CHUNK_METADATA_DTYPE, ChunkBuild, ordered_pool_map
+from .embedding_cache import EmbeddingCache, embedding_key, query_embedding_cache
+from .index_store import (
+    current_manifest,
+    file_stamp,
+    save_npy_stream,
+    write_json_atomic,
+)
+from .model_artifacts import ModelArtifacts
+from .models import sentence_transformer
+from .near_duplicates import minhasher
+from .postings import slice_indices
 from .search_utils import (
-    CHUNK_EMBEDDINGS_PATH,
-    CHUNK_METADATA_PATH,
+    ANN_BENCHMARK_SAMPLE,
+    AUTOTUNE_BATCH_SIZES,
+    AUTOTUNE_MIN_SIMILARITY,
+    AUTOTUNE_SAMPLE,
+    CHUNK_TASK_SIZE,
+    CHUNK_WORKERS,
     DEFAULT_CHUNK_OVERLAP,
     DEFAULT_CHUNK_SIZE,
+    DEFAULT_EMBEDDING_MODEL,
     DEFAULT_SEARCH_LIMIT,
     DEFAULT_SEMANTIC_CHUNK_SIZE,
     DOCUMENT_PREVIEW_LENGTH,
-    MOVIE_EMBEDDINGS_PATH,
+    EMBED_BATCH_SIZE,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_EF_SEARCH,
+    HNSW_M,
+    INGEST_BATCH_SIZE,
+    IVF_LISTS,
+    IVF_PROBES,
+    IVFPQ_RERANK,
+    LSH_BANDS,
+    MINHASH_PERMUTATIONS,
+    NEAR_DUPLICATE_THRESHOLD,
+    QUANTIZED_RESCORE,
+    SEARCH_MULTIPLIER,
+    SHINGLE_SIZE,
     format_search_result,
+    iter_movies,
     load_movies,
 )
+from .vectors import (
+    POOLING_METHODS,
+    QUANTIZATION_KINDS,
+    QUANTIZED_FORMAT,
+    QUANTIZED_FORMAT_VERSION,
+    QuantizedEmbeddings,
+    normalize_embeddings,
+    pool_segments,
+    similarity_blocks,
+    top_k_indices,
+    top_k_rows,
+)
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 
 
 class SemanticSearch:
-    def __init__(self, model_name="all-MiniLM-L6-v2"):
-        self.model = SentenceTransformer(model_name)
+    def __init__(
+            self,
+            model_name=DEFAULT_EMBEDDING_MODEL,
+            quantization: Optional[str] = None,
+            rescore: int = QUANTIZED_RESCORE,
+    ):
+        self.model_name = model_name
+        self.artifacts = ModelArtifacts(model_name)
+        self.embedding_cache = EmbeddingCache(model_name)
+        self.query_cache = query_embedding_cache(model_name)
         self.embeddings = None
         self.documents = None
         self.document_map = {}
+        self.quantization = quantization
+        self.rescore = rescore
+        self.quantized_embeddings = None
+
+    @property
+    def model(self) -> "SentenceTransformer":
+        """The shared model instance, loaded the first time it is needed."""
+        return sentence_transformer(self.model_name)
 
     def generate_embedding(self, text):
         if not text or not text.strip():
             raise ValueError("cannot generate embedding for empty text")
-        return self.model.encode([text])[0]
+        return self.query_cache.get(text, self.encode_queries)
+
+    def generate_query_vector(self, text: str) -> np.ndarray:
+        """Unit-length query embedding, ready to dot with normalized embeddings."""
+        return normalize_embeddings(self.generate_embedding(text))
+
+    def generate_query_vectors(self, queries: list[str]) -> np.ndarray:
+        """Unit-length embeddings of `queries`, one row each.
+
+        Queries missing from the query cache are encoded in one batch.
+        """
+        if any(not query or not query.strip() for query in queries):
+            raise ValueError("cannot generate embedding for empty text")
+        return normalize_embeddings(
+            self.query_cache.get_many(queries, self.encode_queries)
+        )
+
+    def encode_queries(self, queries: list[str]) -> np.ndarray:
+        return self.model.encode(queries, show_progress_bar=False)
 
     def build_embeddings(self, documents):
         self.documents = documents
         self.document_map = {}
-        movie_strings = []
         for doc in documents:
             self.document_map[doc["id"]] = doc
-            movie_strings.append(f"{doc['title']}: {doc['description']}")
-        self.embeddings = self.model.encode(movie_strings, show_progress_bar=True)
-
-        os.makedirs(os.path.dirname(MOVIE_EMBEDDINGS_PATH), exist_ok=True)
-        np.save(MOVIE_EMBEDDINGS_PATH, self.embeddings)
+        return self.set_embeddings(self.embed_documents(documents))
+
+    def set_embeddings(self, embeddings: np.ndarray) -> np.ndarray:
+        """Hold the movie embeddings for search; returns the matrix kept in memory.
+
+        With `quantization` only the int8 or float16 copy is kept, and the
+        float32 file is read just for re-scoring.
+        """
+        if self.quantization:
+            self.embeddings = None
+            self.quantized_embeddings = load_or_create_quantized(
+                self.artifacts.movie_embeddings, self.quantization
+            )
+            return self.quantized_embeddings.codes
+        self.embeddings = normalize_embeddings(embeddings)
+        self.quantized_embeddings = None
         return self.embeddings
 
+    def embed_documents(
+            self, documents: Iterable[dict], batch_size: int = INGEST_BATCH_SIZE
+    ) -> np.ndarray:
+        """Embed a stream of movies to the model's movie embeddings, batch by batch.
+
+        Texts already in the embedding cache are not encoded again. Encode
+        settings saved by `autotune_command` are used for every batch.
+        """
+        encode_options = encode_settings(self.model_name)
+        digest = hashlib.sha1()
+        path = self.artifacts.movie_embeddings
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_embeddings_digest(path, None)
+        embeddings = save_npy_stream(
+            path,
+            self.embedding_cache.encode_batches(
+                self.model, movie_texts(documents), batch_size, digest, encode_options
+            ),
+        )
+        self.artifacts.record(embeddings)
+        write_embeddings_digest(path, digest.hexdigest())
+        return embeddings
+
     def load_or_create_embeddings(self, documents):
         self.documents = documents
         self.document_map = {}
         for doc in documents:
             self.document_map[doc["id"]] = doc
 
-        if os.path.exists(MOVIE_EMBEDDINGS_PATH):
-            self.embeddings = np.load(MOVIE_EMBEDDINGS_PATH)
-            if len(self.embeddings) == len(documents):
-                return self.embeddings
+        digest = hashlib.sha1(
+            self.embedding_cache.keys(
+                list(movie_texts(documents)), encode_settings(self.model_name)
+            ).tobytes()
+        )
+        path = self.artifacts.movie_embeddings
+        if read_embeddings_digest(path) == digest.hexdigest():
+            embeddings = np.load(path, mmap_mode="r")
+            if self.artifacts.matches(embeddings):
+                return self.set_embeddings(embeddings)
 
         return self.build_embeddings(documents)
 
     def search(self, query, limit=DEFAULT_SEARCH_LIMIT):
-        if self.embeddings is None or self.embeddings.size == 0:
+        self.check_loaded()
+        return self.search_vectors(self.generate_query_vector(query)[None], limit)[0]
+
+    def search_many(
+            self, queries: list[str], limit: int = DEFAULT_SEARCH_LIMIT
+    ) -> list[list[dict]]:
+        """`search` for every query, embedding and scoring them all at once."""
+        self.check_loaded()
+        if not queries:
+            return []
+        return self.search_vectors(self.generate_query_vectors(queries), limit)
+
+    def check_loaded(self) -> None:
+        if self.quantized_embeddings is None and (
+                self.embeddings is None or self.embeddings.size == 0
+        ):
             raise ValueError(
                 "No embeddings loaded. Call `load_or_create_embeddings` first."
             )
@@ -68,26 +222,48 @@ class SemanticSearch:
                 "No documents loaded. Call `load_or_create_embeddings` first."
             )
 
-        query_embedding = self.generate_embedding(query)
-
-        similarities = []
-        for i, doc_embedding in enumerate(self.embeddings):
-            similarity = cosine_similarity(query_embedding, doc_embedding)
-            similarities.append((similarity, self.documents[i]))
-
-        similarities.sort(key=lambda x: x[0], reverse=True)
-
-        results = []
-        for score, doc in similarities[:limit]:
-            results.append(
+    def search_vectors(
+            self, query_vectors: np.ndarray, limit: int
+    ) -> list[list[dict]]:
+        """Top `limit` movies for every row of `query_vectors`.
+
+        Float32 embeddings are scored against a block of queries with one
+        matrix product; quantized ones are searched query by query.
+        """
+        if self.quantized_embeddings is not None:
+            tops = [
+                self.quantized_embeddings.search(query_vector, limit, self.rescore)
+                for query_vector in query_vectors
+            ]
+        else:
+            tops = []
+            for scores in similarity_blocks(self.embeddings, query_vectors):
+                top = top_k_rows(scores, limit)
+                tops.extend(zip(top, np.take_along_axis(scores, top, axis=1)))
+
+        return [
+            [
                 {
                     "score": score,
-                    "title": doc["title"],
-                    "description": doc["description"],
+                    "title": self.documents[i]["title"],
+                    "description": self.documents[i]["description"],
                 }
-            )
+                for i, score in zip(top.tolist(), top_scores.tolist())
+            ]
+            for top, top_scores in tops
+        ]
+
 
-        return results
+def encode_batches(
+        model: "SentenceTransformer",
+        texts: Iterable[str],
+        batch_size: int,
+        encode_options: Optional[dict] = None,
+) -> Iterator[np.ndarray]:
+    for batch in batched(texts, batch_size):
+        yield encode_with_settings(
+            model, list(batch), encode_options, show_progress_bar=False
+        )
 
 
 def cosine_similarity(vec1, vec2):
@@ -133,8 +309,14 @@ def embed_query_text(query):
     print(f"Shape: {embedding.shape}")
 
 
-def semantic_search(query, limit=DEFAULT_SEARCH_LIMIT):
-    search_instance = SemanticSearch()
+def semantic_search(
+        query,
+        limit=DEFAULT_SEARCH_LIMIT,
+        quantization: Optional[str] = None,
+        rescore: int = QUANTIZED_RESCORE,
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
+):
+    search_instance = SemanticSearch(model_name, quantization, rescore)
     documents = load_movies()
     search_instance.load_or_create_embeddings(documents)
 
@@ -150,6 +332,10 @@ def semantic_search(query, limit=DEFAULT_SEARCH_LIMIT):
         print()
 
 
+def query_cache_stats(model_name: str = DEFAULT_EMBEDDING_MODEL) -> dict:
+    return query_embedding_cache(model_name).stats()
+
+
 def fixed_size_chunking(
         text: str,
         chunk_size: int = DEFAULT_CHUNK_SIZE,
@@ -229,11 +415,87 @@ def semantic_chunk_text(
         print(f"{i + 1}. {chunk}")
 
 
+def chunk_movies(
+        movies: tuple[tuple[int, int, str], ...]
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, list[str], np.ndarray, np.ndarray]:
+    """Semantic chunks of (ordinal, key, description) movies, in a worker process.
+
+    Returns the movie keys, their chunk counts, their MinHash signatures,
+    the chunks, one CHUNK_METADATA_DTYPE record per chunk and the chunk
+    signatures. The vector and canonical movie of each record are filled
+    in later by the build.
+    """
+    counts = np.zeros(len(movies), dtype=np.int64)
+    all_chunks = []
+    chunk_metadata = []
+    for i, (idx, _, text) in enumerate(movies):
+        if not text.strip():
+            continue
+
+        chunks = semantic_chunk(
+            text,
+            max_chunk_size=DEFAULT_SEMANTIC_CHUNK_SIZE,
+            overlap=DEFAULT_CHUNK_OVERLAP,
+        )
+        counts[i] = len(chunks)
+        all_chunks.extend(chunks)
+        chunk_metadata.extend(
+            (idx, j, len(chunks), -1, idx) for j in range(len(chunks))
+        )
+    keys = np.array([key for _, key, _ in movies], dtype=np.uint64)
+    hasher = minhasher()
+    return (
+        keys,
+        counts,
+        hasher.signatures(text for _, _, text in movies),
+        all_chunks,
+        np.array(chunk_metadata, CHUNK_METADATA_DTYPE),
+        hasher.signatures(all_chunks),
+    )
+
+
 class ChunkedSemanticSearch(SemanticSearch):
-    def __init__(self, model_name: str = "all-MiniLM-L6-v2") -> None:
-        super().__init__(model_name)
+    def __init__(
+            self,
+            model_name: str = DEFAULT_EMBEDDING_MODEL,
+            quantization: Optional[str] = None,
+            rescore: int = QUANTIZED_RESCORE,
+            pooling: str = "max",
+            first_stage_model: Optional[str] = None,
+            collapse_duplicates: bool = False,
+    ) -> None:
+        """`first_stage_model`, if given, embeds the movies that pick the
+        shortlist of cascaded search, typically a smaller and faster model
+        than the one scoring the chunks. `collapse_duplicates` keeps only
+        the best movie of every group of near-duplicate descriptions in
+        results.
+        """
+        super().__init__(model_name, quantization, rescore)
+        if pooling not in POOLING_METHODS:
+            raise ValueError(
+                f"unknown pooling {pooling!r}, "
+                f"expected one of {', '.join(POOLING_METHODS)}"
+            )
+        self.pooling = pooling
+        self.collapse_duplicates = collapse_duplicates
         self.chunk_embeddings = None
+        self.quantized_chunk_embeddings = None
         self.chunk_metadata = None
+        self.chunk_movie_indices = None
+        self.chunk_vectors = None
+        self.vector_chunks = None
+        self.vector_chunk_offsets = None
+        self.movie_canonical = None
+        self.pooled_movies = None
+        self.movie_chunk_starts = None
+        self.movie_chunk_offsets = None
+        self.ann_index = None
+        self.ivfpq_index = None
+        self.first_stage = (
+            SemanticSearch(first_stage_model)
+            if first_stage_model not in (None, model_name)
+            else self
+        )
 
     def build_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
         self.documents = documents
@@ -242,109 +504,974 @@ class ChunkedSemanticSearch(SemanticSearch):
         for doc in documents:
             self.document_map[doc["id"]] = doc
 
-        all_chunks = []
-        chunk_metadata = []
-
-        for idx, doc in enumerate(documents):
-            text = doc.get("description", "")
-            if not text.strip():
-                continue
-
-            chunks = semantic_chunk(
-                text,
-                max_chunk_size=DEFAULT_SEMANTIC_CHUNK_SIZE,
-                overlap=DEFAULT_CHUNK_OVERLAP,
+        return self.set_chunk_embeddings(
+            self.embed_chunks(documents),
+            load_chunk_metadata(self.artifacts.chunk_metadata),
+        )
+
+    def set_chunk_embeddings(
+            self, chunk_embeddings: np.ndarray, chunk_metadata: np.ndarray
+    ) -> np.ndarray:
+        """Hold the chunk embeddings for search, like `set_embeddings`."""
+        self.set_chunk_metadata(chunk_metadata)
+        if self.quantization:
+            self.quantized_chunk_embeddings = load_or_create_quantized(
+                self.artifacts.chunk_embeddings, self.quantization
             )
+            return self.quantized_chunk_embeddings.codes
+        self.chunk_embeddings = normalize_embeddings(chunk_embeddings)
+        return self.chunk_embeddings
 
-            for i, chunk in enumerate(chunks):
-                all_chunks.append(chunk)
-                chunk_metadata.append(
-                    {"movie_idx": idx, "chunk_idx": i, "total_chunks": len(chunks)}
-                )
+    def set_chunk_metadata(self, chunk_metadata: np.ndarray) -> None:
+        """Hold CHUNK_METADATA_DTYPE records, normally memory-mapped, for search.
 
-        self.chunk_embeddings = self.model.encode(all_chunks, show_progress_bar=True)
+        Chunks are written in movie order, so finding where each movie's
+        chunks start is one pass over the movie column. Near-duplicate
+        chunks share a vector, so `chunk_vectors` maps chunks in movie order
+        to rows of the embeddings, and `vector_chunks` maps vectors found by
+        the indexes back to every chunk that uses them. Both are None while
+        chunks and vectors are one to one.
+        """
         self.chunk_metadata = chunk_metadata
-
-        os.makedirs(os.path.dirname(CHUNK_EMBEDDINGS_PATH), exist_ok=True)
-        np.save(CHUNK_EMBEDDINGS_PATH, self.chunk_embeddings)
-        with open(CHUNK_METADATA_PATH, "w") as f:
-            json.dump(
-                {"chunks": chunk_metadata, "total_chunks": len(all_chunks)}, f, indent=2
+        self.chunk_embeddings = None
+        self.quantized_chunk_embeddings = None
+        self.ann_index = None
+        self.ivfpq_index = None
+        self.chunk_movie_indices = chunk_metadata["movie_idx"]
+        movie_indices = self.chunk_movie_indices
+        vector_indices = np.array(chunk_metadata["vector_idx"])
+        canonical = np.array(chunk_metadata["canonical_movie"])
+        if np.any(movie_indices[1:] < movie_indices[:-1]):
+            chunk_movie_order = np.argsort(movie_indices, kind="stable")
+            movie_indices = movie_indices[chunk_movie_order]
+            vector_indices = vector_indices[chunk_movie_order]
+            canonical = canonical[chunk_movie_order]
+        self.chunk_vectors = None
+        if np.any(vector_indices != np.arange(len(vector_indices))):
+            self.chunk_vectors = vector_indices
+        self.vector_chunks = self.vector_chunk_offsets = None
+        vector_count = int(vector_indices.max()) + 1 if len(vector_indices) else 0
+        if vector_count < len(chunk_metadata):
+            stored = np.array(chunk_metadata["vector_idx"])
+            self.vector_chunks = np.argsort(stored, kind="stable")
+            self.vector_chunk_offsets = np.searchsorted(
+                stored[self.vector_chunks], np.arange(vector_count + 1)
             )
-
-        return self.chunk_embeddings
-
-    def load_or_create_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
+        self.movie_chunk_starts = np.flatnonzero(
+            np.diff(movie_indices, prepend=-1) != 0
+        )
+        self.pooled_movies = movie_indices[self.movie_chunk_starts]
+        movie_count = int(movie_indices[-1]) + 1 if len(movie_indices) else 0
+        self.movie_chunk_offsets = np.searchsorted(
+            movie_indices, np.arange(movie_count + 1)
+        )
+        self.movie_canonical = np.arange(movie_count)
+        self.movie_canonical[self.pooled_movies] = canonical[self.movie_chunk_starts]
+
+    def embed_chunks(
+            self,
+            documents: Iterable[dict],
+            batch_size: int = EMBED_BATCH_SIZE,
+            workers: int = CHUNK_WORKERS,
+    ) -> np.ndarray:
+        """Chunk and embed a stream of movies with bounded memory.
+
+        `workers` processes chunk CHUNK_TASK_SIZE movies at a time ahead of
+        the model, which encodes `batch_size` chunks at a time. Each batch is
+        appended to a ChunkBuild on disk, so an interrupted build resumes
+        after the last movie it completed. Chunks already in the embedding
+        cache are not encoded again, and saved encode settings are applied
+        like in `embed_documents`.
+
+        Chunks are MinHashed as they are cut, and a chunk that is a
+        near-duplicate of one seen before is not encoded but points at that
+        chunk's vector, so the model runs and the stored vectors shrink with
+        the duplication rate. Movies are grouped by near-duplicate
+        descriptions the same way, for collapsing them in results.
+        """
+        encode_options = encode_settings(self.model_name)
+        max_seq_length = encode_options.get("max_seq_length")
+        digest = chunk_source_digest()
+        artifacts = self.artifacts
+        build = ChunkBuild(
+            artifacts.chunk_build,
+            self.model_name,
+            digest.hexdigest(),
+            digest,
+            max_seq_length,
+        )
+        write_embeddings_digest(artifacts.chunk_embeddings, None)
+        descriptions = (doc.get("description", "") for doc in documents)
+        movies = (
+            (embedding_key(self.model_name, text, max_seq_length), text)
+            for text in descriptions
+        )
+
+        try:
+            texts: list[str] = []
+            chunk_rows = np.empty(0, dtype=CHUNK_METADATA_DTYPE)
+            chunk_signatures = np.empty((0, MINHASH_PERMUTATIONS), dtype=np.uint32)
+            for keys, counts, movie_signatures, chunks, rows, signatures in (
+                    ordered_pool_map(
+                        chunk_movies,
+                        batched(build.pending(movies), CHUNK_TASK_SIZE),
+                        workers,
+                    )
+            ):
+                canonical = build.add(keys, counts, movie_signatures)
+                rows["canonical_movie"] = np.repeat(canonical, counts)
+                texts.extend(chunks)
+                chunk_rows = np.concatenate([chunk_rows, rows])
+                chunk_signatures = np.concatenate([chunk_signatures, signatures])
+                while len(texts) >= batch_size:
+                    self.append_chunks(
+                        build,
+                        texts[:batch_size],
+                        chunk_rows[:batch_size],
+                        chunk_signatures[:batch_size],
+                        encode_options,
+                    )
+                    del texts[:batch_size]
+                    chunk_rows = chunk_rows[batch_size:]
+                    chunk_signatures = chunk_signatures[batch_size:]
+            if texts:
+                self.append_chunks(
+                    build, texts, chunk_rows, chunk_signatures, encode_options
+                )
+        except BaseException:
+            # Files are closed without a commit, so resuming starts after the
+            # last completed movie.
+            build.close()
+            raise
+
+        chunk_embeddings = build.finish(
+            artifacts.chunk_embeddings, artifacts.chunk_metadata
+        )
+        artifacts.record(chunk_embeddings)
+        write_embeddings_digest(artifacts.chunk_embeddings, digest.hexdigest())
+        return chunk_embeddings
+
+    def append_chunks(
+            self,
+            build: ChunkBuild,
+            texts: list[str],
+            chunk_rows: np.ndarray,
+            signatures: np.ndarray,
+            encode_options: dict,
+    ) -> None:
+        """Encode the chunks that are not near-duplicates and append the batch."""
+        chunk_rows["vector_idx"], new = build.assign_vectors(signatures)
+        new_texts = [text for text, is_new in zip(texts, new) if is_new]
+        embeddings = (
+            self.embedding_cache.encode(
+                self.model,
+                new_texts,
+                encode_options=encode_options,
+                show_progress_bar=False,
+            )
+            if new_texts
+            else np.empty((0, 0), dtype=np.float32)
+        )
+        build.append(embeddings, chunk_rows)
+
+    def digested_descriptions(
+            self, documents: Iterable[dict], digest: "hashlib._Hash"
+    ) -> Iterator[dict]:
+        """Pass movies through, feeding `digest` the key of every description.
+
+        Keys include the tuned sequence length, like those of `embed_chunks`.
+        """
+        max_seq_length = encode_settings(self.model_name).get("max_seq_length")
+        for doc in documents:
+            key = embedding_key(
+                self.model_name, doc.get("description", ""), max_seq_length
+            )
+            digest.update(key.to_bytes(8, "little"))
+            yield doc
+
+    def load_or_create_chunk_embeddings(
+            self, documents: list[dict], load_vectors: bool = True
+    ) -> Optional[np.ndarray]:
+        """Load the chunk embeddings and metadata, embedding the movies if needed.
+
+        Without `load_vectors` only the metadata is loaded, for searching
+        through the IVF-PQ index, which does not need the float32 matrix in
+        memory.
+        """
         self.documents = documents
         self.document_map = {}
         for doc in documents:
             self.document_map[doc["id"]] = doc
 
-        if os.path.exists(CHUNK_EMBEDDINGS_PATH) and os.path.exists(
-                CHUNK_METADATA_PATH
-        ):
-            self.chunk_embeddings = np.load(CHUNK_EMBEDDINGS_PATH)
-            with open(CHUNK_METADATA_PATH, "r") as f:
-                data = json.load(f)
-                self.chunk_metadata = data["chunks"]
-            return self.chunk_embeddings
+        digest = chunk_source_digest()
+        for _ in self.digested_descriptions(documents, digest):
+            pass
+        artifacts = self.artifacts
+        if os.path.exists(artifacts.chunk_metadata) and read_embeddings_digest(
+                artifacts.chunk_embeddings
+        ) == digest.hexdigest():
+            chunk_embeddings = np.load(artifacts.chunk_embeddings, mmap_mode="r")
+            chunk_metadata = load_chunk_metadata(artifacts.chunk_metadata)
+            if artifacts.matches(chunk_embeddings):
+                if not load_vectors:
+                    self.set_chunk_metadata(chunk_metadata)
+                    return None
+                return self.set_chunk_embeddings(chunk_embeddings, chunk_metadata)
 
         return self.build_chunk_embeddings(documents)
 
-    def search_chunks(self, query: str, limit: int = 10) -> list[dict]:
-        if self.chunk_embeddings is None or self.chunk_metadata is None:
+    def load_or_create_ann_index(
+            self,
+            m: Optional[int] = None,
+            ef_construction: Optional[int] = None,
+            ef_search: int = HNSW_EF_SEARCH,
+    ) -> HNSWIndex:
+        """Open the HNSW graph over the chunk embeddings, building it if needed.
+
+        The saved graph is reused while the embeddings file is unchanged and
+        `m` and `ef_construction` match where they are given. Otherwise it is
+        rebuilt, with the defaults for parameters left as None.
+        """
+        if self.chunk_embeddings is None:
             raise ValueError(
                 "No chunk embeddings loaded. Call load_or_create_chunk_embeddings first."
             )
-
-        query_embedding = self.generate_embedding(query)
-
-        chunk_scores = []
-        for i, chunk_embedding in enumerate(self.chunk_embeddings):
-            similarity = cosine_similarity(query_embedding, chunk_embedding)
-            chunk_scores.append(
-                {
-                    "chunk_idx": i,
-                    "movie_idx": self.chunk_metadata[i]["movie_idx"],
-                    "score": similarity,
-                }
+        source = file_stamp(self.artifacts.chunk_embeddings)
+        path = self.artifacts.chunk_ann
+        manifest = current_manifest(path, ANN_FORMAT, ANN_FORMAT_VERSION)
+        if manifest is not None and (
+                manifest.get("source") == source
+                and m in (None, manifest["m"])
+                and ef_construction in (None, manifest["ef_construction"])
+        ):
+            self.ann_index, _ = HNSWIndex.load(path, self.chunk_embeddings, ef_search)
+            return self.ann_index
+
+        index = HNSWIndex.build(
+            self.chunk_embeddings,
+            m or HNSW_M,
+            ef_construction or HNSW_EF_CONSTRUCTION,
+            ef_search,
+        )
+        index.save(path, source=source)
+        self.ann_index = index
+        return index
+
+    def load_or_create_ivfpq_index(
+            self,
+            lists: Optional[int] = None,
+            subvectors: Optional[int] = None,
+            nprobe: int = IVF_PROBES,
+            rerank: int = IVFPQ_RERANK,
+    ) -> IVFPQIndex:
+        """Open the IVF-PQ index over the chunk embeddings, building it if needed.
+
+        The index is trained and encoded straight from the memory-mapped
+        embeddings file, which is also what re-ranking reads from. It is
+        reused while the file is unchanged and `lists` and `subvectors`
+        match where they are given, like the HNSW graph.
+        """
+        if self.chunk_metadata is None:
+            raise ValueError(
+                "No chunk embeddings loaded. Call load_or_create_chunk_embeddings first."
             )
-
-        movie_scores = {}
-        for chunk_score in chunk_scores:
-            movie_idx = chunk_score["movie_idx"]
-            if (
-                    movie_idx not in movie_scores
-                    or chunk_score["score"] > movie_scores[movie_idx]
-            ):
-                movie_scores[movie_idx] = chunk_score["score"]
-
-        sorted_movies = sorted(movie_scores.items(), key=lambda x: x[1], reverse=True)
-
-        results = []
-        for movie_idx, score in sorted_movies[:limit]:
-            doc = self.documents[movie_idx]
-            results.append(
+        vectors = np.load(self.artifacts.chunk_embeddings, mmap_mode="r")
+        source = file_stamp(self.artifacts.chunk_embeddings)
+        path = self.artifacts.chunk_ivfpq
+        manifest = current_manifest(path, IVFPQ_FORMAT, IVFPQ_FORMAT_VERSION)
+        if manifest is not None and (
+                manifest.get("source") == source
+                and lists in (None, manifest["lists"])
+                and subvectors in (None, manifest["subvectors"])
+        ):
+            self.ivfpq_index, _ = IVFPQIndex.load(path, vectors, nprobe, rerank)
+            return self.ivfpq_index
+
+        index = IVFPQIndex.build(vectors, lists or IVF_LISTS, subvectors)
+        index.nprobe, index.rerank = nprobe, rerank
+        index.save(path, source=source)
+        self.ivfpq_index = index
+        return index
+
+    def search_chunks(
+            self,
+            query: str,
+            limit: int = 10,
+            ann: Optional[str] = None,
+            ef_search: Optional[int] = None,
+            nprobe: Optional[int] = None,
+            cascade: Optional[int] = None,
+    ) -> list[dict]:
+        """Best movies by their best matching chunk.
+
+        `ann` picks an approximate index, "hnsw" or "ivfpq", instead of
+        scoring every chunk. `cascade` instead scores only the chunks of the
+        that many movies whose movie embeddings match best.
+        """
+        return self.search_many([query], limit, ann, ef_search, nprobe, cascade)[0]
+
+    def search_many(
+            self,
+            queries: list[str],
+            limit: int = 10,
+            ann: Optional[str] = None,
+            ef_search: Optional[int] = None,
+            nprobe: Optional[int] = None,
+            cascade: Optional[int] = None,
+    ) -> list[list[dict]]:
+        """`search_chunks` for every query, embedding them in one batch.
+
+        Exact search scores a block of queries against every chunk with one
+        matrix product; the indexes and quantized embeddings are searched
+        query by query. When collapsing duplicates, more movies are fetched
+        so `limit` remain once near-duplicates are dropped.
+        """
+        if self.chunk_metadata is None or (
+                self.chunk_embeddings is None
+                and self.quantized_chunk_embeddings is None
+                and ann != "ivfpq"
+        ):
+            raise ValueError(
+                "No chunk embeddings loaded. Call load_or_create_chunk_embeddings first."
+            )
+        if not queries:
+            return []
+
+        query_vectors = self.generate_query_vectors(queries)
+        fetch = limit * SEARCH_MULTIPLIER if self.collapse_duplicates else limit
+        if ann:
+            tops = [
+                self.ann_search_movies(query_vector, fetch, ann, ef_search, nprobe)
+                for query_vector in query_vectors
+            ]
+        elif cascade:
+            shortlist_vectors = (
+                query_vectors
+                if self.first_stage is self
+                else self.first_stage.generate_query_vectors(queries)
+            )
+            tops = self.cascade_search_movies(
+                query_vectors, fetch, cascade, shortlist_vectors
+            )
+        elif self.quantized_chunk_embeddings is not None:
+            tops = [
+                self.best_movies(
+                    *self.quantized_chunk_embeddings.search(
+                        query_vector, limit * SEARCH_MULTIPLIER, self.rescore
+                    ),
+                    fetch,
+                )
+                for query_vector in query_vectors
+            ]
+        else:
+            tops = self.exact_search_movies(query_vectors, fetch)
+        if self.collapse_duplicates:
+            tops = [self.distinct_movies(*top, limit) for top in tops]
+
+        return [
+            [
                 format_search_result(
-                    doc_id=doc["id"],
-                    title=doc["title"],
-                    document=doc["description"][:DOCUMENT_PREVIEW_LENGTH],
+                    doc_id=self.documents[movie_idx]["id"],
+                    title=self.documents[movie_idx]["title"],
+                    document=self.documents[movie_idx]["description"][
+                        :DOCUMENT_PREVIEW_LENGTH
+                    ],
                     score=score,
                 )
+                for movie_idx, score in zip(top_movies.tolist(), top_scores.tolist())
+            ]
+            for top_movies, top_scores in tops
+        ]
+
+    def exact_search_movies(
+            self, query_vectors: np.ndarray, limit: int
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Top `limit` movies and scores for every row of `query_vectors`.
+
+        Chunks are grouped by movie, so each block of chunk scores is pooled
+        into movie scores with a few reduceat calls. Only the distinct
+        vectors are scored; chunks sharing one read the same score.
+        """
+        if len(self.pooled_movies) == 0:
+            empty = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            return [empty] * len(query_vectors)
+        tops = []
+        for chunk_scores in similarity_blocks(self.chunk_embeddings, query_vectors):
+            if self.chunk_vectors is not None:
+                chunk_scores = chunk_scores[:, self.chunk_vectors]
+            movie_scores = pool_segments(
+                chunk_scores, self.movie_chunk_starts, self.pooling
+            )
+            top = top_k_rows(movie_scores, limit)
+            tops.extend(
+                zip(self.pooled_movies[top], np.take_along_axis(movie_scores, top, 1))
+            )
+        return tops
+
+    def cascade_search_movies(
+            self,
+            query_vectors: np.ndarray,
+            limit: int,
+            shortlist: int,
+            shortlist_vectors: Optional[np.ndarray] = None,
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Like `exact_search_movies`, over the `shortlist` best movies only.
+
+        Movie embeddings of the first stage model pick the shortlist for a
+        block of queries with one matrix product, scored against
+        `shortlist_vectors`, the same queries embedded by that model if it
+        is not the chunk model. The chunks of each shortlisted movie are
+        then found through the movie -> chunk offset table and scored on
+        their own.
+        """
+        movie_embeddings = self.first_stage.embeddings
+        if movie_embeddings is None or self.chunk_embeddings is None:
+            raise ValueError(
+                "Cascaded search needs float32 movie and chunk embeddings. Call "
+                "first_stage.load_or_create_embeddings and "
+                "load_or_create_chunk_embeddings."
+            )
+        if shortlist_vectors is None:
+            shortlist_vectors = query_vectors
+        offsets = self.movie_chunk_offsets
+        tops = []
+        for movie_scores in similarity_blocks(movie_embeddings, shortlist_vectors):
+            for candidates in top_k_rows(movie_scores, shortlist):
+                query_vector = query_vectors[len(tops)]
+                # In movie order, so that ties go to the lowest movie index
+                # like in `exact_search_movies`.
+                candidates = np.sort(candidates[candidates < len(offsets) - 1])
+                candidates = candidates[offsets[candidates + 1] > offsets[candidates]]
+                starts, ends = offsets[candidates], offsets[candidates + 1]
+                if len(candidates) == 0:
+                    tops.append((candidates, np.empty(0, dtype=np.float32)))
+                    continue
+                vector_ids = slice_indices(starts, ends)
+                if self.chunk_vectors is not None:
+                    vector_ids = self.chunk_vectors[vector_ids]
+                lengths = ends - starts
+                pooled = pool_segments(
+                    self.chunk_embeddings[vector_ids] @ query_vector,
+                    np.cumsum(lengths) - lengths,
+                    self.pooling,
+                )
+                top = top_k_indices(pooled, limit)
+                tops.append((candidates[top], pooled[top]))
+        return tops
+
+    def ann_search_movies(
+            self,
+            query_vector: np.ndarray,
+            limit: int,
+            ann: str = "hnsw",
+            ef_search: Optional[int] = None,
+            nprobe: Optional[int] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Best movies among the nearest `limit * SEARCH_MULTIPLIER` chunks.
+
+        Several chunks can belong to one movie, so more chunks than movies
+        are fetched. The indexes hold one entry per distinct vector.
+        """
+        chunk_limit = limit * SEARCH_MULTIPLIER
+        if ann == "hnsw":
+            if self.ann_index is None:
+                self.load_or_create_ann_index()
+            vector_ids, vector_scores = self.ann_index.search(
+                query_vector, chunk_limit, ef_search
             )
+        elif ann == "ivfpq":
+            if self.ivfpq_index is None:
+                self.load_or_create_ivfpq_index()
+            vector_ids, vector_scores = self.ivfpq_index.search(
+                query_vector, chunk_limit, nprobe
+            )
+        else:
+            raise ValueError(f"unknown ANN index {ann!r}, expected hnsw or ivfpq")
+        return self.best_movies(vector_ids, vector_scores, limit)
+
+    def distinct_movies(
+            self, movies: np.ndarray, scores: np.ndarray, limit: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """The first `limit` ranked movies, skipping near-duplicates of earlier
+        ones.
+        """
+        _, first = np.unique(self.movie_canonical[movies], return_index=True)
+        keep = np.sort(first)[:limit]
+        return movies[keep], scores[keep]
+
+    def best_movies(
+            self, vector_ids: np.ndarray, vector_scores: np.ndarray, limit: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Top `limit` movies by their pooled scores over the chunks of the
+        given vectors.
+        """
+        chunk_ids, chunk_scores = vector_ids, vector_scores
+        if self.vector_chunks is not None:
+            offsets = self.vector_chunk_offsets
+            starts, ends = offsets[vector_ids], offsets[vector_ids + 1]
+            chunk_ids = self.vector_chunks[slice_indices(starts, ends)]
+            chunk_scores = np.repeat(vector_scores, ends - starts)
+        movies = self.chunk_movie_indices[chunk_ids]
+        order = np.argsort(movies, kind="stable")
+        movies, starts = np.unique(movies[order], return_index=True)
+        if len(movies) == 0:
+            return movies, chunk_scores[:0]
+        movie_scores = pool_segments(chunk_scores[order], starts, self.pooling)
+        top = top_k_indices(movie_scores, limit)
+        return movies[top], movie_scores[top]
+
+
+def load_or_create_quantized(embeddings_path: str, kind: str) -> QuantizedEmbeddings:
+    """Quantized copy of an embeddings file, saved next to it.
+
+    The copy is rebuilt whenever the file's size or mtime changes.
+    """
+    vectors = np.load(embeddings_path, mmap_mode="r")
+    directory = f"{os.path.splitext(embeddings_path)[0]}_{kind}"
+    source = file_stamp(embeddings_path)
+    manifest = current_manifest(directory, QUANTIZED_FORMAT, QUANTIZED_FORMAT_VERSION)
+    if (
+            manifest is not None
+            and manifest["kind"] == kind
+            and manifest.get("source") == source
+    ):
+        return QuantizedEmbeddings.load(directory, vectors)[0]
+    quantized = QuantizedEmbeddings.from_vectors(vectors, kind)
+    quantized.save(directory, source=source)
+    return quantized
+
+
+def movie_texts(documents: Iterable[dict]) -> Iterator[str]:
+    return (f"{doc['title']}: {doc['description']}" for doc in documents)
+
+
+def chunk_source_digest() -> "hashlib._Hash":
+    """Digest of the chunk inputs, seeded with the chunking and dedup settings."""
+    return hashlib.sha1(
+        f"semantic:{DEFAULT_SEMANTIC_CHUNK_SIZE}:{DEFAULT_CHUNK_OVERLAP}:"
+        f"minhash:{SHINGLE_SIZE}:{MINHASH_PERMUTATIONS}:{LSH_BANDS}:"
+        f"{NEAR_DUPLICATE_THRESHOLD}".encode()
+    )
 
-        return results
+
+def embeddings_digest_path(embeddings_path: str) -> str:
+    return f"{os.path.splitext(embeddings_path)[0]}.digest.json"
+
+
+def read_embeddings_digest(embeddings_path: str) -> Optional[str]:
+    """Digest of the inputs `embeddings_path` was built from, if it exists."""
+    if not os.path.exists(embeddings_path):
+        return None
+    try:
+        with open(embeddings_digest_path(embeddings_path), "r") as f:
+            return json.load(f)["digest"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_embeddings_digest(embeddings_path: str, digest: Optional[str]) -> None:
+    """Record the input digest of a finished file; None clears it before a build."""
+    if digest is None:
+        if os.path.exists(embeddings_digest_path(embeddings_path)):
+            os.remove(embeddings_digest_path(embeddings_path))
+        return
+    write_json_atomic(embeddings_digest_path(embeddings_path), {"digest": digest})
+
+
+def load_chunk_metadata(path: str) -> np.ndarray:
+    return np.load(path, mmap_mode="r")
+
+
+def embed_movies_command(
+        batch_size: int = INGEST_BATCH_SIZE, model_name: str = DEFAULT_EMBEDDING_MODEL
+) -> np.ndarray:
+    searcher = SemanticSearch(model_name)
+    return searcher.embed_documents(iter_movies(), batch_size)
+
+
+def embed_chunks_command(
+        batch_size: int = EMBED_BATCH_SIZE,
+        workers: int = CHUNK_WORKERS,
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
+) -> dict:
+    """Embed the chunks of every movie and count what near-duplicates saved."""
+    searcher = ChunkedSemanticSearch(model_name)
+    embeddings = searcher.embed_chunks(iter_movies(), batch_size, workers)
+    chunk_metadata = load_chunk_metadata(searcher.artifacts.chunk_metadata)
+    movies, first_chunks = np.unique(chunk_metadata["movie_idx"], return_index=True)
+    canonical = chunk_metadata["canonical_movie"][first_chunks]
+    return {
+        "chunks": len(chunk_metadata),
+        "vectors": len(embeddings),
+        "duplicate_movies": int(np.sum(movies != canonical)),
+    }
+
+
+def search_chunked_command(
+        query: str,
+        limit: int = DEFAULT_SEARCH_LIMIT,
+        ann: Optional[str] = None,
+        ef_search: int = HNSW_EF_SEARCH,
+        nprobe: int = IVF_PROBES,
+        quantization: Optional[str] = None,
+        rescore: int = QUANTIZED_RESCORE,
+        pooling: str = "max",
+        cascade: Optional[int] = None,
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
+        first_stage_model: Optional[str] = None,
+        collapse_duplicates: bool = False,
+) -> dict:
+    movies = load_movies()
+    searcher = ChunkedSemanticSearch(
+        model_name,
+        quantization,
+        rescore,
+        pooling,
+        first_stage_model,
+        collapse_duplicates,
+    )
+    if cascade:
+        searcher.first_stage.load_or_create_embeddings(movies)
+    searcher.load_or_create_chunk_embeddings(movies, load_vectors=ann != "ivfpq")
+    results = searcher.search_chunks(query, limit, ann, ef_search, nprobe, cascade)
+    return {"query": query, "results": results}
 
 
-def embed_chunks_command() -> np.ndarray:
+def search_many_command(
+        queries: list[str],
+        limit: int = DEFAULT_SEARCH_LIMIT,
+        chunked: bool = False,
+        quantization: Optional[str] = None,
+        rescore: int = QUANTIZED_RESCORE,
+        pooling: str = "max",
+        cascade: Optional[int] = None,
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
+        first_stage_model: Optional[str] = None,
+        collapse_duplicates: bool = False,
+) -> list[dict]:
     movies = load_movies()
-    searcher = ChunkedSemanticSearch()
-    return searcher.load_or_create_chunk_embeddings(movies)
+    if chunked:
+        searcher = ChunkedSemanticSearch(
+            model_name,
+            quantization,
+            rescore,
+            pooling,
+            first_stage_model,
+            collapse_duplicates,
+        )
+        if cascade:
+            searcher.first_stage.load_or_create_embeddings(movies)
+        searcher.load_or_create_chunk_embeddings(movies)
+        results = searcher.search_many(queries, limit, cascade=cascade)
+    else:
+        searcher = SemanticSearch(model_name, quantization, rescore)
+        searcher.load_or_create_embeddings(movies)
+        results = searcher.search_many(queries, limit)
+    return [
+        {"query": query, "results": query_results}
+        for query, query_results in zip(queries, results)
+    ]
+
+
+def build_ann_command(
+        m: int = HNSW_M,
+        ef_construction: int = HNSW_EF_CONSTRUCTION,
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
+) -> HNSWIndex:
+    searcher = ChunkedSemanticSearch(model_name)
+    searcher.load_or_create_chunk_embeddings(load_movies())
+    return searcher.load_or_create_ann_index(m, ef_construction)
+
+
+def benchmark_queries(
+        searcher: ChunkedSemanticSearch,
+        queries: Optional[list[str]],
+        sample: int,
+        limit: int,
+) -> tuple[list[np.ndarray], list[set[int]], float]:
+    """Query vectors, their exact top `limit` chunks and the exact ms/query."""
+    embeddings = searcher.chunk_embeddings
+    query_vectors = list(benchmark_query_vectors(searcher, queries, sample))
+    start = time.perf_counter()
+    exact = [set(top_k_indices(embeddings @ q, limit).tolist()) for q in query_vectors]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+    return query_vectors, exact, exact_ms
+
+
+def benchmark_query_vectors(
+        searcher: ChunkedSemanticSearch, queries: Optional[list[str]], sample: int
+) -> np.ndarray:
+    """`queries` embedded, or else `sample` chunk embeddings picked at random."""
+    if queries:
+        return searcher.generate_query_vectors(queries)
+    embeddings = searcher.chunk_embeddings
+    rng = np.random.default_rng(0)
+    sample_ids = rng.choice(len(embeddings), min(sample, len(embeddings)), False)
+    return np.asarray(embeddings[np.sort(sample_ids)])
+
+
+def recall(exact: list[set[int]], found: list[np.ndarray]) -> float:
+    return float(
+        np.mean(
+            [
+                len(expected.intersection(ids.tolist())) / max(len(expected), 1)
+                for expected, ids in zip(exact, found)
+            ]
+        )
+    )
 
 
-def search_chunked_command(query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> dict:
+def ann_benchmark_command(
+        ef_values: list[int],
+        limit: int = DEFAULT_SEARCH_LIMIT,
+        queries: Optional[list[str]] = None,
+        sample: int = ANN_BENCHMARK_SAMPLE,
+        m: Optional[int] = None,
+        ef_construction: Optional[int] = None,
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
+) -> dict:
+    """Recall@limit and latency of HNSW chunk search against the exact scan.
+
+    Recall is the fraction of the exact top `limit` chunks the graph search
+    also returns.
+    """
+    searcher = ChunkedSemanticSearch(model_name)
+    searcher.load_or_create_chunk_embeddings(load_movies())
+    index = searcher.load_or_create_ann_index(m, ef_construction)
+    query_vectors, exact, exact_ms = benchmark_queries(searcher, queries, sample, limit)
+
+    operating_points = []
+    for ef in ef_values:
+        start = time.perf_counter()
+        found = [index.search(q, limit, ef)[0] for q in query_vectors]
+        latency_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+        operating_points.append(
+            {"ef_search": ef, "recall": recall(exact, found), "latency_ms": latency_ms}
+        )
+    return {
+        "queries": len(query_vectors),
+        "chunks": len(searcher.chunk_embeddings),
+        "limit": limit,
+        "m": index.m,
+        "ef_construction": index.ef_construction,
+        "exact_latency_ms": exact_ms,
+        "operating_points": operating_points,
+    }
+
+
+def build_ivfpq_command(
+        lists: int = IVF_LISTS,
+        subvectors: Optional[int] = None,
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
+) -> IVFPQIndex:
+    searcher = ChunkedSemanticSearch(model_name)
+    searcher.load_or_create_chunk_embeddings(load_movies(), load_vectors=False)
+    return searcher.load_or_create_ivfpq_index(lists, subvectors)
+
+
+def ivfpq_benchmark_command(
+        nprobe_values: list[int],
+        limit: int = DEFAULT_SEARCH_LIMIT,
+        rerank: int = IVFPQ_RERANK,
+        queries: Optional[list[str]] = None,
+        sample: int = ANN_BENCHMARK_SAMPLE,
+        lists: Optional[int] = None,
+        subvectors: Optional[int] = None,
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
+) -> dict:
+    """Memory per vector, recall@limit and latency of IVF-PQ chunk search.
+
+    Every `nprobe` is measured on the PQ scores alone and with the best
+    `rerank` hits re-scored against the full vectors.
+    """
+    searcher = ChunkedSemanticSearch(model_name)
+    searcher.load_or_create_chunk_embeddings(load_movies())
+    index = searcher.load_or_create_ivfpq_index(lists, subvectors)
+    query_vectors, exact, exact_ms = benchmark_queries(searcher, queries, sample, limit)
+
+    operating_points = []
+    for nprobe in nprobe_values:
+        for rerank_size in sorted({0, rerank}):
+            start = time.perf_counter()
+            found = [
+                index.search(q, limit, nprobe, rerank_size)[0] for q in query_vectors
+            ]
+            latency_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+            operating_points.append(
+                {
+                    "nprobe": nprobe,
+                    "rerank": rerank_size,
+                    "recall": recall(exact, found),
+                    "latency_ms": latency_ms,
+                }
+            )
+    embeddings = searcher.chunk_embeddings
+    return {
+        "queries": len(query_vectors),
+        "chunks": len(embeddings),
+        "limit": limit,
+        "lists": len(index.centroids),
+        "subvectors": len(index.codebooks),
+        "float32_bytes_per_vector": embeddings.shape[1] * 4,
+        "code_bytes_per_vector": index.code_bytes_per_vector,
+        "index_bytes_per_vector": index.nbytes / len(embeddings),
+        "exact_latency_ms": exact_ms,
+        "operating_points": operating_points,
+    }
+
+
+def quantization_benchmark_command(
+        limit: int = DEFAULT_SEARCH_LIMIT,
+        rescore: int = QUANTIZED_RESCORE,
+        queries: Optional[list[str]] = None,
+        sample: int = ANN_BENCHMARK_SAMPLE,
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
+) -> dict:
+    """Bytes per vector, recall@limit and latency of quantized chunk search.
+
+    Every kind is measured on its quantized scores alone and with `rescore`
+    against the exact float32 scan.
+    """
+    searcher = ChunkedSemanticSearch(model_name)
+    searcher.load_or_create_chunk_embeddings(load_movies())
+    query_vectors, exact, exact_ms = benchmark_queries(searcher, queries, sample, limit)
+
+    operating_points = []
+    for kind in QUANTIZATION_KINDS:
+        quantized = load_or_create_quantized(searcher.artifacts.chunk_embeddings, kind)
+        for rescore_size in sorted({0, rescore}):
+            start = time.perf_counter()
+            found = [
+                quantized.search(q, limit, rescore_size)[0] for q in query_vectors
+            ]
+            latency_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+            operating_points.append(
+                {
+                    "kind": kind,
+                    "bytes_per_vector": quantized.bytes_per_vector,
+                    "rescore": rescore_size,
+                    "recall": recall(exact, found),
+                    "latency_ms": latency_ms,
+                }
+            )
+    embeddings = searcher.chunk_embeddings
+    return {
+        "queries": len(query_vectors),
+        "chunks": len(embeddings),
+        "limit": limit,
+        "float32_bytes_per_vector": embeddings.shape[1] * 4,
+        "exact_latency_ms": exact_ms,
+        "operating_points": operating_points,
+    }
+
+
+def cascade_benchmark_command(
+        shortlists: list[int],
+        limit: int = DEFAULT_SEARCH_LIMIT,
+        queries: Optional[list[str]] = None,
+        sample: int = ANN_BENCHMARK_SAMPLE,
+        pooling: str = "max",
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
+        first_stage_model: Optional[str] = None,
+) -> dict:
+    """Recall@limit and latency of cascaded movie search against full chunk search.
+
+    Recall is the fraction of the top `limit` movies of the full chunk scan
+    that the cascade also returns; queries run one at a time in both modes.
+    A separate `first_stage_model` needs `queries`, since sampled chunk
+    embeddings only exist for the chunk model.
+    """
     movies = load_movies()
-    searcher = ChunkedSemanticSearch()
+    searcher = ChunkedSemanticSearch(
+        model_name, pooling=pooling, first_stage_model=first_stage_model
+    )
+    first_stage = searcher.first_stage
+    if first_stage is not searcher and not queries:
+        raise ValueError("a queries file is needed to benchmark a first stage model")
+    first_stage.load_or_create_embeddings(movies)
     searcher.load_or_create_chunk_embeddings(movies)
-    results = searcher.search_chunks(query, limit)
-    return {"query": query, "results": results}
+    query_vectors = benchmark_query_vectors(searcher, queries, sample)
+    shortlist_vectors = (
+        query_vectors
+        if first_stage is searcher
+        else first_stage.generate_query_vectors(queries)
+    )
+
+    start = time.perf_counter()
+    exact = [
+        set(searcher.exact_search_movies(q[None], limit)[0][0].tolist())
+        for q in query_vectors
+    ]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+
+    operating_points = []
+    for shortlist in shortlists:
+        start = time.perf_counter()
+        found = [
+            searcher.cascade_search_movies(q[None], limit, shortlist, s[None])[0][0]
+            for q, s in zip(query_vectors, shortlist_vectors)
+        ]
+        latency_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+        operating_points.append(
+            {
+                "shortlist": shortlist,
+                "recall": recall(exact, found),
+                "latency_ms": latency_ms,
+            }
+        )
+    return {
+        "queries": len(query_vectors),
+        "movies": len(first_stage.embeddings),
+        "chunks": len(searcher.chunk_embeddings),
+        "limit": limit,
+        "pooling": pooling,
+        "model": model_name,
+        "first_stage_model": first_stage.model_name,
+        "exact_latency_ms": exact_ms,
+        "operating_points": operating_points,
+    }
+
+
+def autotune_command(
+        model_name: str = DEFAULT_EMBEDDING_MODEL,
+        sample: int = AUTOTUNE_SAMPLE,
+        batch_sizes: Iterable[int] = AUTOTUNE_BATCH_SIZES,
+        threads: Optional[list[int]] = None,
+        sequence_lengths: Optional[list[int]] = None,
+        min_similarity: float = AUTOTUNE_MIN_SIMILARITY,
+) -> dict:
+    """Find the fastest encode settings on a sample of movies and save them.
+
+    Thread counts and sequence lengths default to candidates derived from
+    the machine and from the token lengths of the sample.
+    """
+    movies = load_movies()
+    rng = np.random.default_rng(0)
+    picks = np.sort(rng.choice(len(movies), min(sample, len(movies)), False))
+    texts = list(movie_texts(movies[i] for i in picks.tolist()))
+    model = sentence_transformer(model_name)
+    best, points = autotune(
+        model,
+        texts,
+        batch_sizes,
+        threads or thread_candidates(),
+        sequence_lengths or sequence_length_candidates(model, texts),
+        min_similarity,
+    )
+    if best is not None:
+        save_encode_settings(
+            model_name,
+            {
+                "batch_size": best["batch_size"],
+                "threads": best["threads"],
+                "max_seq_length": best["max_seq_length"],
+                "texts_per_second": best["texts_per_second"],
+            },
+        )
+    return {
+        "model": model_name,
+        "texts": len(texts),
+        "min_similarity": min_similarity,
+        "best": best,
+        "operating_points": points,
+    }
@@ -0,0 +1,270 @@
+from collections.abc import Iterator
+from typing import Optional
+
+import numpy as np
+
+from .index_store import load_arrays, save_arrays
+from .search_utils import (
+    INGEST_BATCH_SIZE,
+    KMEANS_ITERATIONS,
+    QUANTIZED_RESCORE,
+    SOFTMAX_POOLING_TEMPERATURE,
+    VECTOR_BATCH_CELLS,
+)
+
+QUANTIZED_FORMAT = "quantized-embeddings"
+QUANTIZED_FORMAT_VERSION = 1
+QUANTIZATION_KINDS = ("int8", "float16")
+INT8_LEVELS = 255
+POOLING_METHODS = ("max", "top2", "softmax")
+
+
+def normalize_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    """Float32 copy of `embeddings` with every row scaled to unit length.
+
+    Dot products between normalized rows are cosine similarities. All-zero
+    rows stay zero, so they score 0 against everything.
+    """
+    embeddings = np.array(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    np.divide(embeddings, norms, out=embeddings, where=norms > 0)
+    return embeddings
+
+
+def top_k_indices(scores: np.ndarray, limit: int) -> np.ndarray:
+    """Indices of the `limit` highest scores, best first, ties by index."""
+    limit = min(limit, len(scores))
+    if limit <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, limit - 1)[:limit]
+    # argpartition keeps arbitrary indices among those tied with the k-th
+    # score, so take all of them and keep the lowest.
+    top = np.flatnonzero(scores >= scores[top].min())
+    return top[np.lexsort((top, -scores[top]))][:limit]
+
+
+def top_k_rows(scores: np.ndarray, limit: int) -> np.ndarray:
+    """`top_k_indices` of every row of a 2-D score matrix."""
+    limit = min(limit, scores.shape[1])
+    if limit <= 0:
+        return np.empty((len(scores), 0), dtype=np.int64)
+    top = np.argpartition(-scores, limit - 1, axis=1)[:, :limit]
+    kth_scores = np.take_along_axis(scores, top, axis=1).min(axis=1, keepdims=True)
+    for row in np.flatnonzero((scores >= kth_scores).sum(axis=1) > limit):
+        top[row] = top_k_indices(scores[row], limit)
+    order = np.lexsort((top, -np.take_along_axis(scores, top, axis=1)), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def similarity_blocks(
+        vectors: np.ndarray, queries: np.ndarray
+) -> Iterator[np.ndarray]:
+    """Dot products of `queries` with every row of `vectors`, in query blocks.
+
+    Each block has one row of scores per query and holds about
+    VECTOR_BATCH_CELLS scores, however many queries there are.
+    """
+    batch_size = max(1, VECTOR_BATCH_CELLS // max(len(vectors), 1))
+    for start in range(0, len(queries), batch_size):
+        yield queries[start : start + batch_size] @ vectors.T
+
+
+def pool_segments(
+        scores: np.ndarray,
+        starts: np.ndarray,
+        method: str = "max",
+        temperature: float = SOFTMAX_POOLING_TEMPERATURE,
+) -> np.ndarray:
+    """Pool every row of `scores` over the column segments beginning at `starts`.
+
+    "max" keeps the best score of a segment, "top2" averages its two best
+    (a lone score stands as is) and "softmax" weights every score by
+    exp(score / temperature). Each is a few reduceat passes over the row.
+    """
+    best = np.maximum.reduceat(scores, starts, axis=-1)
+    if method == "max":
+        return best
+    lengths = np.diff(starts, append=scores.shape[-1])
+    spread_best = np.repeat(best, lengths, axis=-1)
+    if method == "top2":
+        is_best = scores == spread_best
+        second = np.maximum.reduceat(
+            np.where(is_best, -np.inf, scores), starts, axis=-1
+        )
+        tied = np.add.reduceat(is_best.astype(np.int32), starts, axis=-1) > 1
+        second = np.where(tied | (lengths == 1), best, second)
+        return (best + second) / 2
+    if method == "softmax":
+        weights = np.exp((scores - spread_best) / temperature)
+        return np.add.reduceat(weights * scores, starts, axis=-1) / np.add.reduceat(
+            weights, starts, axis=-1
+        )
+    raise ValueError(
+        f"unknown pooling {method!r}, expected one of {', '.join(POOLING_METHODS)}"
+    )
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the closest centroid (squared L2) for every row of `vectors`."""
+    squared_norms = (centroids * centroids).sum(axis=1)
+    batch_size = max(1, VECTOR_BATCH_CELLS // len(centroids))
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), batch_size):
+        batch = vectors[start : start + batch_size]
+        labels[start : start + len(batch)] = np.argmin(
+            squared_norms - 2 * (batch @ centroids.T), axis=1
+        )
+    return labels
+
+
+def kmeans(
+        samples: np.ndarray,
+        k: int,
+        iterations: int = KMEANS_ITERATIONS,
+        seed: int = 0,
+) -> np.ndarray:
+    """Lloyd's k-means from `k` random samples; empty clusters are re-seeded."""
+    rng = np.random.default_rng(seed)
+    samples = np.asarray(samples, dtype=np.float32)
+    k = min(k, len(samples))
+    centroids = samples[rng.choice(len(samples), k, replace=False)]
+    for _ in range(iterations):
+        labels = nearest_centroids(samples, centroids)
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=k)
+        filled = np.flatnonzero(counts)
+        starts = np.cumsum(counts) - counts
+        sums = np.add.reduceat(samples[order], starts[filled], axis=0)
+        centroids[filled] = sums / counts[filled, None]
+        empty = np.flatnonzero(counts == 0)
+        centroids[empty] = samples[rng.choice(len(samples), len(empty), replace=False)]
+    return centroids
+
+
+class QuantizedEmbeddings:
+    """Normalized embeddings held as int8 or float16 for a first scoring pass.
+
+    int8 codes map every dimension's range onto 256 levels with a
+    per-dimension `scale` and `offset`, so x ~ offset + scale * (code + 128).
+    The best first-pass candidates are re-scored with the float32 rows of
+    `vectors`, usually the memory-mapped embeddings file, which is touched
+    only for those rows.
+    """
+
+    def __init__(
+            self,
+            kind: str,
+            codes: np.ndarray,
+            scale: Optional[np.ndarray] = None,
+            offset: Optional[np.ndarray] = None,
+            vectors: Optional[np.ndarray] = None,
+    ) -> None:
+        self.kind = kind
+        self.codes = codes
+        self.scale = scale
+        self.offset = offset
+        self.vectors = vectors
+
+    @classmethod
+    def from_vectors(
+            cls, vectors: np.ndarray, kind: str, batch_size: int = INGEST_BATCH_SIZE
+    ) -> "QuantizedEmbeddings":
+        """Quantize `vectors` batch by batch, normalizing rows as they are read."""
+        if kind not in QUANTIZATION_KINDS:
+            raise ValueError(
+                f"unknown quantization {kind!r}, expected one of {QUANTIZATION_KINDS}"
+            )
+        batches = range(0, len(vectors), batch_size)
+        if kind == "float16":
+            codes = np.empty(vectors.shape, dtype=np.float16)
+            for start in batches:
+                codes[start : start + batch_size] = normalize_embeddings(
+                    vectors[start : start + batch_size]
+                )
+            return cls(kind, codes, vectors=vectors)
+
+        low = np.full(vectors.shape[1], np.inf, dtype=np.float32)
+        high = np.full(vectors.shape[1], -np.inf, dtype=np.float32)
+        for start in batches:
+            batch = normalize_embeddings(vectors[start : start + batch_size])
+            np.minimum(low, batch.min(axis=0, initial=np.inf), out=low)
+            np.maximum(high, batch.max(axis=0, initial=-np.inf), out=high)
+        scale = np.where(high > low, (high - low) / INT8_LEVELS, 1.0).astype(np.float32)
+        codes = np.empty(vectors.shape, dtype=np.int8)
+        for start in batches:
+            batch = normalize_embeddings(vectors[start : start + batch_size])
+            levels = np.rint((batch - low) / scale).clip(0, INT8_LEVELS)
+            codes[start : start + batch_size] = levels - 128
+        return cls(kind, codes, scale, low, vectors)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        """Approximate dot products of `query` with every row.
+
+        Rows are widened to float32 a block at a time, so only the compact
+        codes are ever held for the whole matrix.
+        """
+        if self.kind == "int8":
+            weights = query * self.scale
+            bias = float(query @ self.offset + 128 * weights.sum())
+        else:
+            weights, bias = query, 0.0
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        batch_size = max(1, VECTOR_BATCH_CELLS // max(self.codes.shape[1], 1))
+        for start in range(0, len(self.codes), batch_size):
+            block = self.codes[start : start + batch_size].astype(np.float32)
+            scores[start : start + len(block)] = block @ weights + bias
+        return scores
+
+    def search(
+            self, query: np.ndarray, limit: int, rescore: int = QUANTIZED_RESCORE
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Top `limit` rows, best first, after re-scoring `rescore` candidates.
+
+        Without `vectors` or with `rescore` 0 the approximate scores stand.
+        """
+        scores = self.scores(query)
+        if not rescore or self.vectors is None:
+            top = top_k_indices(scores, limit)
+            return top, scores[top]
+        ids = np.sort(top_k_indices(scores, max(limit, rescore)))
+        scores = normalize_embeddings(self.vectors[ids]) @ query
+        top = top_k_indices(scores, limit)
+        return ids[top], scores[top]
+
+    @property
+    def bytes_per_vector(self) -> int:
+        return self.codes.shape[1] * self.codes.itemsize
+
+    def save(self, directory: str, **manifest) -> None:
+        arrays = {"codes": self.codes}
+        if self.kind == "int8":
+            arrays.update(scale=self.scale, offset=self.offset)
+        save_arrays(
+            directory,
+            {
+                "format": QUANTIZED_FORMAT,
+                "version": QUANTIZED_FORMAT_VERSION,
+                "kind": self.kind,
+                **manifest,
+            },
+            arrays,
+        )
+
+    @classmethod
+    def load(
+            cls, directory: str, vectors: Optional[np.ndarray] = None
+    ) -> tuple["QuantizedEmbeddings", dict]:
+        manifest, arrays = load_arrays(
+            directory, QUANTIZED_FORMAT, QUANTIZED_FORMAT_VERSION
+        )
+        quantized = cls(
+            manifest["kind"],
+            arrays["codes"],
+            arrays.get("scale"),
+            arrays.get("offset"),
+            vectors,
+        )
+        return quantized, manifest
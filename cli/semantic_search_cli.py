@@ -1,18 +1,49 @@
 #!/usr/bin/env python3
 
 import argparse
+from typing import Optional
 
 from lib.semantic_search import (
+    ann_benchmark_command,
+    autotune_command,
+    build_ann_command,
+    build_ivfpq_command,
+    cascade_benchmark_command,
     chunk_text,
     embed_chunks_command,
+    embed_movies_command,
     embed_query_text,
     embed_text,
+    ivfpq_benchmark_command,
+    quantization_benchmark_command,
+    query_cache_stats,
     search_chunked_command,
+    search_many_command,
     semantic_chunk_text,
     semantic_search,
     verify_embeddings,
     verify_model,
 )
+from lib.search_utils import (
+    ANN_BENCHMARK_SAMPLE,
+    AUTOTUNE_BATCH_SIZES,
+    AUTOTUNE_MIN_SIMILARITY,
+    AUTOTUNE_SAMPLE,
+    CASCADE_SHORTLIST,
+    CHUNK_WORKERS,
+    DEFAULT_EMBEDDING_MODEL,
+    EMBED_BATCH_SIZE,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_EF_SEARCH,
+    HNSW_M,
+    INGEST_BATCH_SIZE,
+    IVF_LISTS,
+    IVF_PROBES,
+    IVFPQ_RERANK,
+    PQ_SUBVECTORS,
+    QUANTIZED_RESCORE,
+)
+from lib.vectors import POOLING_METHODS, QUANTIZATION_KINDS
 
 
 def main() -> None:
@@ -42,6 +73,30 @@ def main() -> None:
     search_parser.add_argument(
         "--limit", type=int, default=5, help="Number of results to return"
     )
+    add_quantization_arguments(search_parser)
+    add_cache_stats_argument(search_parser)
+    add_model_arguments(search_parser)
+
+    search_many_parser = subparsers.add_parser(
+        "search_many", help="Search for many queries at once, one per line of a file"
+    )
+    search_many_parser.add_argument(
+        "queries_file", type=str, help="File with one query per line"
+    )
+    search_many_parser.add_argument(
+        "--limit", type=int, default=5, help="Number of results per query"
+    )
+    search_many_parser.add_argument(
+        "--chunked",
+        action="store_true",
+        help="Rank movies by their best chunk instead of the whole description",
+    )
+    add_pooling_argument(search_many_parser)
+    add_cascade_argument(search_many_parser)
+    add_collapse_argument(search_many_parser)
+    add_quantization_arguments(search_many_parser)
+    add_cache_stats_argument(search_many_parser)
+    add_model_arguments(search_many_parser, first_stage=True)
 
     chunk_parser = subparsers.add_parser(
         "chunk", help="Split text into fixed-size chunks with optional overlap"
@@ -74,9 +129,33 @@ def main() -> None:
         help="Number of sentences to overlap between chunks",
     )
 
-    subparsers.add_parser(
+    embed_movies_parser = subparsers.add_parser(
+        "embed_movies", help="Stream the movie dataset into a new embeddings file"
+    )
+    embed_movies_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=INGEST_BATCH_SIZE,
+        help="Number of movies read and embedded at a time",
+    )
+    add_model_arguments(embed_movies_parser)
+
+    embed_chunks_parser = subparsers.add_parser(
         "embed_chunks", help="Generate embeddings for chunked documents"
     )
+    embed_chunks_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=EMBED_BATCH_SIZE,
+        help="Number of chunks encoded and written at a time",
+    )
+    embed_chunks_parser.add_argument(
+        "--workers",
+        type=int,
+        default=CHUNK_WORKERS,
+        help="Number of processes that chunk movies while the model encodes",
+    )
+    add_model_arguments(embed_chunks_parser)
 
     search_chunked_parser = subparsers.add_parser(
         "search_chunked", help="Search using chunked embeddings"
@@ -85,6 +164,230 @@ def main() -> None:
     search_chunked_parser.add_argument(
         "--limit", type=int, default=5, help="Number of results to return"
     )
+    search_chunked_parser.add_argument(
+        "--ann",
+        nargs="?",
+        const="hnsw",
+        choices=["hnsw", "ivfpq"],
+        help="Search an approximate index (default hnsw) instead of every chunk",
+    )
+    search_chunked_parser.add_argument(
+        "--ef-search",
+        type=int,
+        default=HNSW_EF_SEARCH,
+        help="Candidates kept while searching the HNSW graph",
+    )
+    search_chunked_parser.add_argument(
+        "--nprobe",
+        type=int,
+        default=IVF_PROBES,
+        help="IVF lists scanned per query",
+    )
+    add_pooling_argument(search_chunked_parser)
+    add_cascade_argument(search_chunked_parser)
+    add_collapse_argument(search_chunked_parser)
+    add_quantization_arguments(search_chunked_parser)
+    add_cache_stats_argument(search_chunked_parser)
+    add_model_arguments(search_chunked_parser, first_stage=True)
+
+    build_ann_parser = subparsers.add_parser(
+        "build_ann", help="Build the HNSW graph over the chunk embeddings"
+    )
+    build_ann_parser.add_argument(
+        "--m", type=int, default=HNSW_M, help="Links per node on the upper layers"
+    )
+    build_ann_parser.add_argument(
+        "--ef-construction",
+        type=int,
+        default=HNSW_EF_CONSTRUCTION,
+        help="Candidates kept while inserting a node",
+    )
+    add_model_arguments(build_ann_parser)
+
+    ann_benchmark_parser = subparsers.add_parser(
+        "ann_benchmark", help="Report HNSW recall@k and latency against exact search"
+    )
+    ann_benchmark_parser.add_argument(
+        "--ef-search",
+        type=int,
+        nargs="+",
+        default=[16, 32, 64, 128, 256],
+        help="ef_search operating points to measure",
+    )
+    ann_benchmark_parser.add_argument(
+        "--limit", type=int, default=10, help="k for recall@k"
+    )
+    ann_benchmark_parser.add_argument(
+        "--queries-file",
+        type=str,
+        help="File with one query per line; defaults to sampled chunks",
+    )
+    ann_benchmark_parser.add_argument(
+        "--sample",
+        type=int,
+        default=ANN_BENCHMARK_SAMPLE,
+        help="Number of chunk embeddings used as queries without a queries file",
+    )
+    ann_benchmark_parser.add_argument(
+        "--m", type=int, help="Rebuild the graph unless it has this m"
+    )
+    ann_benchmark_parser.add_argument(
+        "--ef-construction",
+        type=int,
+        help="Rebuild the graph unless it has this ef_construction",
+    )
+    add_model_arguments(ann_benchmark_parser)
+
+    build_ivfpq_parser = subparsers.add_parser(
+        "build_ivfpq", help="Build the IVF-PQ index over the chunk embeddings"
+    )
+    build_ivfpq_parser.add_argument(
+        "--lists", type=int, default=IVF_LISTS, help="Number of IVF lists"
+    )
+    build_ivfpq_parser.add_argument(
+        "--subvectors",
+        type=int,
+        help=(
+            "PQ subvectors, i.e. code bytes per vector; must divide the embedding "
+            f"size (default: its largest divisor up to {PQ_SUBVECTORS})"
+        ),
+    )
+    add_model_arguments(build_ivfpq_parser)
+
+    ivfpq_benchmark_parser = subparsers.add_parser(
+        "ivfpq_benchmark",
+        help="Report IVF-PQ memory, recall@k and latency against exact search",
+    )
+    ivfpq_benchmark_parser.add_argument(
+        "--nprobe",
+        type=int,
+        nargs="+",
+        default=[1, 4, 16, 64],
+        help="nprobe operating points to measure",
+    )
+    ivfpq_benchmark_parser.add_argument(
+        "--rerank",
+        type=int,
+        default=IVFPQ_RERANK,
+        help="Shortlist re-scored against the full vectors",
+    )
+    ivfpq_benchmark_parser.add_argument(
+        "--limit", type=int, default=10, help="k for recall@k"
+    )
+    ivfpq_benchmark_parser.add_argument(
+        "--queries-file",
+        type=str,
+        help="File with one query per line; defaults to sampled chunks",
+    )
+    ivfpq_benchmark_parser.add_argument(
+        "--sample",
+        type=int,
+        default=ANN_BENCHMARK_SAMPLE,
+        help="Number of chunk embeddings used as queries without a queries file",
+    )
+    ivfpq_benchmark_parser.add_argument(
+        "--lists", type=int, help="Rebuild the index unless it has this many lists"
+    )
+    ivfpq_benchmark_parser.add_argument(
+        "--subvectors",
+        type=int,
+        help="Rebuild the index unless it has this many subvectors",
+    )
+    add_model_arguments(ivfpq_benchmark_parser)
+
+    quantization_benchmark_parser = subparsers.add_parser(
+        "quantization_benchmark",
+        help="Report int8/float16 recall@k and latency against float32 search",
+    )
+    quantization_benchmark_parser.add_argument(
+        "--rescore",
+        type=int,
+        default=QUANTIZED_RESCORE,
+        help="Candidates re-scored with float32 vectors",
+    )
+    quantization_benchmark_parser.add_argument(
+        "--limit", type=int, default=10, help="k for recall@k"
+    )
+    quantization_benchmark_parser.add_argument(
+        "--queries-file",
+        type=str,
+        help="File with one query per line; defaults to sampled chunks",
+    )
+    quantization_benchmark_parser.add_argument(
+        "--sample",
+        type=int,
+        default=ANN_BENCHMARK_SAMPLE,
+        help="Number of chunk embeddings used as queries without a queries file",
+    )
+    add_model_arguments(quantization_benchmark_parser)
+
+    cascade_benchmark_parser = subparsers.add_parser(
+        "cascade_benchmark",
+        help="Report cascaded search recall@k and latency against full chunk search",
+    )
+    cascade_benchmark_parser.add_argument(
+        "--shortlist",
+        type=int,
+        nargs="+",
+        default=[25, 50, CASCADE_SHORTLIST, 2 * CASCADE_SHORTLIST],
+        help="Movie shortlist sizes to measure",
+    )
+    cascade_benchmark_parser.add_argument(
+        "--limit", type=int, default=10, help="k for recall@k"
+    )
+    cascade_benchmark_parser.add_argument(
+        "--queries-file",
+        type=str,
+        help="File with one query per line; defaults to sampled chunks",
+    )
+    cascade_benchmark_parser.add_argument(
+        "--sample",
+        type=int,
+        default=ANN_BENCHMARK_SAMPLE,
+        help="Number of chunk embeddings used as queries without a queries file",
+    )
+    add_pooling_argument(cascade_benchmark_parser)
+    add_model_arguments(cascade_benchmark_parser, first_stage=True)
+
+    autotune_parser = subparsers.add_parser(
+        "autotune",
+        help="Benchmark encode batch size, threads and sequence length and save "
+        "the fastest",
+    )
+    autotune_parser.add_argument(
+        "--sample",
+        type=int,
+        default=AUTOTUNE_SAMPLE,
+        help="Number of movies encoded per configuration",
+    )
+    autotune_parser.add_argument(
+        "--batch-sizes",
+        type=int,
+        nargs="+",
+        default=list(AUTOTUNE_BATCH_SIZES),
+        help="Encode batch sizes to try",
+    )
+    autotune_parser.add_argument(
+        "--threads",
+        type=int,
+        nargs="+",
+        help="Torch thread counts to try; defaults to 1, half and all cores",
+    )
+    autotune_parser.add_argument(
+        "--max-seq-lengths",
+        type=int,
+        nargs="+",
+        help="Sequence lengths to try; defaults to the model's limit and "
+        "percentiles of the sample's token lengths",
+    )
+    autotune_parser.add_argument(
+        "--min-similarity",
+        type=float,
+        default=AUTOTUNE_MIN_SIMILARITY,
+        help="Lowest cosine similarity to full-length embeddings a truncating "
+        "sequence length may cause",
+    )
+    add_model_arguments(autotune_parser)
 
     args = parser.parse_args()
 
@@ -98,24 +401,291 @@ def main() -> None:
         case "embedquery":
             embed_query_text(args.query)
         case "search":
-            semantic_search(args.query, args.limit)
+            semantic_search(
+                args.query, args.limit, args.quantize, args.rescore, args.model
+            )
+        case "search_many":
+            for result in search_many_command(
+                read_queries(args.queries_file),
+                args.limit,
+                args.chunked,
+                args.quantize,
+                args.rescore,
+                args.pooling,
+                args.cascade,
+                args.model,
+                args.first_stage_model,
+                args.collapse_duplicates,
+            ):
+                print(f"Query: {result['query']}")
+                for i, res in enumerate(result["results"], 1):
+                    print(f"  {i}. {res['title']} (score: {res['score']:.4f})")
+                print()
         case "chunk":
             chunk_text(args.text, args.chunk_size, args.overlap)
         case "semantic_chunk":
             semantic_chunk_text(args.text, args.max_chunk_size, args.overlap)
+        case "embed_movies":
+            embeddings = embed_movies_command(args.batch_size, args.model)
+            print(f"Generated {len(embeddings)} movie embeddings")
         case "embed_chunks":
-            embeddings = embed_chunks_command()
-            print(f"Generated {len(embeddings)} chunked embeddings")
+            report = embed_chunks_command(args.batch_size, args.workers, args.model)
+            print(
+                f"Generated {report['vectors']} embeddings for "
+                f"{report['chunks']} chunks; "
+                f"{report['duplicate_movies']} movies are near-duplicates"
+            )
         case "search_chunked":
-            result = search_chunked_command(args.query, args.limit)
+            result = search_chunked_command(
+                args.query,
+                args.limit,
+                args.ann,
+                args.ef_search,
+                args.nprobe,
+                args.quantize,
+                args.rescore,
+                args.pooling,
+                args.cascade,
+                args.model,
+                args.first_stage_model,
+                args.collapse_duplicates,
+            )
             print(f"Query: {result['query']}")
             print("Results:")
             for i, res in enumerate(result["results"], 1):
                 print(f"\n{i}. {res['title']} (score: {res['score']:.4f})")
                 print(f"   {res['document']}...")
+        case "build_ann":
+            index = build_ann_command(args.m, args.ef_construction, args.model)
+            print(
+                f"HNSW graph over {len(index.vectors)} chunks: "
+                f"{len(index.links)} layers, m={index.m}, "
+                f"ef_construction={index.ef_construction}"
+            )
+        case "ann_benchmark":
+            report = ann_benchmark_command(
+                args.ef_search,
+                args.limit,
+                read_queries(args.queries_file),
+                args.sample,
+                args.m,
+                args.ef_construction,
+                args.model,
+            )
+            print(
+                f"{report['queries']} queries over {report['chunks']} chunks, "
+                f"m={report['m']}, ef_construction={report['ef_construction']}"
+            )
+            print(f"Exact: {report['exact_latency_ms']:.3f} ms/query")
+            recall_header = f"recall@{report['limit']}"
+            print(f"{'ef_search':>10} {recall_header:>10} {'ms/query':>10}")
+            for point in report["operating_points"]:
+                print(
+                    f"{point['ef_search']:>10} {point['recall']:>10.4f} "
+                    f"{point['latency_ms']:>10.3f}"
+                )
+        case "build_ivfpq":
+            index = build_ivfpq_command(args.lists, args.subvectors, args.model)
+            print(
+                f"IVF-PQ index over {len(index.list_ids)} chunks: "
+                f"{len(index.centroids)} lists, {len(index.codebooks)} subvectors, "
+                f"{index.code_bytes_per_vector} bytes/vector"
+            )
+        case "ivfpq_benchmark":
+            report = ivfpq_benchmark_command(
+                args.nprobe,
+                args.limit,
+                args.rerank,
+                read_queries(args.queries_file),
+                args.sample,
+                args.lists,
+                args.subvectors,
+                args.model,
+            )
+            print(
+                f"{report['queries']} queries over {report['chunks']} chunks, "
+                f"{report['lists']} lists, {report['subvectors']} subvectors"
+            )
+            print(
+                f"Bytes/vector: {report['float32_bytes_per_vector']} float32, "
+                f"{report['code_bytes_per_vector']} code+id, "
+                f"{report['index_bytes_per_vector']:.1f} with codebooks"
+            )
+            print(f"Exact: {report['exact_latency_ms']:.3f} ms/query")
+            recall_header = f"recall@{report['limit']}"
+            print(
+                f"{'nprobe':>8} {'rerank':>8} {recall_header:>10} {'ms/query':>10}"
+            )
+            for point in report["operating_points"]:
+                print(
+                    f"{point['nprobe']:>8} {point['rerank']:>8} "
+                    f"{point['recall']:>10.4f} {point['latency_ms']:>10.3f}"
+                )
+        case "quantization_benchmark":
+            report = quantization_benchmark_command(
+                args.limit,
+                args.rescore,
+                read_queries(args.queries_file),
+                args.sample,
+                args.model,
+            )
+            print(f"{report['queries']} queries over {report['chunks']} chunks")
+            print(
+                f"float32: {report['float32_bytes_per_vector']} bytes/vector, "
+                f"{report['exact_latency_ms']:.3f} ms/query"
+            )
+            recall_header = f"recall@{report['limit']}"
+            print(
+                f"{'kind':>8} {'bytes':>6} {'rescore':>8} {recall_header:>10} "
+                f"{'ms/query':>10}"
+            )
+            for point in report["operating_points"]:
+                print(
+                    f"{point['kind']:>8} {point['bytes_per_vector']:>6} "
+                    f"{point['rescore']:>8} {point['recall']:>10.4f} "
+                    f"{point['latency_ms']:>10.3f}"
+                )
+        case "cascade_benchmark":
+            report = cascade_benchmark_command(
+                args.shortlist,
+                args.limit,
+                read_queries(args.queries_file),
+                args.sample,
+                args.pooling,
+                args.model,
+                args.first_stage_model,
+            )
+            print(
+                f"{report['queries']} queries over {report['movies']} movies, "
+                f"{report['chunks']} chunks, {report['pooling']} pooling"
+            )
+            print(
+                f"Shortlist by {report['first_stage_model']}, "
+                f"chunks by {report['model']}"
+            )
+            print(f"Full chunk search: {report['exact_latency_ms']:.3f} ms/query")
+            recall_header = f"recall@{report['limit']}"
+            print(f"{'shortlist':>10} {recall_header:>10} {'ms/query':>10}")
+            for point in report["operating_points"]:
+                print(
+                    f"{point['shortlist']:>10} {point['recall']:>10.4f} "
+                    f"{point['latency_ms']:>10.3f}"
+                )
+        case "autotune":
+            report = autotune_command(
+                args.model,
+                args.sample,
+                args.batch_sizes,
+                args.threads,
+                args.max_seq_lengths,
+                args.min_similarity,
+            )
+            print(f"{report['model']}: {report['texts']} movies per configuration")
+            print(
+                f"{'seq_len':>8} {'threads':>8} {'batch':>6} {'texts/s':>10} "
+                f"{'min_sim':>8}"
+            )
+            for point in report["operating_points"]:
+                flag = "" if point["eligible"] else "  (truncates too much)"
+                print(
+                    f"{point['max_seq_length']:>8} {point['threads']:>8} "
+                    f"{point['batch_size']:>6} {point['texts_per_second']:>10.1f} "
+                    f"{point['min_similarity']:>8.4f}{flag}"
+                )
+            best = report["best"]
+            if best is None:
+                print("No configuration met --min-similarity; nothing saved")
+            else:
+                print(
+                    f"Saved: batch_size={best['batch_size']}, "
+                    f"threads={best['threads']}, "
+                    f"max_seq_length={best['max_seq_length']}"
+                )
         case _:
             parser.print_help()
 
+    if getattr(args, "cache_stats", False):
+        stats = query_cache_stats(args.model)
+        print(
+            f"\nQuery embedding cache: {stats['hits']} hits, "
+            f"{stats['disk_hits']} disk hits, {stats['misses']} misses "
+            f"({stats['hit_rate']:.0%} hit rate), {stats['size']} cached"
+        )
+
+
+def add_quantization_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--quantize",
+        choices=QUANTIZATION_KINDS,
+        help="Score on int8 or float16 embeddings, then re-score in float32",
+    )
+    parser.add_argument(
+        "--rescore",
+        type=int,
+        default=QUANTIZED_RESCORE,
+        help="Candidates re-scored with float32 vectors when quantized",
+    )
+
+
+def add_pooling_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--pooling",
+        choices=POOLING_METHODS,
+        default="max",
+        help="How chunk scores combine into a movie score",
+    )
+
+
+def add_cascade_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--cascade",
+        type=int,
+        nargs="?",
+        const=CASCADE_SHORTLIST,
+        metavar="SHORTLIST",
+        help="Score only the chunks of the SHORTLIST movies whose movie "
+        f"embeddings match best (default {CASCADE_SHORTLIST})",
+    )
+
+
+def add_collapse_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--collapse-duplicates",
+        action="store_true",
+        help="Return only the best of movies with near-duplicate descriptions",
+    )
+
+
+def add_model_arguments(
+        parser: argparse.ArgumentParser, first_stage: bool = False
+) -> None:
+    parser.add_argument(
+        "--model",
+        default=DEFAULT_EMBEDDING_MODEL,
+        help=f"Embedding model (default {DEFAULT_EMBEDDING_MODEL})",
+    )
+    if first_stage:
+        parser.add_argument(
+            "--first-stage-model",
+            help="Smaller model whose movie embeddings pick the cascade "
+            "shortlist (default --model)",
+        )
+
+
+def add_cache_stats_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--cache-stats",
+        action="store_true",
+        help="Print query embedding cache hit counters after searching",
+    )
+
+
+def read_queries(path: Optional[str]) -> Optional[list[str]]:
+    if not path:
+        return None
+    with open(path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
 
 if __name__ == "__main__":
     main()
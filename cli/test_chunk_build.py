@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import random
+import tempfile
+import unittest
+from typing import Optional
+from unittest import mock
+
+import numpy as np
+
+from lib import embedding_cache, model_artifacts, models, near_duplicates
+from lib import semantic_search
+from lib.model_artifacts import ModelArtifacts
+from lib.semantic_search import ChunkedSemanticSearch
+
+MODEL_NAME = "test-chunk-model"
+DIMENSIONS = 8
+# Wide enough that unrelated descriptions are never near-duplicates.
+WORDS = [f"word{i}" for i in range(500)]
+
+
+class Interrupted(Exception):
+    pass
+
+
+class FakeModel:
+    """Deterministic per-text vectors; raises after `fail_after` encode calls."""
+
+    max_seq_length = 256
+
+    def __init__(self) -> None:
+        self.encoded: list[str] = []
+        self.calls = 0
+        self.fail_after: Optional[int] = None
+
+    def encode(self, texts: list[str], **kwargs) -> np.ndarray:
+        if texts:
+            if self.fail_after is not None and self.calls >= self.fail_after:
+                raise Interrupted()
+            self.calls += 1
+            self.encoded.extend(texts)
+        return np.array(
+            [
+                np.frombuffer(
+                    hashlib.sha256(text.encode()).digest()[:DIMENSIONS], np.uint8
+                )
+                for text in texts
+            ],
+            dtype=np.float32,
+        ).reshape(len(texts), DIMENSIONS)
+
+
+def make_description(rng: random.Random) -> str:
+    return " ".join(
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 12))) + "."
+        for _ in range(rng.randint(1, 9))
+    )
+
+
+def make_movies(count: int, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    movies = [
+        {"id": i + 1, "title": f"Movie {i}", "description": make_description(rng)}
+        for i in range(count)
+    ]
+    # Exact copies of earlier descriptions, as a catalog has for remakes.
+    for i in range(5, count, 7):
+        movies[i]["description"] = movies[rng.randrange(i)]["description"]
+    return movies
+
+
+class ChunkBuildTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.model = FakeModel()
+        for target, name, value in [
+            (model_artifacts, "MODEL_CACHE_DIR", self.path("models")),
+            (embedding_cache, "QUERY_EMBEDDINGS_DIR", self.path("queries")),
+            (semantic_search, "CHUNK_TASK_SIZE", 16),
+            (near_duplicates, "DUPLICATE_RUN_SIZE", 16),
+        ]:
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for patcher in [
+            mock.patch.dict(
+                models.MODEL_LOADERS,
+                {models.SENTENCE_TRANSFORMER: lambda name: self.model},
+            ),
+            mock.patch.dict(models._models, clear=True),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.stores = 0
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def embed(
+            self,
+            movies: list[dict],
+            workers: int = 1,
+            fail_after: Optional[int] = None,
+    ) -> None:
+        """Embed the chunks of `movies` with an empty embedding cache.
+
+        With `fail_after`, the model is interrupted after that many batches.
+        """
+        self.stores += 1
+        store = self.path(f"store_{self.stores}")
+        self.model.calls = 0
+        self.model.fail_after = fail_after
+        with mock.patch.object(embedding_cache, "EMBEDDING_STORE_DIR", store):
+            searcher = ChunkedSemanticSearch(MODEL_NAME)
+            searcher.embed_chunks(iter(movies), batch_size=8, workers=workers)
+
+    def interrupt(self, movies: list[dict], fail_after: int, **kwargs) -> int:
+        """Interrupt a build of `movies` and return how many movies it completed."""
+        with self.assertRaises(Interrupted):
+            self.embed(movies, fail_after=fail_after, **kwargs)
+        path = os.path.join(ModelArtifacts(MODEL_NAME).chunk_build, "progress.json")
+        with open(path) as f:
+            return json.load(f)["movies"]
+
+    def outputs(self) -> tuple[bytes, bytes]:
+        artifacts = ModelArtifacts(MODEL_NAME)
+        outputs = []
+        for path in [artifacts.chunk_embeddings, artifacts.chunk_metadata]:
+            with open(path, "rb") as f:
+                outputs.append(f.read())
+        return outputs[0], outputs[1]
+
+    def clean_build(self, movies: list[dict]) -> tuple[bytes, bytes]:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = os.path.join(directory.name, "models")
+        with mock.patch.object(model_artifacts, "MODEL_CACHE_DIR", cache):
+            self.embed(movies)
+            return self.outputs()
+
+    def metadata(self) -> np.ndarray:
+        return np.load(ModelArtifacts(MODEL_NAME).chunk_metadata)
+
+
+class ResumeTest(ChunkBuildTestCase):
+    def test_resume_matches_clean_build(self) -> None:
+        movies = make_movies(120)
+        clean = self.clean_build(movies)
+        clean_encoded = len(self.model.encoded)
+        for workers in [1, 2]:
+            for fail_after in [1, 6, 20]:
+                with self.subTest(workers=workers, fail_after=fail_after):
+                    completed = self.interrupt(movies, fail_after, workers=workers)
+                    self.assertGreater(completed, 0)
+                    self.assertLess(completed, len(movies))
+                    self.model.encoded = []
+                    self.embed(movies, workers=workers)
+                    self.assertEqual(self.outputs(), clean)
+                    # Only chunks of movies the build had not completed are
+                    # encoded again.
+                    pending = {
+                        chunk
+                        for movie in movies[completed:]
+                        for chunk in semantic_search.semantic_chunk(
+                            movie["description"]
+                        )
+                    }
+                    self.assertLessEqual(set(self.model.encoded), pending)
+                    self.assertLess(len(self.model.encoded), clean_encoded)
+                    self.assertFalse(
+                        os.path.exists(ModelArtifacts(MODEL_NAME).chunk_build)
+                    )
+
+    def test_resume_twice(self) -> None:
+        movies = make_movies(120, seed=1)
+        clean = self.clean_build(movies)
+        first = self.interrupt(movies, 4)
+        second = self.interrupt(movies, 4)
+        self.assertGreater(second, first)
+        self.embed(movies)
+        self.assertEqual(self.outputs(), clean)
+
+
+class RewindTest(ChunkBuildTestCase):
+    def test_changed_movie_rewinds(self) -> None:
+        movies = make_movies(120, seed=2)
+        completed = self.interrupt(movies, 10)
+        changed = [dict(movie) for movie in movies]
+        changed[completed // 2]["description"] = "A storm hits the city. The end."
+        self.model.encoded = []
+        clean = self.clean_build(changed)
+        clean_encoded = len(self.model.encoded)
+        self.model.encoded = []
+        self.embed(changed)
+        self.assertEqual(self.outputs(), clean)
+        # Movies before the changed one were kept.
+        self.assertLess(len(self.model.encoded), clean_encoded)
+
+    def test_shorter_catalog_rewinds(self) -> None:
+        movies = make_movies(120, seed=3)
+        completed = self.interrupt(movies, 10)
+        shorter = movies[: completed // 2]
+        clean = self.clean_build(shorter)
+        self.embed(shorter)
+        self.assertEqual(self.outputs(), clean)
+        self.assertEqual(self.metadata()["movie_idx"].max(), len(shorter) - 1)
+
+
+class DuplicateTest(ChunkBuildTestCase):
+    def test_duplicates_share_vectors(self) -> None:
+        movies = make_movies(120, seed=4)
+        self.embed(movies)
+        metadata = self.metadata()
+        embeddings = np.load(ModelArtifacts(MODEL_NAME).chunk_embeddings)
+        descriptions = [movie["description"] for movie in movies]
+        first = {}
+        for i, description in enumerate(descriptions):
+            first.setdefault(description, i)
+        chunks = {
+            i: metadata[metadata["movie_idx"] == i] for i in range(len(movies))
+        }
+        for i, description in enumerate(descriptions):
+            rows = chunks[i]
+            self.assertTrue((rows["canonical_movie"] == first[description]).all())
+            texts = semantic_search.semantic_chunk(description)
+            self.assertEqual(len(rows), len(texts))
+            np.testing.assert_array_equal(
+                rows["vector_idx"], chunks[first[description]]["vector_idx"]
+            )
+            np.testing.assert_array_equal(
+                embeddings[rows["vector_idx"]], self.model.encode(texts)
+            )
+        self.assertLess(len(embeddings), len(metadata))
+        self.assertEqual(len(embeddings), len(set(self.model.encoded)))
+
+
+if __name__ == "__main__":
+    unittest.main()
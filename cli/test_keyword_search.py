@@ -0,0 +1,147 @@
+import random
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+from lib import keyword_search
+from lib.keyword_search import InvertedIndex, TextAnalyzer
+
+WORDS = ["bear", "attack", "river", "city", "night", "storm", "ghost", "train"]
+
+
+def make_movies(count: int, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    return [
+        {
+            "id": i + 1,
+            "title": f"Movie {i}",
+            "description": " ".join(
+                rng.choice(WORDS) for _ in range(rng.randint(3, 30))
+            ),
+        }
+        for i in range(count)
+    ]
+
+
+class KeywordIndexTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        analyzer = TextAnalyzer(stopwords=["the", "a"])
+        for target, value in [
+            ("CACHE_DIR", directory.name),
+            ("get_analyzer", lambda: analyzer),
+        ]:
+            patcher = mock.patch.object(keyword_search, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def build(self, movies: list[dict], **kwargs) -> InvertedIndex:
+        index = InvertedIndex()
+        with mock.patch.object(keyword_search, "iter_movies", lambda: iter(movies)):
+            index.build(**kwargs)
+        index.save()
+        return index
+
+
+class BuildTest(KeywordIndexTestCase):
+    def test_build_merges_into_one_segment(self) -> None:
+        movies = make_movies(300)
+        repeated = {**movies[10], "description": "ghost train"}
+        index = self.build([*movies, repeated], batch_size=40)
+        self.assertEqual(len(index.segments), 1)
+        self.assertEqual(index.doc_count, len(movies))
+        self.assertEqual(index.docmap[repeated["id"]], repeated)
+
+    def test_workers_share_one_pool(self) -> None:
+        movies = make_movies(300)
+        pools = []
+
+        def executor(**kwargs):
+            pools.append(ProcessPoolExecutor(**kwargs))
+            return pools[-1]
+
+        with mock.patch.object(keyword_search, "ProcessPoolExecutor", executor):
+            index = self.build(movies, workers=2, batch_size=40)
+            self.assertEqual(len(pools), 1)
+            changed = make_movies(300, seed=1)
+            changes = index.sync(changed, batch_size=40, workers=2)
+            self.assertEqual(changes["updated"], len(changed))
+            self.assertEqual(len(pools), 2)
+        index.wait_for_merge()
+        self.assertEqual(
+            {r["id"] for r in index.bm25_search("ghost", 300)},
+            {m["id"] for m in changed if "ghost" in m["description"].split()},
+        )
+
+
+class PhraseSearchTest(KeywordIndexTestCase):
+    def expected(self, movies: list[dict], words: list[str], window=None) -> set[int]:
+        ids = set()
+        for movie in movies:
+            tokens = f"{movie['title']} {movie['description']}".lower().split()
+            if window is None:
+                n = len(words)
+                found = any(
+                    tokens[i : i + n] == words for i in range(len(tokens) - n + 1)
+                )
+            else:
+                found = any(
+                    set(words) <= set(tokens[i : i + window])
+                    for i in range(len(tokens))
+                )
+            if found:
+                ids.add(movie["id"])
+        return ids
+
+    def assert_matches(self, index: InvertedIndex, movies: list[dict]) -> None:
+        for words, window in [(["bear", "attack"], None), (["river", "storm"], 3)]:
+            results = index.phrase_search(" ".join(words), len(movies), window)
+            self.assertEqual(
+                {result["id"] for result in results},
+                self.expected(movies, words, window),
+            )
+
+    def test_phrase_after_delete(self) -> None:
+        movies = make_movies(500)
+        index = self.build(movies, positions=True)
+        deleted = set(range(1, 501, 7))
+        index.delete_documents(deleted)
+        index.wait_for_merge()
+        self.assertTrue(any(segment.deleted for segment in index.segments))
+        self.assert_matches(index, [m for m in movies if m["id"] not in deleted])
+
+    def test_phrase_after_sync(self) -> None:
+        movies = make_movies(500)
+        index = self.build(movies, positions=True)
+        updated = {m["id"]: m for m in make_movies(500, seed=1)[:200:4]}
+        movies = [updated.get(m["id"], m) for m in movies if m["id"] % 10]
+        index.sync(movies)
+        index.wait_for_merge()
+        self.assertTrue(any(segment.deleted for segment in index.segments))
+        self.assert_matches(index, movies)
+
+
+class BM25BatchTest(KeywordIndexTestCase):
+    def test_batch_breaks_ties_like_single_query(self) -> None:
+        ids = random.Random(0).sample(range(1, 10_000), 400)
+        movies = [
+            {
+                "id": doc_id,
+                "title": f"Movie {i}",
+                "description": "ghost train" if i % 3 else "bear attack",
+            }
+            for i, doc_id in enumerate(ids)
+        ]
+        index = self.build(movies, batch_size=64)
+        index.delete_documents(ids[::50])
+        queries = ["ghost", "bear attack", "ghost bear", "storm"]
+        for limit in [1, 10, 150, 500]:
+            batch = index.bm25_search_many(queries, limit)
+            for query, results in zip(queries, batch):
+                self.assertEqual(results, index.bm25_search(query, limit))
+
+
+if __name__ == "__main__":
+    unittest.main()